@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+批量导入多个月的 csv 帐单, 代替对每个文件分别跑 bean-extract。
+
+- 各文件的行通过生成器流式读出, 分批提交给工作进程, 不会一次把所有帐单读进内存
+- 生成 Transaction 和分类在多个工作进程中完成, 得到的交易和 bean-extract
+  (csv.Importer.extract)相同, 有余额列时同样在帐单末尾加 balance 断言。
+  交易按帐单中的顺序写入, 日期降序的帐单不会像 bean-extract 那样反转
+- 按 (日期, 金额, 卡号末四位, 描述) 的哈希去重: 一份帐单中某个哈希第 n 次出现时,
+  ledger/daily/ 和输出目录下(包括本批次已写入的)同一哈希的交易不足 n 笔才导入。
+  同一天同一张卡两笔相同的地铁扣费都会导入, 时间范围重叠的两份帐单只导入一次
+- 按交易月份写到 {output-dir}/{年}/{年-月}-{name}.beancount, 文件已存在时追加
+
+例:
+    ./scripts/batch-import.py raw-data/spdbcc/*.csv
+"""
+import os
+import sys
+import csv
+import glob
+import time
+import hashlib
+import datetime
+import itertools
+import collections
+import functools
+import logging
+import multiprocessing
+
+import click
+import dateutil.parser
+from beancount.core import data
+from beancount.core.amount import Amount
+from beancount.ingest import cache
+from beancount.ingest.importers.csv import Col, normalize_config
+from beancount.parser import parser
+from beancount.parser import printer
+from beancount.utils.date_utils import parse_date_liberally
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTERS_DIR = os.path.join(ROOT_DIR, "importers")
+DAILY_DIR = os.path.join(ROOT_DIR, "ledger", "daily")
+
+CHUNK_SIZE = 256
+# 同时提交给进程池的行数为 workers * CHUNK_SIZE * WINDOW_CHUNKS, 最多两批在处理中
+WINDOW_CHUNKS = 4
+PROGRESS_EVERY = 10000
+
+logger = logging.getLogger()
+
+# 工作进程中的 importer 配置, 由 _init_worker 设置
+_worker_config = None
+
+
+def load_importer_config(module_name):
+    sys.path.insert(0, IMPORTERS_DIR)
+    module = __import__(module_name)
+    return module.CONFIG
+
+
+def txn_key(date, units, card, narration):
+    """用于去重的 (日期, 金额, 卡号末四位, 描述) 哈希"""
+    raw = "\t".join([
+        date.isoformat(), str(units.number.normalize()), units.currency,
+        str(card or ""), narration.strip(),
+    ])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def balance_key(date, account, amount):
+    """用于去重的 balance 指令的哈希"""
+    raw = "\t".join(["balance", date.isoformat(), account, str(amount.number.normalize()),
+                     amount.currency])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def get_existing_keys(daily_dirs, accounts):
+    """
+    解析 daily_dirs 下所有 beancount 文件(包括还没被 include 的)
+
+    Returns:
+        Counter: 记在 accounts 上的交易和 balance 指令的去重哈希 -> 个数
+    """
+    paths = set()
+    for daily_dir in daily_dirs:
+        paths.update(
+            os.path.abspath(path)
+            for path in glob.glob(os.path.join(daily_dir, "**", "*.beancount"), recursive=True)
+        )
+    keys = collections.Counter()
+    for path in sorted(paths):
+        entries, _, _ = parser.parse_file(path)
+        for entry in entries:
+            if isinstance(entry, data.Balance) and entry.account in accounts:
+                keys[balance_key(entry.date, entry.account, entry.amount)] += 1
+            if not isinstance(entry, data.Transaction):
+                continue
+            for posting in entry.postings:
+                if posting.account in accounts and posting.units is not None:
+                    keys[txn_key(
+                        entry.date, posting.units, entry.meta.get("card"), entry.narration
+                    )] += 1
+    return keys
+
+
+def identify_importer(config, path):
+    file_memo = cache.get_file(path)
+    for importer_idx, importer in enumerate(config):
+        if importer.identify(file_memo):
+            return importer_idx
+    return None
+
+
+def iter_rows(config, paths):
+    """
+    逐行读出所有帐单文件
+
+    Yields:
+        (importer 下标, iconfig, 文件名, 行号, row)
+    """
+    for path in paths:
+        path = os.path.abspath(path)
+        importer_idx = identify_importer(config, path)
+        if importer_idx is None:
+            logger.warning("No importer matches %s, skipped", path)
+            continue
+        importer = config[importer_idx]
+        iconfig, has_header = normalize_config(
+            importer.config,
+            cache.get_file(path).head(encoding=importer.encoding),
+            importer.csv_dialect,
+            importer.skip_lines,
+        )
+        with open(path, encoding=importer.encoding) as fhandler:
+            reader = csv.reader(fhandler, dialect=importer.csv_dialect)
+            for _ in range(importer.skip_lines):
+                next(reader)
+            if has_header:
+                next(reader)
+            for index, row in enumerate(reader, 1):
+                if not row or row[0].startswith("#"):
+                    continue
+                yield importer_idx, iconfig, path, index, row
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date(date_str, dateutil_kwds_items):
+    # 一份帐单里日期重复很多, dateutil 解析比较慢
+    return parse_date_liberally(date_str, dict(dateutil_kwds_items))
+
+
+def _get_field(iconfig, row, ftype):
+    return row[iconfig[ftype]] if ftype in iconfig and iconfig[ftype] < len(row) else None
+
+
+def get_row_date(importer, iconfig, row):
+    dateutil_kwds_items = tuple(sorted((importer.dateutil_kwds or {}).items()))
+    return _parse_date(_get_field(iconfig, row, Col.DATE), dateutil_kwds_items)
+
+
+def build_transaction(importer, iconfig, filename, index, row):
+    """
+    和 csv.Importer.extract 对单行的处理相同, 返回 None 表示金额为空的行。
+    有余额列时余额放在 meta["balance"] 中, 由调用方取出后生成 balance 指令
+    """
+    dateutil_kwds_items = tuple(sorted((importer.dateutil_kwds or {}).items()))
+
+    def get(ftype):
+        return _get_field(iconfig, row, ftype)
+
+    payee = get(Col.PAYEE)
+    if payee:
+        payee = payee.strip()
+    fields = filter(None, [get(field) for field in (Col.NARRATION1, Col.NARRATION2, Col.NARRATION3)])
+    narration = importer.narration_sep.join(field.strip() for field in fields).replace("\n", "; ")
+    tag = get(Col.TAG)
+    link = get(Col.REFERENCE_ID)
+
+    meta = data.new_metadata(filename, index)
+    txn_date = get(Col.TXN_DATE)
+    if txn_date is not None:
+        meta["date"] = _parse_date(txn_date, dateutil_kwds_items)
+    txn_time = get(Col.TXN_TIME)
+    if txn_time is not None:
+        meta["time"] = str(dateutil.parser.parse(txn_time).time())
+    balance = get(Col.BALANCE)
+    if balance is not None:
+        meta["balance"] = importer.parse_amount(balance)
+    last4 = get(Col.LAST4)
+    if last4:
+        meta["card"] = importer.last4_map.get(last4.strip()) or last4
+
+    date = get_row_date(importer, iconfig, row)
+    txn = data.Transaction(
+        meta, date, importer.FLAG, payee, narration,
+        {tag} if tag else data.EMPTY_SET, {link} if link else data.EMPTY_SET, [],
+    )
+
+    amount_debit, amount_credit = importer.get_amounts(
+        iconfig, row, False, importer.parse_amount
+    )
+    if amount_debit is None and amount_credit is None:
+        return None
+    account = importer.file_account(None)
+    for amount in [amount_debit, amount_credit]:
+        if amount is None:
+            continue
+        if importer.invert_sign:
+            amount = -amount
+        txn.postings.append(
+            data.Posting(account, Amount(amount, importer.currency), None, None, None, None)
+        )
+    return importer.call_categorizer(txn, row)
+
+
+def _init_worker(module_name):
+    global _worker_config
+    _worker_config = load_importer_config(module_name)
+
+
+def _process_row(item):
+    """
+    工作进程: 生成并分类交易
+
+    Returns:
+        (帐单文件名, 日期, 去重哈希, 格式化后的交易, (账户, 余额) 或 None),
+        金额为空的行去重哈希和交易为 None
+    """
+    importer_idx, iconfig, filename, index, row = item
+    importer = _worker_config[importer_idx]
+    txn = build_transaction(importer, iconfig, filename, index, row)
+    if txn is None:
+        return filename, get_row_date(importer, iconfig, row), None, None, None
+    balance = txn.meta.pop("balance", None)
+    if balance is not None:
+        balance = (importer.file_account(None), Amount(balance, importer.currency))
+    units = txn.postings[0].units
+    key = txn_key(txn.date, units, txn.meta.get("card"), txn.narration)
+    return filename, txn.date, key, printer.format_entry(txn), balance
+
+
+class Statement:
+    """
+    一份帐单中 csv.Importer.extract 用来生成 balance 指令的信息: 帐单按日期升序时
+    用最后一笔交易的余额, 否则用第一笔交易的余额, 日期为该交易的第二天
+    """
+    __slots__ = ("first_date", "last_date", "first_txn", "last_txn")
+
+    def __init__(self):
+        self.first_date = self.last_date = None
+        # (日期, (账户, 余额) 或 None)
+        self.first_txn = self.last_txn = None
+
+    def add(self, date, balance=None, is_txn=True):
+        if self.first_date is None:
+            self.first_date = date
+        self.last_date = date
+        if is_txn:
+            if self.first_txn is None:
+                self.first_txn = (date, balance)
+            self.last_txn = (date, balance)
+
+    def get_balance(self, filename):
+        if self.first_txn is None:
+            return None
+        is_ascending = self.first_date < self.last_date
+        date, balance = self.last_txn if is_ascending else self.first_txn
+        if balance is None:
+            return None
+        account, amount = balance
+        return data.Balance(
+            data.new_metadata(filename, 0), date + datetime.timedelta(days=1),
+            account, amount, None, None,
+        )
+
+
+def iter_results(pool, func, items, window):
+    """
+    和 pool.imap(func, items) 相同, 但每次只从 items 中取 window 个提交。
+    Pool.imap 的任务线程会一口气读完整个生成器, 大帐单的行会全部堆在内存里;
+    这里在处理当前一批时提交下一批, 内存中最多有两批
+    """
+    items = iter(items)
+    pending = collections.deque()
+    while True:
+        batch = list(itertools.islice(items, window))
+        if batch:
+            pending.append(pool.imap(func, batch, CHUNK_SIZE))
+        if len(pending) > 1 or (pending and not batch):
+            yield from pending.popleft()
+        if not batch and not pending:
+            return
+
+
+class MonthlyWriter:
+    """按交易月份把交易写到不同文件, 每个文件只打开一次"""
+
+    def __init__(self, output_dir, name):
+        self.output_dir = output_dir
+        self.name = name
+        self._handlers = {}
+        self.counts = {}
+
+    def get_path(self, date):
+        return os.path.join(
+            self.output_dir, str(date.year), f"{date:%Y-%m}-{self.name}.beancount"
+        )
+
+    def write(self, date, text):
+        path = self.get_path(date)
+        if path not in self._handlers:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            is_new = not os.path.exists(path)
+            fhandler = open(path, "a")
+            if is_new:
+                fhandler.write(";; -*- mode: beancount -*-\n")
+                fhandler.write("; 由 scripts/batch-import.py 生成, 人工检查后 include 到帐本中\n")
+            self._handlers[path] = fhandler
+            self.counts[path] = 0
+        self._handlers[path].write("\n" + text)
+        self.counts[path] += 1
+
+    def close(self):
+        for fhandler in self._handlers.values():
+            fhandler.close()
+
+
+@click.command()
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--importer", "module_name", default="spdccc_importer", show_default=True,
+              help="importers/ 下的模块名, 使用其中的 CONFIG")
+@click.option("--name", default="spdbcc", show_default=True, help="输出文件名后缀")
+@click.option("--output-dir", default=DAILY_DIR, show_default=True)
+@click.option("--workers", default=os.cpu_count(), show_default=True)
+def main(paths, module_name, name, output_dir, workers):
+    logging.basicConfig(level=logging.INFO)
+    config = load_importer_config(module_name)
+
+    accounts = {importer.file_account(None) for importer in config}
+    daily_dirs = sorted({DAILY_DIR, os.path.abspath(output_dir)})
+    existing_keys = get_existing_keys(daily_dirs, accounts)
+    logger.info(
+        "Found %d existing transactions in %s",
+        sum(existing_keys.values()), ", ".join(daily_dirs),
+    )
+    # (帐单文件名, 去重哈希) -> 在该文件中出现的次数
+    occurrences = collections.Counter()
+    statements = collections.defaultdict(Statement)
+
+    writer = MonthlyWriter(output_dir, name)
+    num_rows = num_skipped = num_duplicated = 0
+    start = time.time()
+    with multiprocessing.Pool(workers, _init_worker, (module_name,)) as pool:
+        results = iter_results(
+            pool, _process_row, iter_rows(config, paths), workers * CHUNK_SIZE * WINDOW_CHUNKS
+        )
+        for result in results:
+            num_rows += 1
+            if num_rows % PROGRESS_EVERY == 0:
+                logger.info("%d rows, %.0f rows/s", num_rows, num_rows / (time.time() - start))
+            filename, date, key, text, balance = result
+            statements[filename].add(date, balance, key is not None)
+            if key is None:
+                num_skipped += 1
+                continue
+            occurrences[filename, key] += 1
+            if occurrences[filename, key] <= existing_keys[key]:
+                num_duplicated += 1
+                continue
+            # 本批次写入的交易也算作已有, 和之后重叠的帐单去重
+            existing_keys[key] = occurrences[filename, key]
+            writer.write(date, text)
+
+    # 和 bean-extract 一样在每份帐单末尾的余额处加 balance 断言
+    num_balances = 0
+    for filename, statement in statements.items():
+        entry = statement.get_balance(filename)
+        if entry is None:
+            continue
+        key = balance_key(entry.date, entry.account, entry.amount)
+        if existing_keys[key]:
+            continue
+        existing_keys[key] += 1
+        writer.write(entry.date, printer.format_entry(entry))
+        num_balances += 1
+    writer.close()
+
+    elapsed = time.time() - start
+    for path, count in sorted(writer.counts.items()):
+        logger.info("Wrote %d transactions to %s", count, path)
+    logger.info(
+        "Processed %d rows from %d files in %.2fs (%.0f rows/s): "
+        "%d imported, %d balances, %d duplicated, %d empty",
+        num_rows, len(paths), elapsed, num_rows / elapsed if elapsed else 0,
+        sum(writer.counts.values()) - num_balances, num_balances, num_duplicated, num_skipped,
+    )
+
+
+if __name__ == "__main__":
+    main()
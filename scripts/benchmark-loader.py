@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+对比串行(beancount.loader.load_file)和不同进程数并行解析 include 文件的加载耗时,
+并确认 entries、errors 和 options 都和串行加载完全一致
+
+默认用按天拆分交易文件的模拟帐本, 也可以用 --ledger 指定真实的帐本。
+
+例:
+    ./scripts/benchmark-loader.py --years 4 --jobs 1,2,4,8
+    ./scripts/benchmark-loader.py --ledger ledger/main.beancount
+"""
+import time
+import logging
+import tempfile
+
+import click
+
+from ledger_loader import load_ledger
+from synthetic_ledger import DAILY_FILENAME_FORMATS, SyntheticLedger
+
+
+def get_comparable(result):
+    """DisplayContext 没有实现 __eq__, 用它的字符串形式比较"""
+    entries, errors, options_map = result
+    options_map = dict(options_map, dcontext=str(options_map["dcontext"]))
+    errors = [(error.source, error.message) for error in errors]
+    return entries, errors, options_map
+
+
+def run(ledger_file, jobs_list):
+    baseline = None
+    serial_elapsed = None
+    print("jobs,seconds,speedup")
+    for jobs in jobs_list:
+        start = time.time()
+        result = load_ledger(ledger_file, use_cache=False, use_price_cache=False, jobs=jobs)
+        elapsed = time.time() - start
+        result = get_comparable(result)
+        if baseline is None:
+            baseline, serial_elapsed = result, elapsed
+        else:
+            for name, value, expected in zip(("entries", "errors", "options"), result, baseline):
+                if value != expected:
+                    raise click.ClickException(f"Loaded {name} of --jobs {jobs} differ from serial")
+        print(f"{jobs},{elapsed:.3f},{serial_elapsed / elapsed:.2f}", flush=True)
+
+
+@click.command()
+@click.option('--ledger', 'ledger_file', default=None, type=click.Path(exists=True),
+              help="默认生成模拟帐本")
+@click.option('--years', default=2.0, show_default=True, help="模拟帐本的历史年数")
+@click.option('--commodities', default=20, show_default=True, help="模拟帐本的标的数")
+@click.option('--txns-per-day', default=5, show_default=True, help="模拟帐本每天的消费交易数")
+@click.option('--daily-split', default="day", show_default=True,
+              type=click.Choice(list(DAILY_FILENAME_FORMATS)), help="模拟帐本的交易文件按年/月/日拆分")
+@click.option('--jobs', 'jobs_list', default="1,2,4", show_default=True,
+              help="逗号分隔的进程数, 1 为 beancount.loader.load_file 串行加载")
+def main(ledger_file, years, commodities, txns_per_day, daily_split, jobs_list):
+    logging.basicConfig(level=logging.ERROR)
+    jobs_list = [1] + [int(jobs) for jobs in jobs_list.split(",") if int(jobs) != 1]
+    if ledger_file:
+        run(ledger_file, jobs_list)
+        return
+
+    synthetic = SyntheticLedger(
+        years, commodities, txns_per_day=txns_per_day, daily_split=daily_split
+    )
+    with tempfile.TemporaryDirectory(prefix="synthetic-ledger-") as ledger_dir:
+        click.echo(f"# {synthetic.key}", err=True)
+        run(synthetic.write(ledger_dir), jobs_list)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+对比不同 --jobs 下重新计算整个净值序列的耗时, 并确认输出和串行计算完全一致
+"""
+import time
+import datetime
+import logging
+
+import click
+
+from networth import compute_networth_series, format_row
+
+
+@click.command()
+@click.option('-s', '--since', default="2019-07-08", show_default=True)
+@click.option('-e', '--end', default=None, help="默认为今天")
+@click.option('--jobs', 'jobs_list', default="1,2,4,8", show_default=True)
+def main(since, end, jobs_list):
+    logging.basicConfig(level=logging.WARNING)
+    since_date = datetime.datetime.strptime(since, "%Y-%m-%d").date()
+    end_date = datetime.datetime.strptime(end, "%Y-%m-%d").date() if end else None
+
+    baseline = None
+    serial_elapsed = None
+    print("jobs,seconds,speedup")
+    for jobs in [int(jobs) for jobs in jobs_list.split(",")]:
+        start = time.time()
+        rows = [format_row(row) for row in compute_networth_series(
+            since_date, end_date, jobs=jobs
+        )]
+        elapsed = time.time() - start
+        if baseline is None:
+            baseline, serial_elapsed = rows, elapsed
+        elif rows != baseline:
+            raise click.ClickException(f"Output of --jobs {jobs} differs from --jobs {jobs_list.split(',')[0]}")
+        print(f"{jobs},{elapsed:.3f},{serial_elapsed / elapsed:.2f}")
+
+
+if __name__ == "__main__":
+    main()
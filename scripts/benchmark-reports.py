@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+用模拟帐本分别测试加载、持仓、净值各阶段的耗时和内存
+
+每个维度都可以是逗号分隔的多个值, 会测试所有组合, 方便观察耗时随规模的增长。
+内存是各阶段结束时进程的最高 RSS(ru_maxrss), 只会增加。每个场景在新启动的进程中测试,
+生成价格缓存也在单独的进程中, 各场景、各加载方式的 RSS 互不影响。
+
+例:
+    ./scripts/benchmark-reports.py --years 1,2,4 --save-baseline local/bench.json
+    ./scripts/benchmark-reports.py --years 1,2,4 --baseline local/bench.json
+
+对比解析价格文本和使用价格缓存(见 ingest-prices.py)的加载耗时和内存:
+    ./scripts/benchmark-reports.py --years 4 --commodities 100 --save-baseline local/text.json
+    ./scripts/benchmark-reports.py --years 4 --commodities 100 --price-cache --baseline local/text.json
+"""
+import sys
+import json
+import time
+import logging
+import datetime
+import itertools
+import multiprocessing
+import resource
+import tempfile
+
+import click
+
+from ledger_loader import get_prices_file, load_ledger
+from networth import compute_networth_series
+from portfolio import get_month_ends, iter_portfolio_matrices
+from price_cache import ingest
+from price_index import PriceIndex
+from synthetic_ledger import SyntheticLedger
+
+
+def get_peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是 KB, macOS 上是字节
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _init_worker():
+    # spawn 启动的进程不继承日志配置
+    logging.basicConfig(level=logging.ERROR)
+
+
+def run_in_subprocess(func, *args):
+    """在新启动(spawn)的解释器中运行, ru_maxrss 不包含本进程和之前测试的内存"""
+    with multiprocessing.get_context("spawn").Pool(1, _init_worker) as pool:
+        return pool.apply(func, args)
+
+
+def ingest_prices(ledger_file):
+    start = time.time()
+    ingest(get_prices_file(ledger_file))
+    return {
+        "seconds": round(time.time() - start, 4),
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+    }
+
+
+def run_stages(ledger_file, synthetic, use_price_cache=False):
+    """
+    Args:
+        use_price_cache: 从价格缓存加载价格, 不解析价格文件。缓存需要先生成
+
+    Returns:
+        {阶段: {"seconds": 耗时, "peak_rss_mb": 阶段结束时的最高 RSS}}
+    """
+    results = {}
+
+    def record(stage, start):
+        results[stage] = {
+            "seconds": round(time.time() - start, 4),
+            "peak_rss_mb": round(get_peak_rss_mb(), 1),
+        }
+
+    start = time.time()
+    ledger = load_ledger(ledger_file, use_cache=False, use_price_cache=use_price_cache)
+    record("load", start)
+    if ledger[1]:
+        raise ValueError(f"Synthetic ledger has errors: {ledger[1][:3]}")
+
+    start = time.time()
+    PriceIndex.build(ledger[0], ledger[2])
+    record("price_index", start)
+
+    start = time.time()
+    list(iter_portfolio_matrices([synthetic.end_date], ledger=ledger))
+    record("portfolio", start)
+
+    start = time.time()
+    month_ends = get_month_ends(synthetic.start_date, synthetic.end_date)
+    list(iter_portfolio_matrices(month_ends, ledger=ledger))
+    record("portfolio_monthly", start)
+
+    start = time.time()
+    compute_networth_series(synthetic.start_date, synthetic.end_date, ledger=ledger)
+    record("networth", start)
+    return results
+
+
+def benchmark(ledger_file, synthetic, use_price_cache=False):
+    """生成价格缓存和加载、报表分别在各自的进程中运行"""
+    results = {}
+    if use_price_cache:
+        results["ingest_prices"] = run_in_subprocess(ingest_prices, ledger_file)
+    try:
+        results.update(run_in_subprocess(run_stages, ledger_file, synthetic, use_price_cache))
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+    return results
+
+
+def parse_list(value, type_):
+    return [type_(item) for item in value.split(",") if item.strip()]
+
+
+@click.command()
+@click.option('--years', default="1", show_default=True, help="历史年数")
+@click.option('--commodities', default="20", show_default=True, help="标的数")
+@click.option('--price-density', default="1.0", show_default=True,
+              help="每个标的在每个工作日有报价的概率")
+@click.option('--txns-per-day', default="5", show_default=True, help="每天的消费交易数")
+@click.option('--baseline', 'baseline_file', default=None, type=click.Path(exists=True),
+              help="和之前保存的结果对比")
+@click.option('--save-baseline', 'save_baseline_file', default=None, type=click.Path(),
+              help="把本次结果保存为 JSON")
+@click.option('--tolerance', default=1.5, show_default=True,
+              help="比 baseline 慢超过这个倍数时报错")
+@click.option('--price-cache', is_flag=True, default=False,
+              help="先把价格写入二进制缓存, 从缓存加载价格")
+def main(years, commodities, price_density, txns_per_day, baseline_file,
+         save_baseline_file, tolerance, price_cache):
+    # 模拟帐本中的预付、押金账户会在每个日期产生警告
+    logging.basicConfig(level=logging.ERROR)
+    baseline = {}
+    if baseline_file:
+        with open(baseline_file) as fhandler:
+            baseline = json.load(fhandler)["results"]
+
+    scenarios = [
+        SyntheticLedger(*params) for params in itertools.product(
+            parse_list(years, float), parse_list(commodities, int),
+            parse_list(price_density, float), parse_list(txns_per_day, int),
+        )
+    ]
+    results = {}
+    regressions = []
+    print("scenario,stage,seconds,peak_rss_mb,baseline_seconds,baseline_peak_rss_mb,ratio")
+    for synthetic in scenarios:
+        with tempfile.TemporaryDirectory(prefix="synthetic-ledger-") as ledger_dir:
+            ledger_file = synthetic.write(ledger_dir)
+            results[synthetic.key] = benchmark(ledger_file, synthetic, price_cache)
+        for stage, stage_result in results[synthetic.key].items():
+            base_result = baseline.get(synthetic.key, {}).get(stage, {})
+            base_seconds = base_result.get("seconds")
+            base_rss = base_result.get("peak_rss_mb")
+            ratio = stage_result["seconds"] / base_seconds if base_seconds else None
+            if ratio is not None and ratio > tolerance:
+                regressions.append(f"{synthetic.key} {stage}: {ratio:.2f}x")
+            print(",".join([
+                f'"{synthetic.key}"', stage, f'{stage_result["seconds"]:.3f}',
+                f'{stage_result["peak_rss_mb"]:.1f}',
+                "" if base_seconds is None else f"{base_seconds:.3f}",
+                "" if base_rss is None else f"{base_rss:.1f}",
+                "" if ratio is None else f"{ratio:.2f}",
+            ]), flush=True)
+
+    if save_baseline_file:
+        with open(save_baseline_file, "w") as fhandler:
+            json.dump({
+                "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                "results": results,
+            }, fhandler, ensure_ascii=False, indent=2)
+    if regressions:
+        raise click.ClickException(
+            f"Slower than baseline by more than {tolerance}x:\n" + "\n".join(regressions)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+通过其他货币换算没有直接报价的汇率
+
+价格构成一张货币图, 每个有报价的 (base, quote) 是一条边(price_map 中已经包含了
+反向的边)。比如只有 BTC/USD、USDT/USD、USD/CNY 的报价时, BTC/CNY 经过 USD 换算,
+BTC/USDT 经过 USD 再取 USDT/USD 的倒数。
+
+某日的路径只使用当日为止已有报价的边, 取跳数最少的路径; 跳数相同时优先经过
+preferred 中靠前的货币(默认为帐本的 operating_currency)。结果按 (base, quote, 日期)
+缓存在 LRU 中, 逐日估值时同一个交易对只需要搜索一次。
+"""
+import functools
+
+from beancount.core.number import ONE
+
+import instrument
+
+
+MAX_HOPS = 4
+CACHE_SIZE = 1 << 16
+
+
+class CurrencyGraph:
+    """
+    Args:
+        price_index: PriceIndex, 提供每条边的 as-of 报价
+        pairs: 图中所有的边 (base, quote)
+        preferred: 跳数相同时优先经过的货币
+    """
+
+    def __init__(self, price_index, pairs, preferred=(), max_hops=MAX_HOPS, cache_size=CACHE_SIZE):
+        self.price_index = price_index
+        self.max_hops = max_hops
+        rank = {currency: idx for idx, currency in enumerate(preferred)}
+        neighbours = {}
+        for base, quote in pairs:
+            neighbours.setdefault(base, []).append(quote)
+        # 按偏好排序后广度优先搜索, 先找到的就是偏好的路径
+        self._neighbours = {
+            base: sorted(quotes, key=lambda quote: (rank.get(quote, len(rank)), quote))
+            for base, quotes in neighbours.items()
+        }
+        self.get_rate = functools.lru_cache(maxsize=cache_size)(self._get_rate)
+
+    def find_path(self, base, quote, date=None):
+        """
+        Returns:
+            [base, ..., quote], 没有路径时返回 None
+        """
+        if base not in self._neighbours or quote not in self._neighbours:
+            return None
+        parents = {base: None}
+        level = [base]
+        for _ in range(self.max_hops):
+            next_level = []
+            for currency in level:
+                for neighbour in self._neighbours[currency]:
+                    if neighbour in parents:
+                        continue
+                    if self.price_index.count((currency, neighbour), date) == 0:
+                        continue
+                    parents[neighbour] = currency
+                    if neighbour == quote:
+                        path = [quote]
+                        while parents[path[-1]] is not None:
+                            path.append(parents[path[-1]])
+                        return path[::-1]
+                    next_level.append(neighbour)
+            if not next_level:
+                break
+            level = next_level
+        return None
+
+    def _get_rate(self, base, quote, date):
+        """
+        Returns:
+            (报价日期, 汇率), 报价日期是路径上最早的报价日期; 没有路径时返回 (None, None)
+        """
+        instrument.count("cross_rate_lookups")
+        path = self.find_path(base, quote, date)
+        if path is None:
+            return None, None
+        price_date = None
+        rate = ONE
+        for hop in zip(path, path[1:]):
+            hop_date, hop_rate = self.price_index.get_direct_price(hop, date)
+            rate *= hop_rate
+            if price_date is None or hop_date < price_date:
+                price_date = hop_date
+        return price_date, rate
@@ -0,0 +1,137 @@
+"""
+按日期增量维护各账户的持仓, 供净值、持仓等需要多个日期持仓的报表使用
+"""
+import datetime
+
+import beancount.core.data
+from beancount.core import account_types
+from beancount.core import flags
+from beancount.core import inventory
+from beancount.ops.holdings import Holding
+from beancount.parser import options
+
+import instrument
+
+
+def convert_holding(holding, price_index, date, target_currency):
+    # 等价于 holdings.convert_to_currency, 但按 date 查询汇率
+    if holding.cost_currency == target_currency:
+        return holding
+    _, rate = price_index.get_price((holding.cost_currency, target_currency), date)
+    if rate is None:
+        return holding._replace(
+            cost_number=None, book_value=None, market_value=None,
+            price_number=None, cost_currency=None,
+        )
+
+    def convert(number):
+        return None if number is None else number * rate
+
+    return holding._replace(
+        cost_number=convert(holding.cost_number),
+        book_value=convert(holding.book_value),
+        market_value=convert(holding.market_value),
+        price_number=convert(holding.price_number),
+        cost_currency=target_currency,
+    )
+
+
+def get_holdings(balances, price_index, date, target_currency=None):
+    """
+    把各账户当前的 Inventory 展开成 Holding 列表, 等价于对 date 当日为止的
+    entries 调用 get_assets_holdings 的第一个返回值
+
+    Args:
+        target_currency: 不为 None 时按 date 的汇率把 Holding 换算成该货币
+    """
+    holdings_list = []
+    for account in sorted(balances):
+        for pos in balances[account].get_positions():
+            if pos.cost is not None:
+                base_quote = (pos.units.currency, pos.cost.currency)
+                price_date, price_number = price_index.get_price(base_quote, date)
+                market_value = None
+                if price_number is not None:
+                    market_value = pos.units.number * price_number
+                holding = Holding(
+                    account, pos.units.number, pos.units.currency,
+                    pos.cost.number, pos.cost.currency,
+                    pos.units.number * pos.cost.number,
+                    market_value, price_number, price_date,
+                )
+            else:
+                holding = Holding(
+                    account, pos.units.number, pos.units.currency,
+                    None, pos.units.currency, pos.units.number,
+                    pos.units.number, None, None,
+                )
+            if target_currency is not None:
+                holding = convert_holding(holding, price_index, date, target_currency)
+            holdings_list.append(holding)
+    return holdings_list
+
+
+def iter_holdings_at_dates(entries, options_map, price_index, dates, target_currency=None,
+                           balances=None, balances_date=None):
+    """
+    按日期顺序只遍历一次 entries, 增量维护各资产/负债账户的 Inventory,
+    对 dates 中的每一天(升序)产出 (日期, holdings_list)。
+
+    结果与每个日期对 entries_to_date 调用 get_assets_holdings 相同, 但复杂度是
+    O(日期数 + entries) 而不是 O(日期数 × entries)。
+
+    Args:
+        balances: 各账户的 Inventory, 会被原地更新
+        balances_date: balances 中已经累计了该日及之前的 entries,
+            为 None 时从第一条 entry 开始累计
+    """
+    acc_types = options.get_account_types(options_map)
+    holding_account_types = {acc_types.assets, acc_types.liabilities}
+
+    if balances is None:
+        balances = {}
+    entries = sorted(entries, key=beancount.core.data.entry_sortkey)
+    idx = 0
+    if balances_date is not None:
+        while idx < len(entries) and entries[idx].date <= balances_date:
+            idx += 1
+
+    for curr_date in dates:
+        # 不能跨过 yield, 否则会把调用方的耗时也算进来
+        with instrument.stage("accumulate"):
+            while idx < len(entries) and entries[idx].date <= curr_date:
+                entry = entries[idx]
+                idx += 1
+                if not isinstance(entry, beancount.core.data.Transaction):
+                    continue
+                # 和 get_final_holdings 一样忽略未实现盈亏的自动生成交易
+                if entry.flag == flags.FLAG_UNREALIZED:
+                    continue
+                for posting in entry.postings:
+                    acc_type = account_types.get_account_type(posting.account)
+                    if acc_type not in holding_account_types:
+                        continue
+                    if posting.account not in balances:
+                        balances[posting.account] = inventory.Inventory()
+                    balances[posting.account].add_position(posting)
+
+        with instrument.stage("holdings"):
+            holdings_list = get_holdings(balances, price_index, curr_date, target_currency)
+        instrument.count("holdings", len(holdings_list))
+        yield curr_date, holdings_list
+
+
+def iter_date_range(since_date, end_date):
+    curr_date = since_date
+    while curr_date <= end_date:
+        yield curr_date
+        curr_date += datetime.timedelta(days=1)
+
+
+def iter_daily_holdings(entries, options_map, price_index, since_date, end_date,
+                        target_currency=None, balances=None, balances_date=None):
+    """逐日产出 since_date 到 end_date 的 (日期, holdings_list), 参数同 iter_holdings_at_dates"""
+    return iter_holdings_at_dates(
+        entries, options_map, price_index, iter_date_range(since_date, end_date),
+        target_currency, balances, balances_date,
+    )
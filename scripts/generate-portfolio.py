@@ -7,241 +7,73 @@
 - 过滤已支出不可退款的，预付款项
 - 过滤不可支配资产
 """
-import os
-import csv
 import datetime
 import logging
-from decimal import Decimal
-import io
 
 import click
-import beancount.loader
-import beancount.core.data
-from beancount.core import getters
-from beancount.ops.holdings import get_assets_holdings
 
+import instrument
+from portfolio import (
+    DEFAULT_HORIZONS, format_row, get_month_ends, get_portfolio_matrix, iter_portfolio_matrices,
+)
+from report_output import FORMATS, open_writer
 
-logger = logging.getLogger()
-
-
-def get_account_map(entries):
-    account_map = {}
-    for entry in entries:
-        if isinstance(entry, beancount.core.data.Open):
-            account_map[entry.account] = entry
-    return account_map
-
-
-def sort_key(row):
-    """
-    输出大体的风险系数以供排序
-    """
-    asset_class = row["一级类别"]
-    asset_subclass = row["二级类别"]
-    ac_list = ["现金", "债券", "债权", "基金", "股票", "股权", "另类资产", "另类"]
-    asc_list = [
-        "本币", "外汇", "债券基金", "可转换债券", "指数基金", '偏债混合基金',
-        "偏股混合基金", "A股", "中国股票", "港股", "香港股票",
-        "美股", "美国股票", "贵金属", "加密货币",
-    ]
-    factor1 = ac_list.index(asset_class)
-    factor2 = asc_list.index(asset_subclass)
-    return (1 + factor1) * 100 + factor2
-
-
-def get_ledger_file():
-    this_file = os.path.abspath(__file__)
-    workdir = os.path.dirname(this_file)
-    while not os.path.exists(os.path.join(workdir, "ledger")):
-        workdir = os.path.dirname(workdir)
-
-    return os.path.join(workdir, "ledger", "main.beancount")
-
-
-def get_portfolio_matrix(asof_date=None):
-    """
-    打印持仓
-    Args:
-        asof_date: 计算该日为止的持仓, 避免未来预付款项影响。
-    """
-    if asof_date is None:
-        asof_date = datetime.date.today()
-
-    (entries, errors, option_map) = beancount.loader.load_file(get_ledger_file())
-    entries = [entry for entry in entries if entry.date <= asof_date]
-
-    assets_holdings, price_map = get_assets_holdings(entries, option_map)
-    account_map = get_account_map(entries)
-    commoditiy_map = getters.get_commodity_directives(entries)
-
-    holding_groups = {}
-    for holding in assets_holdings:
-        if holding.currency == "DAY":
-            continue
 
-        account_obj = account_map[holding.account]
-        if account_obj is None:
-            raise ValueError(f"account is not defined for {holding}")
-        currency_obj = commoditiy_map[holding.currency]
-        if currency_obj is None:
-            raise ValueError(f"commoditiy is not defined for {holding}")
-
-        if bool(int(account_obj.meta.get("sunk", 0))):
-            logger.warning(f"{account_obj.account} is an sunk. Ignored.")
-            continue
-        if bool(int(account_obj.meta.get("nondisposable", 0))):
-            logger.warning(f"{account_obj.account} is nondisposable. Ignored.")
-            continue
-
-        for meta_field in ("name", "asset-class", "asset-subclass"):
-            if meta_field not in currency_obj.meta:
-                raise ValueError(
-                    "Commodity %s has no '%s' in meta"
-                    "" % (holding.currency, meta_field)
-                )
-
-        account_name = account_obj.meta.get("name")
-        if not account_name:
-            raise ValueError("Account name not set for %s" % holding.account)
-        account_nondisposable = bool(int(account_obj.meta.get("nondisposable", 0)))
-        symbol_name = currency_obj.meta["name"]
-        asset_class = currency_obj.meta["asset-class"]
-        asset_subclass = currency_obj.meta["asset-subclass"]
-        symbol = holding.currency
-        currency = holding.cost_currency
-        price = holding.price_number
-        price_date = holding.price_date
-        if price is None:
-            if symbol == currency:
-                price = 1
-                price_date = ''
-        qty = holding.number
-        if currency == "CNY":
-            cny_rate = 1
-        else:
-            cny_rate = price_map[(currency, "CNY")][-1][1]
-
-        holding_dict = {
-            "account": account_name,
-            "nondisposable": account_nondisposable,
-            "symbol": symbol,
-            "symbol_name": symbol_name,
-            "asset_class": asset_class,
-            "asset_subclass": asset_subclass,
-            "quantity": qty,
-            "currency": currency,
-            "price": price,
-            "price_date": price_date,
-            "cny_rate": cny_rate,
-            # optional:
-            # book_value
-            # market_value
-            #
-            # chg_1
-            # chg_5
-            # chg_30
-        }
-
-        hld_prices = price_map.get((holding.currency, holding.cost_currency))
-        if hld_prices is not None and holding.cost_number is not None:
-            holding_dict["book_value"] = holding.book_value
-            holding_dict["market_value"] = holding.market_value
-
-            for dur in (1, 2, 7, 30):
-                if len(hld_prices) < dur:
-                    continue
-
-                base_date = asof_date - datetime.timedelta(days=dur)
-                latest_price = hld_prices[-1][1]
-                base_pxs = [(dt, px) for dt, px in hld_prices if dt <= base_date]
-                if base_pxs:
-                    base_price = base_pxs[-1][-1]  # O(N)!
-                    holding_dict[f"chg_{dur}"] = latest_price / base_price - 1
-                else:
-                    holding_dict[f"chg_{dur}"] = 'n/a'
-
-        group_key = (symbol, account_nondisposable)
-        holding_groups.setdefault(group_key, []).append(holding_dict)
-
-    rows = []
-    cum_networth = 0
-    for (symbol, account_nondisposable), holdings in holding_groups.items():
-        qty_by_account = {}
-        total_book_value = Decimal(0)
-        total_market_value = Decimal(0)
-        for holding in holdings:
-            if holding["account"] not in qty_by_account:
-                qty_by_account[holding["account"]] = 0
-            qty_by_account[holding["account"]] += holding["quantity"]
-            if "book_value" in holding:
-                total_book_value += holding["book_value"]
-                total_market_value += holding["market_value"]
-        if total_book_value == 0:
-            pnlr = "n/a"
-        else:
-            pnlr = "%.4f%%" % ((total_market_value / total_book_value - 1) * 100)
-
-        total_qty = sum(qty_by_account.values())
-        hld_px = holding["price"]
-        if hld_px is None:
-            raise ValueError(f"price not found for {holding}")
-
-        networth = holding["cny_rate"] * hld_px * total_qty
-        cum_networth += networth
-        row = {
-            "一级类别": holding["asset_class"],
-            "二级类别": holding["asset_subclass"],
-            "标的": holding["symbol_name"],
-            "代号": symbol,
-            "持仓量": "%.3f" % total_qty,
-            "市场价格": "%.4f" % holding["price"],
-            "报价日期": holding["price_date"],
-            "市场价值": int(round(holding["price"] * total_qty)),
-            "货币": holding["currency"],
-            "人民币价值": "%.2f" % networth,
-            "持仓盈亏%": pnlr,
-        }
-        for optional_col, col_name in [
-                ("chg_1", "1日%"),
-                ("chg_2", "2日%"),
-                ("chg_7", "7日%"),
-                ("chg_30", "30日%")
-            ]:
-            if optional_col not in holding or holding[optional_col] == 'n/a':
-                row[col_name] = "n/a"
-            else:
-                row[col_name] = "%.2f%%" % (holding[optional_col] * 100)
-        rows.append(row)
-
-    rows.sort(key=sort_key)
-    for row in rows:
-        pct = Decimal(row["人民币价值"]) / cum_networth
-        row.update({
-            "占比": "%.2f%%" % (100 * pct)
-        })
-    return rows, cum_networth
+logger = logging.getLogger()
 
 
-def print_portfolio_csv(rows):
-    fhandler = io.StringIO()
-    writer = csv.DictWriter(fhandler, fieldnames=rows[0].keys())
-    writer.writeheader()
-    writer.writerows(rows)
-    print(fhandler.getvalue().strip())
+def parse_date(date_str):
+    return datetime.datetime.strptime(date_str.strip(), "%Y-%m-%d").date()
 
 
 @click.command()
 @click.option('-d', '--date', default=None)
-def main(date):
+@click.option(
+    '--horizons', default=",".join(map(str, DEFAULT_HORIZONS)),
+    help="逗号分隔的涨跌幅天数, 如 1,5,30,90,365",
+)
+@click.option('--dates', default=None, help="逗号分隔的多个日期, 输出按日期排列的长格式CSV")
+@click.option('--monthly-since', default=None, help="该日所在月份起每个月末的持仓, 输出长格式CSV")
+@click.option('-f', '--format', 'fmt', default="csv", show_default=True, type=click.Choice(FORMATS),
+              help="csv 输出格式化的字符串, 其他格式输出数字和日期")
+@click.option('-o', '--output', default=None, type=click.Path(),
+              help="输出文件, csv 和 jsonl 默认输出到 stdout")
+@click.option('--profile', default=None,
+              help="逗号分隔的 timing,cprofile,tracemalloc, 默认读取环境变量 BEAN_PROFILE")
+@click.option('--profile-trace', default=None, type=click.Path(),
+              help="把各阶段的调用写成 Chrome trace 格式的 JSON")
+def main(date, horizons, dates, monthly_since, fmt, output, profile, profile_trace):
     logging.basicConfig(level=logging.INFO)
+    instrument.enable(profile, profile_trace)
+    if fmt in ("sqlite", "parquet") and output is None:
+        raise click.UsageError(f"--output is required for {fmt}")
     if date is None:
         asof_date = datetime.date.today()
     else:
-        asof_date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
-
-    rows, cum_networth = get_portfolio_matrix(asof_date)
-    logger.info("As of %s, disposable networth=%d CNY", asof_date, cum_networth)
-    print_portfolio_csv(rows)
+        asof_date = parse_date(date)
+
+    horizons = [int(dur) for dur in horizons.split(",") if dur.strip()]
+    writer = open_writer(
+        fmt, output, formatter=format_row if fmt == "csv" else None, table="portfolio"
+    )
+    if dates is None and monthly_since is None:
+        rows, cum_networth = get_portfolio_matrix(asof_date, horizons)
+        logger.info("As of %s, disposable networth=%d CNY", asof_date, cum_networth)
+        with writer:
+            writer.write_rows(rows)
+        return
+
+    snapshot_dates = set()
+    if dates:
+        snapshot_dates.update(parse_date(date_str) for date_str in dates.split(",") if date_str.strip())
+    if monthly_since:
+        snapshot_dates.update(get_month_ends(parse_date(monthly_since), asof_date))
+
+    # 每个日期的持仓算完后直接写出, 不需要把所有日期的持仓都保存在内存中
+    with writer:
+        for snapshot_date, rows, cum_networth in iter_portfolio_matrices(snapshot_dates, horizons):
+            logger.info("As of %s, disposable networth=%d CNY", snapshot_date, cum_networth)
+            writer.write_rows({"日期": snapshot_date, **row} for row in rows)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+把 ledger/prices.beancount 量化后写入二进制缓存 ledger/.prices.beancount.bin
+
+之后各报表脚本加载帐本时不再解析价格文件, 直接从缓存中读取价格。价格文件被修改后
+缓存自动失效(update-prices.py 会在写入价格后重新生成已有的缓存)。
+
+价格默认保留 12 位有效数字, 可以在 commodity 的 price-precision 中指定小数位数:
+
+    2019-01-01 commodity CN_510300
+      price-precision: 4
+"""
+import os
+import logging
+
+import click
+
+import instrument
+from ledger_loader import get_ledger_file, get_prices_file, load_ledger
+from price_cache import get_cache_file, get_precisions, ingest
+
+
+@click.command()
+@click.option('--profile', default=None,
+              help="逗号分隔的 timing,cprofile,tracemalloc, 默认读取环境变量 BEAN_PROFILE")
+@click.option('--profile-trace', default=None, type=click.Path(),
+              help="把各阶段的调用写成 Chrome trace 格式的 JSON")
+def main(profile, profile_trace):
+    logging.basicConfig(level=logging.INFO)
+    instrument.enable(profile, profile_trace)
+    entries, _, _ = load_ledger()
+    prices_file = get_prices_file(get_ledger_file())
+    num_prices, num_pairs, num_changed = ingest(prices_file, get_precisions(entries))
+    cache_file = get_cache_file(prices_file)
+    click.echo(
+        f"{num_prices} prices of {num_pairs} pairs, {num_changed} quantized, "
+        f"{os.path.getsize(prices_file)} -> {os.path.getsize(cache_file)} bytes"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+各脚本共用的分阶段计时和性能分析
+
+默认关闭, stage/count 几乎没有开销。通过脚本的 --profile 参数或环境变量开启:
+
+    BEAN_PROFILE=timing ./scripts/generate-portfolio.py
+    BEAN_PROFILE=timing,cprofile,tracemalloc BEAN_PROFILE_TRACE=local/trace.json make today
+
+- timing: 退出时输出每个阶段的调用次数、总耗时、平均和最大耗时, 以及计数器
+- cprofile: 同时用 cProfile 分析主线程, 退出时输出累计耗时最多的函数
+- tracemalloc: 同时记录每个阶段运行期间 Python 内存的峰值(会明显变慢)。进入阶段时重置
+  峰值, 退出时把阶段内的峰值合并回外层阶段。tracemalloc 的峰值是进程级的, 多个线程中
+  同时运行的阶段会互相重置, 它们的峰值只能作参考
+- 指定 trace 文件时把每次调用写成 Chrome trace 格式的 JSON, 可以用
+  chrome://tracing 或 https://ui.perfetto.dev 打开
+"""
+import os
+import io
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+import functools
+import contextlib
+import tracemalloc
+
+
+logger = logging.getLogger(__name__)
+
+ENV_MODES = "BEAN_PROFILE"
+ENV_TRACE = "BEAN_PROFILE_TRACE"
+KNOWN_MODES = {"timing", "cprofile", "tracemalloc"}
+CPROFILE_TOP_N = 30
+
+
+class _Stats:
+    __slots__ = ("calls", "total", "max", "peak_mem")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.peak_mem = 0
+
+
+class Recorder:
+    """
+    Attributes:
+        stats: {阶段名: _Stats}, 嵌套的阶段名用 "/" 连接
+        counters: {计数器名: 值}
+        events: Chrome trace 的事件, 只在指定了 trace 文件时记录
+    """
+
+    def __init__(self, modes, trace_file=None):
+        self.modes = modes
+        self.trace_file = trace_file
+        self.stats = {}
+        self.counters = {}
+        self.events = []
+        self.profiler = None
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            # 和 stack 一一对应, 各阶段在最近一次重置峰值之前的内存峰值
+            self._local.peaks = []
+        return self._local.stack
+
+    def _enter_peak(self):
+        """记下外层阶段到目前为止的峰值, 再重置峰值"""
+        peaks = self._local.peaks
+        if peaks:
+            peaks[-1] = max(peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        peaks.append(0)
+
+    def _exit_peak(self):
+        """Returns: 阶段运行期间的峰值, 同时合并到外层阶段"""
+        peaks = self._local.peaks
+        peak_mem = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if peaks:
+            peaks[-1] = max(peaks[-1], peak_mem)
+        return peak_mem
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stack = self._get_stack()
+        full_name = "/".join(stack + [name])
+        stack.append(name)
+        trace_mem = "tracemalloc" in self.modes
+        if trace_mem:
+            self._enter_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            peak_mem = self._exit_peak() if trace_mem else 0
+            with self._lock:
+                stat = self.stats.get(full_name)
+                if stat is None:
+                    stat = self.stats[full_name] = _Stats()
+                stat.calls += 1
+                stat.total += elapsed
+                stat.max = max(stat.max, elapsed)
+                stat.peak_mem = max(stat.peak_mem, peak_mem)
+                if self.trace_file:
+                    self.events.append({
+                        "name": name, "cat": full_name, "ph": "X",
+                        "ts": 1e6 * (start - self.start_time), "dur": 1e6 * elapsed,
+                        "pid": os.getpid(), "tid": threading.get_ident(),
+                    })
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def log_summary(self):
+        wall_time = time.perf_counter() - self.start_time
+        has_mem = "tracemalloc" in self.modes
+        lines = ["%-48s %8s %10s %10s %10s%s" % (
+            "stage", "calls", "total(s)", "mean(ms)", "max(ms)", "  peak(MB)" if has_mem else "",
+        )]
+        for name, stat in sorted(self.stats.items()):
+            lines.append("%-48s %8d %10.3f %10.2f %10.2f%s" % (
+                name, stat.calls, stat.total, 1000 * stat.total / stat.calls, 1000 * stat.max,
+                "  %8.1f" % (stat.peak_mem / 1024 / 1024) if has_mem else "",
+            ))
+        for name, value in sorted(self.counters.items()):
+            lines.append("%-48s %8d" % ("#" + name, value))
+        logger.info("Profile summary (wall %.3fs):\n%s", wall_time, "\n".join(lines))
+
+    def write_trace(self):
+        trace = {
+            "traceEvents": self.events,
+            "otherData": {
+                "argv": sys.argv,
+                "counters": self.counters,
+                "stages": {
+                    name: {
+                        "calls": stat.calls, "total": stat.total,
+                        "max": stat.max, "peak_mem": stat.peak_mem,
+                    }
+                    for name, stat in self.stats.items()
+                },
+            },
+        }
+        with open(self.trace_file, "w") as fhandler:
+            json.dump(trace, fhandler)
+        logger.info("Wrote profile trace to %s", self.trace_file)
+
+    def finish(self):
+        if self.profiler is not None:
+            import pstats
+
+            self.profiler.disable()
+            fhandler = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=fhandler)
+            stats.sort_stats("cumulative").print_stats(CPROFILE_TOP_N)
+            logger.info("cProfile:\n%s", fhandler.getvalue())
+            if self.trace_file:
+                stats.dump_stats(self.trace_file + ".prof")
+        self.log_summary()
+        if self.trace_file:
+            self.write_trace()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+# 当前的 Recorder, 没有开启时为 None
+_recorder = None
+_null_context = contextlib.nullcontext()
+
+
+def parse_modes(modes):
+    modes = {mode.strip() for mode in (modes or "").split(",") if mode.strip()}
+    if modes & {"1", "true", "yes"}:
+        modes = (modes - {"1", "true", "yes"}) | {"timing"}
+    unknown = modes - KNOWN_MODES
+    if unknown:
+        logger.warning("Ignored unknown profile modes %s, choose from %s",
+                       sorted(unknown), sorted(KNOWN_MODES))
+        modes -= unknown
+    # cprofile 和 tracemalloc 也会输出分阶段计时
+    return modes | {"timing"} if modes else modes
+
+
+def enable(modes=None, trace_file=None):
+    """
+    开启计时, 进程退出时输出汇总。modes 和 trace_file 为 None 时读取环境变量
+    BEAN_PROFILE 和 BEAN_PROFILE_TRACE, 都没有设置时不开启
+
+    Args:
+        modes: 逗号分隔的 timing、cprofile、tracemalloc
+    """
+    global _recorder
+    modes = parse_modes(modes if modes is not None else os.environ.get(ENV_MODES))
+    trace_file = trace_file or os.environ.get(ENV_TRACE)
+    if trace_file and not modes:
+        modes = {"timing"}
+    if not modes or _recorder is not None:
+        return _recorder
+
+    _recorder = Recorder(modes, trace_file)
+    if "tracemalloc" in modes:
+        tracemalloc.start()
+    if "cprofile" in modes:
+        # cProfile 和 pstats 导入比较慢, 只在需要时导入
+        import cProfile
+
+        _recorder.profiler = cProfile.Profile()
+        _recorder.profiler.enable()
+    atexit.register(_recorder.finish)
+    return _recorder
+
+
+def is_enabled():
+    return _recorder is not None
+
+
+def stage(name):
+    """
+    记录一个阶段的耗时, 用法:
+
+        with instrument.stage("load"):
+            ...
+    """
+    if _recorder is None:
+        return _null_context
+    return _recorder.stage(name)
+
+
+def timed(name):
+    """把整个函数作为一个阶段的装饰器"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kw):
+            if _recorder is None:
+                return func(*args, **kw)
+            with _recorder.stage(name):
+                return func(*args, **kw)
+        return wrapped
+    return decorator
+
+
+def count(name, value=1):
+    if _recorder is not None:
+        _recorder.count(name, value)
@@ -0,0 +1,137 @@
+"""
+账户和 commodity 的 meta 属性表
+
+各报表在逐日、逐个持仓的循环中只需要 sunk、nondisposable、asset-class 等少数属性。
+这里在加载帐本后一次性解析好, 报表会读到的 meta 缺失或格式错误时在构建时一起报错,
+而不是在循环深处才抛出异常。
+"""
+from beancount.core import account_types
+from beancount.core import data
+from beancount.parser import options
+
+
+# 报表循环中跳过的不计价单位(比如时间记帐的 DAY), 不需要 Commodity 指令
+NON_PRICED_CURRENCIES = frozenset(["DAY"])
+# commodity 的 meta -> CommodityAttrs 的属性
+COMMODITY_META_FIELDS = ("name", "asset-class", "asset-subclass")
+
+
+def _parse_flag(meta, key):
+    return bool(int(meta.get(key, 0)))
+
+
+class AccountAttrs:
+    __slots__ = ("account", "name", "sunk", "nondisposable")
+
+    def __init__(self, account, name, sunk, nondisposable):
+        self.account = account
+        # 用于展示的名称
+        self.name = name
+        # 预付但大部分情况下不能兑现的沉没资产，比如预付的未来房租
+        self.sunk = sunk
+        # 不可支配，比如房租押金
+        self.nondisposable = nondisposable
+
+
+class CommodityAttrs:
+    __slots__ = ("currency", "name", "asset_class", "asset_subclass")
+
+    def __init__(self, currency, name, asset_class, asset_subclass):
+        self.currency = currency
+        self.name = name
+        self.asset_class = asset_class
+        self.asset_subclass = asset_subclass
+
+
+class AttributeTable:
+    """
+    Attributes:
+        accounts: {账户: AccountAttrs}
+        commodities: {commodity: CommodityAttrs}
+    """
+    __slots__ = ("accounts", "commodities")
+
+    def __init__(self, accounts, commodities):
+        self.accounts = accounts
+        self.commodities = commodities
+
+    @classmethod
+    def build(cls, entries, options_map, account_fields=(), commodity_fields=()):
+        """
+        从 Open 和 Commodity 指令构建属性表, 没有设置的 meta 为 None。
+
+        只检查报表循环会读到的属性: 资产、负债账户中持有过的 commodity(不计价的单位和
+        sunk/nondisposable 账户中的除外)要有 Commodity 指令和 commodity_fields 中的 meta,
+        持有它们的账户要有 account_fields 中的 meta, sunk/nondisposable 是 0 或 1。
+
+        Args:
+            account_fields: 报表需要的账户 meta, 比如 ("name",)
+            commodity_fields: 报表需要的 commodity meta, COMMODITY_META_FIELDS 的子集
+
+        Raises:
+            ValueError: 列出所有不满足的项
+        """
+        acc_types = options.get_account_types(options_map)
+        holding_account_types = {acc_types.assets, acc_types.liabilities}
+
+        errors = []
+        accounts = {}
+        commodities = {}
+        account_metas = {}
+        commodity_metas = {}
+        invalid_flags = {}
+        # (账户, commodity) -> 第一次出现的交易日期
+        held = {}
+        for entry in entries:
+            if isinstance(entry, data.Open):
+                account_metas[entry.account] = entry.meta
+                try:
+                    sunk = _parse_flag(entry.meta, "sunk")
+                    nondisposable = _parse_flag(entry.meta, "nondisposable")
+                except ValueError as exc:
+                    invalid_flags[entry.account] = exc
+                    sunk = nondisposable = False
+                accounts[entry.account] = AccountAttrs(
+                    entry.account, entry.meta.get("name"), sunk, nondisposable
+                )
+            elif isinstance(entry, data.Commodity):
+                commodity_metas[entry.currency] = entry.meta
+                commodities[entry.currency] = CommodityAttrs(
+                    entry.currency, *(entry.meta.get(field) for field in COMMODITY_META_FIELDS)
+                )
+            elif isinstance(entry, data.Transaction):
+                for posting in entry.postings:
+                    if posting.units.currency in NON_PRICED_CURRENCIES:
+                        continue
+                    if account_types.get_account_type(posting.account) in holding_account_types:
+                        held.setdefault((posting.account, posting.units.currency), entry.date)
+
+        # 报表读 account_fields 的账户和读 commodity_fields 的 commodity
+        read_accounts = set()
+        read_currencies = {}
+        for (account, currency), date in sorted(held.items()):
+            acc = accounts.get(account)
+            if account in invalid_flags:
+                read_accounts.add(account)
+            elif acc is not None and not acc.sunk and not acc.nondisposable:
+                read_accounts.add(account)
+                read_currencies.setdefault(currency, (account, date))
+
+        for account in sorted(read_accounts):
+            if account in invalid_flags:
+                errors.append(f"Invalid sunk/nondisposable of {account}: {invalid_flags[account]}")
+                continue
+            missing = [field for field in account_fields if not account_metas[account].get(field)]
+            if missing:
+                errors.append(f"Account {account} has no {missing} in meta")
+        for currency, (account, date) in sorted(read_currencies.items()):
+            meta = commodity_metas.get(currency)
+            if meta is None:
+                errors.append(f"Commodity {currency} held in {account} on {date} is not defined")
+                continue
+            missing = [field for field in commodity_fields if field not in meta]
+            if missing:
+                errors.append(f"Commodity {currency} has no {missing} in meta")
+        if errors:
+            raise ValueError("Invalid ledger metadata:\n" + "\n".join(errors))
+        return cls(accounts, commodities)
@@ -0,0 +1,370 @@
+"""
+各报表脚本共用的帐本加载逻辑
+
+解析和 booking 后的 (entries, errors, options_map) 会 pickle 到 main.beancount
+同目录下的缓存文件中。缓存键是所有 include 文件的 mtime 和内容哈希:
+mtime 没变直接命中; mtime 变了但内容哈希相同(比如 touch)也算命中。
+
+常驻进程(比如 report-server.py)用 IncrementalLoader, 在内存中保留每个文件的
+解析结果, 重新加载时只解析有变化的文件。include 的文件很多时可以用 jobs 或环境变量
+BEAN_PARSE_JOBS 在多个进程中并行解析, booking 和插件仍然在合并后的 entries 上运行一次。
+
+prices.beancount 有最新的二进制缓存(见 price_cache.py)时不解析价格文件,
+options_map["price_cache"] 为缓存文件的路径, 价格由 price_cache.build_price_map 读取。
+"""
+import os
+import copy
+import glob
+import time
+import pickle
+import hashlib
+import logging
+import multiprocessing
+
+import beancount
+import beancount.loader
+from beancount.core import data
+from beancount.ops import validation
+from beancount.parser import booking
+from beancount.parser import parser
+
+import instrument
+import price_cache
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILENAME = ".{filename}.ledgercache"
+PRICE_CACHED_FILENAME = ".{filename}.pricecached.ledgercache"
+PRICES_FILENAME = "prices.beancount"
+ENV_PARSE_JOBS = "BEAN_PARSE_JOBS"
+# 帐本格式或 beancount 升级后旧缓存不可用
+CACHE_VERSION = (1, beancount.__version__)
+
+
+def get_ledger_file():
+    this_file = os.path.abspath(__file__)
+    workdir = os.path.dirname(this_file)
+    while not os.path.exists(os.path.join(workdir, "ledger")):
+        workdir = os.path.dirname(workdir)
+
+    return os.path.join(workdir, "ledger", "main.beancount")
+
+
+def get_cache_file(ledger_file, price_cached=False):
+    dirname, basename = os.path.split(ledger_file)
+    filename = PRICE_CACHED_FILENAME if price_cached else CACHE_FILENAME
+    return os.path.join(dirname, filename.format(filename=basename))
+
+
+def get_prices_file(ledger_file):
+    return os.path.join(os.path.dirname(ledger_file), PRICES_FILENAME)
+
+
+def _file_digest(path):
+    with open(path, "rb") as fhandler:
+        return hashlib.sha256(fhandler.read()).hexdigest()
+
+
+def _get_file_keys(paths):
+    return {
+        path: (os.stat(path).st_mtime_ns, _file_digest(path))
+        for path in paths
+    }
+
+
+def _is_cache_valid(file_keys):
+    for path, (mtime_ns, digest) in file_keys.items():
+        try:
+            curr_mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if curr_mtime_ns != mtime_ns and _file_digest(path) != digest:
+            return False
+    return True
+
+
+def _read_cache(cache_file, ledger_file):
+    try:
+        with open(cache_file, "rb") as fhandler:
+            cached = pickle.load(fhandler)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        # 缓存损坏或是旧版本 pickle, 直接重新解析
+        logger.warning("Ignored broken ledger cache %s: %s", cache_file, exc)
+        return None
+
+    if cached.get("version") != CACHE_VERSION:
+        return None
+    # 帐本目录被复制或移动后, 缓存中的 include 路径仍然指向原来的文件
+    if cached.get("ledger_file") != ledger_file:
+        return None
+    if not _is_cache_valid(cached["files"]):
+        return None
+    return cached["result"]
+
+
+def _write_cache(cache_file, ledger_file, result):
+    _, _, options_map = result
+    cached = {
+        "version": CACHE_VERSION,
+        "ledger_file": ledger_file,
+        "files": _get_file_keys(options_map["include"]),
+        "result": result,
+    }
+    # 多个工作进程可能同时写同一个缓存
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as fhandler:
+        pickle.dump(cached, fhandler, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+
+
+def get_parse_jobs():
+    """环境变量 BEAN_PARSE_JOBS 指定的并行解析进程数, 默认为 1"""
+    return int(os.environ.get(ENV_PARSE_JOBS) or 1)
+
+
+def _load_file(ledger_file, prices_cache, jobs):
+    """没有价格缓存且 jobs 为 1 时和 beancount.loader.load_file 相同"""
+    if prices_cache is None and jobs <= 1:
+        return beancount.loader.load_file(ledger_file)
+
+    exclude = [] if prices_cache is None else [get_prices_file(ledger_file)]
+    loader = IncrementalLoader(ledger_file, exclude=exclude, jobs=jobs)
+    loader.reload()
+    entries, errors, options_map = loader.result
+    if loader.excluded:
+        options_map["price_cache"] = prices_cache.path
+    return entries, errors, options_map
+
+
+def load_ledger(ledger_file=None, use_cache=True, use_price_cache=True, jobs=None):
+    """
+    加载帐本, 优先使用磁盘缓存
+
+    Args:
+        use_price_cache: 价格缓存是最新的时不解析 prices.beancount
+        jobs: 没有命中缓存时并行解析 include 文件的进程数, 默认读取环境变量 BEAN_PARSE_JOBS
+
+    Returns:
+        和 beancount.loader.load_file 一样的 (entries, errors, options_map)
+    """
+    if ledger_file is None:
+        ledger_file = get_ledger_file()
+    ledger_file = os.path.abspath(ledger_file)
+    if jobs is None:
+        jobs = get_parse_jobs()
+
+    start = time.time()
+    with instrument.stage("load_ledger"):
+        prices_cache = None
+        if use_price_cache:
+            with instrument.stage("check_price_cache"):
+                prices_cache = price_cache.open_fresh_cache(get_prices_file(ledger_file))
+            if prices_cache is not None:
+                prices_cache.close()
+        cache_file = get_cache_file(ledger_file, prices_cache is not None)
+
+        with instrument.stage("read_cache"):
+            result = _read_cache(cache_file, ledger_file) if use_cache else None
+        cache_hit = result is not None
+        instrument.count("ledger_cache_hit" if cache_hit else "ledger_cache_miss")
+        if not cache_hit:
+            with instrument.stage("load_file"):
+                result = _load_file(ledger_file, prices_cache, jobs)
+            if use_cache:
+                with instrument.stage("write_cache"):
+                    _write_cache(cache_file, ledger_file, result)
+
+    logger.info(
+        "Loaded %s in %.3fs (cache %s%s)",
+        ledger_file, time.time() - start, "hit" if cache_hit else "miss",
+        ", prices from " + prices_cache.path if prices_cache is not None else "",
+    )
+    return result
+
+
+class IncrementalLoader:
+    """
+    在内存中保留帐本及每个文件的解析结果
+
+    reload 时重新展开 include(包括 glob, 所以能发现新增的文件), 只重新解析
+    mtime 或大小有变化的文件, 再对全部 entries 重新 booking、运行插件和校验。
+    booking 和插件依赖全部 entries, 没法只对变化的文件做。
+
+    Args:
+        exclude: 不解析的文件, 被 include 到时只记录到 excluded 中
+        jobs: 大于 1 时用多个进程并行解析同一层 include 的文件
+
+    Attributes:
+        result: 最近一次加载的 (entries, errors, options_map)
+        generation: 每次帐本有变化并重新加载后加 1
+        excluded: 最近一次加载时被 include 到但没有解析的文件
+    """
+
+    def __init__(self, ledger_file=None, exclude=(), jobs=1):
+        if ledger_file is None:
+            ledger_file = get_ledger_file()
+        self.ledger_file = os.path.abspath(ledger_file)
+        self.exclude = {os.path.normpath(os.path.abspath(path)) for path in exclude}
+        self.jobs = jobs
+        self.result = None
+        self.generation = 0
+        self.excluded = set()
+        # {文件名: ((mtime_ns, size), parser.parse_file 的结果)}
+        self._parsed = {}
+
+    def _check_parsed(self, filename):
+        stat = os.stat(filename)
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._parsed.get(filename)
+        return stat_key, cached is not None and cached[0] == stat_key
+
+    def _parse_files(self, filenames, pool_holder):
+        """
+        文件数大于 1 且 jobs 大于 1 时在进程池中解析有变化的文件
+
+        Args:
+            pool_holder: [进程池], 第一次需要时才创建, 同一次 reload 中复用
+
+        Returns:
+            [(parse_file 的结果, 是否重新解析了)], 和 filenames 的顺序相同
+        """
+        stat_keys = {}
+        to_parse = []
+        for filename in filenames:
+            stat_key, is_cached = self._check_parsed(filename)
+            if not is_cached:
+                stat_keys[filename] = stat_key
+                to_parse.append(filename)
+
+        if self.jobs > 1 and len(to_parse) > 1:
+            if not pool_holder:
+                pool_holder.append(multiprocessing.Pool(self.jobs))
+            with instrument.stage("parse_files_parallel"):
+                chunksize = max(1, len(to_parse) // (self.jobs * 4))
+                parsed_list = pool_holder[0].map(parser.parse_file, to_parse, chunksize)
+            instrument.count("parsed_files_parallel", len(to_parse))
+        else:
+            parsed_list = []
+            for filename in to_parse:
+                with instrument.stage("parse_file"):
+                    parsed_list.append(parser.parse_file(filename))
+        for filename, parsed in zip(to_parse, parsed_list):
+            self._parsed[filename] = (stat_keys[filename], parsed)
+        return [(self._parsed[filename][1], filename in stat_keys) for filename in filenames]
+
+    def _parse_recursive(self):
+        """
+        和 beancount.loader._parse_recursive 相同, 但复用没有变化的文件的解析结果。
+
+        串行版本按先进先出的顺序处理 include 的文件, 等价于按 include 的层级逐层处理,
+        所以每一层的文件可以一起并行解析, 再按原来的顺序合并, 结果和串行版本一致。
+
+        Returns:
+            (entries, parse_errors, options_map, 重新解析的文件数)
+        """
+        entries, parse_errors = [], []
+        options_map = None
+        num_parsed = 0
+        filenames_seen = set()
+        excluded = set()
+        pool_holder = []
+        level = [self.ledger_file]
+        try:
+            while level:
+                # (文件名, 错误), 错误为 None 的需要解析
+                sources = []
+                for filename in level:
+                    filename = os.path.normpath(filename)
+                    if filename in filenames_seen:
+                        sources.append((filename, beancount.loader.LoadError(
+                            data.new_metadata("<load>", 0),
+                            'Duplicate filename parsed: "{}"'.format(filename), None,
+                        )))
+                    elif not os.path.exists(filename):
+                        sources.append((filename, beancount.loader.LoadError(
+                            data.new_metadata("<load>", 0),
+                            'File "{}" does not exist'.format(filename), None,
+                        )))
+                    elif filename in self.exclude:
+                        excluded.add(filename)
+                    else:
+                        filenames_seen.add(filename)
+                        sources.append((filename, None))
+                parsed_list = iter(self._parse_files(
+                    [filename for filename, error in sources if error is None], pool_holder
+                ))
+
+                level = []
+                for filename, error in sources:
+                    if error is not None:
+                        parse_errors.append(error)
+                        continue
+                    (src_entries, src_errors, src_options_map), is_parsed = next(parsed_list)
+                    num_parsed += is_parsed
+
+                    entries.extend(src_entries)
+                    parse_errors.extend(src_errors)
+                    if options_map is None:
+                        # 后面会修改 options_map, 不能改到缓存的解析结果
+                        options_map = copy.deepcopy(src_options_map)
+                    else:
+                        beancount.loader.aggregate_options_map(options_map, src_options_map)
+
+                    cwd = os.path.dirname(filename)
+                    for include_filename in src_options_map["include"]:
+                        matched_filenames = glob.glob(
+                            os.path.join(cwd, include_filename), recursive=True
+                        )
+                        if not matched_filenames:
+                            parse_errors.append(beancount.loader.LoadError(
+                                data.new_metadata("<load>", 0),
+                                'File glob "{}" does not match any files'.format(include_filename),
+                                None,
+                            ))
+                        level.extend(sorted(matched_filenames))
+        finally:
+            if pool_holder:
+                pool_holder[0].close()
+                pool_holder[0].join()
+
+        # 不再被 include 的文件
+        for filename in set(self._parsed) - filenames_seen:
+            del self._parsed[filename]
+            num_parsed += 1
+        # 被排除的文件有变化时也需要重新加载
+        if excluded != self.excluded and self.result is not None:
+            num_parsed += 1
+        self.excluded = excluded
+        options_map["include"] = sorted(filenames_seen)
+        return entries, parse_errors, options_map, num_parsed
+
+    @instrument.timed("reload_ledger")
+    def reload(self):
+        """
+        Returns:
+            帐本有变化并重新加载了时返回 True
+        """
+        start = time.time()
+        entries, parse_errors, options_map, num_parsed = self._parse_recursive()
+        if self.result is not None and num_parsed == 0:
+            return False
+
+        entries.sort(key=data.entry_sortkey)
+        entries, balance_errors = booking.book(entries, options_map)
+        parse_errors.extend(balance_errors)
+        entries, errors = beancount.loader.run_transformations(
+            entries, parse_errors, options_map, None
+        )
+        errors.extend(validation.validate(entries, options_map, None, None))
+        options_map["input_hash"] = beancount.loader.compute_input_hash(options_map["include"])
+
+        self.result = (entries, errors, options_map)
+        self.generation += 1
+        logger.info(
+            "Reloaded %s in %.3fs, parsed %d of %d files",
+            self.ledger_file, time.time() - start, num_parsed, len(options_map["include"]),
+        )
+        return True
@@ -0,0 +1,409 @@
+"""
+净值序列的计算, 供 generate-networth-report.py 等脚本使用
+
+逐日汇总持仓市值和非投资收支(compute_daily_values), 再用 NetworthSeries
+算出投资盈亏、净值等, 输出前用 format_row 格式化。
+"""
+import copy
+import datetime
+import logging
+import collections
+import decimal
+import multiprocessing
+
+import numpy as np
+import beancount.core.data
+
+import instrument
+from daily_holdings import iter_daily_holdings
+from ledger_attrs import NON_PRICED_CURRENCIES, AttributeTable
+from ledger_loader import load_ledger
+from networth_checkpoint import (
+    NetworthCheckpoint, get_checkpoint_file, hash_entries_by_date, is_snapshot_date,
+)
+from price_cache import get_price_digests
+from price_index import PriceIndex
+from networth_series import NetworthSeries, check_equivalence, compute_decimal_series
+
+
+logger = logging.getLogger(__name__)
+
+KNOWN_ASSET_CLASSES = {
+    "股权",
+    "另类",
+    "债权",
+    "现金",
+}
+EXPENSES_PREFIX = "Expenses:"
+EXPENSES_TRADE_PREFIX = "Expenses:Trade:"
+EXPENSES_PREPAYMENTS_PREFIX = "Assets:PrePayments"
+
+
+def build_non_trade_postings_index(entries):
+    """
+    按日期索引交易中的非投资收入/支出 posting
+
+    Returns:
+        {日期: [(是否非投资支出, units), ...]}, 不含时间记帐(DAY)的交易
+    """
+    index = collections.defaultdict(list)
+    for entry in entries:
+        if not isinstance(entry, beancount.core.data.Transaction):
+            continue
+        is_time_tx = any((posting.units.currency == "DAY" for posting in entry.postings))
+        if is_time_tx:
+            continue
+
+        for posting in entry.postings:
+            acc = posting.account
+            is_non_trade_exp = (
+                acc.startswith(EXPENSES_PREFIX) and not acc.startswith(EXPENSES_TRADE_PREFIX)
+            ) or (
+                acc.startswith(EXPENSES_PREPAYMENTS_PREFIX)
+            )
+
+            is_non_trade_inc = acc.startswith("Income:") and not acc.startswith("Income:Trade:")
+            if is_non_trade_exp or is_non_trade_inc:
+                index[entry.date].append((is_non_trade_exp, posting.units))
+    return index
+
+
+def _summarize_day(curr_date, holdings_list, attrs, non_trade_postings, price_index,
+                   target_currency):
+    raw_networth_in_cny = decimal.Decimal(0)  # 包含sunk资产的理论净资产
+    networth_in_cny = decimal.Decimal(0)  # 不包含sunk资产的净资产
+    disposable_networth_in_cny = decimal.Decimal(0)
+    dnw_by_asset_class = {}
+
+    for hld in holdings_list:
+        if hld.currency in NON_PRICED_CURRENCIES:
+            continue
+
+        acc = attrs.accounts[hld.account]
+        if hld.market_value is None:
+            raise ValueError(hld)
+
+        raw_networth_in_cny += hld.market_value
+        if acc.sunk:
+            continue
+
+        if not acc.nondisposable:
+            disposable_networth_in_cny += hld.market_value
+            asset_class = attrs.commodities[hld.currency].asset_class
+            if asset_class not in dnw_by_asset_class:
+                dnw_by_asset_class[asset_class] = decimal.Decimal(0)
+            dnw_by_asset_class[asset_class] += hld.market_value
+
+        networth_in_cny += hld.market_value
+
+    non_trade_expenses = decimal.Decimal(0)
+    non_trade_incomes = decimal.Decimal(0)
+    for is_non_trade_exp, units in non_trade_postings.get(curr_date, ()):
+        if units.currency != target_currency:
+            base_quote = (units.currency, target_currency)
+            _, rate = price_index.get_price(base_quote, curr_date)
+        else:
+            rate = decimal.Decimal(1)
+
+        if is_non_trade_exp:
+            non_trade_expenses += (units.number * rate)
+        else:
+            non_trade_incomes -= (units.number * rate)
+
+    assert abs(sum(dnw_by_asset_class.values()) - disposable_networth_in_cny) < 1
+    assert set(dnw_by_asset_class.keys()) <= KNOWN_ASSET_CLASSES, dnw_by_asset_class
+
+    return {
+        "date": curr_date,
+        "raw_networth": raw_networth_in_cny,
+        "networth": networth_in_cny,
+        "disposable_networth": disposable_networth_in_cny,
+        "incomes": non_trade_incomes,
+        "expenses": non_trade_expenses,
+        "by_asset_class": dnw_by_asset_class,
+    }
+
+
+def split_date_range(start_date, end_date, num_shards):
+    """把 [start_date, end_date] 尽量均匀地切成最多 num_shards 段连续的日期区间"""
+    num_days = (end_date - start_date).days + 1
+    num_shards = max(1, min(num_shards, num_days))
+    shards = []
+    shard_start = start_date
+    for idx in range(num_shards):
+        shard_days = num_days // num_shards + (1 if idx < num_days % num_shards else 0)
+        shard_end = shard_start + datetime.timedelta(days=shard_days - 1)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end + datetime.timedelta(days=1)
+    return shards
+
+
+def build_attribute_table(entries, options_map):
+    """净值只用到账户的 sunk/nondisposable 和 commodity 的 asset-class"""
+    return AttributeTable.build(entries, options_map, commodity_fields=("asset-class",))
+
+
+def _compute_range(ledger, start_date, end_date, target_currency,
+                   balances=None, balances_date=None, snapshot_start=None,
+                   price_index=None, attrs=None):
+    """
+    Returns:
+        (start_date 到 end_date 每天的汇总值, {日期: 该日结束时各账户 Inventory 的副本}),
+        snapshot_start 为 None 时不保存快照
+    """
+    entries, _, options_map = ledger
+    with instrument.stage("build_indexes"):
+        if attrs is None:
+            attrs = build_attribute_table(entries, options_map)
+        if price_index is None:
+            price_index = PriceIndex.build(entries, options_map)
+        non_trade_postings = build_non_trade_postings_index(entries)
+    if balances is None:
+        balances = {}
+
+    result = []
+    snapshots = {}
+    daily_holdings = iter_daily_holdings(
+        entries, options_map, price_index, start_date, end_date, target_currency,
+        balances, balances_date,
+    )
+    for curr_date, holdings_list in daily_holdings:
+        with instrument.stage("summarize_day"):
+            result.append(_summarize_day(
+                curr_date, holdings_list, attrs, non_trade_postings, price_index,
+                target_currency,
+            ))
+        instrument.count("days")
+        if snapshot_start is not None and (
+                is_snapshot_date(curr_date, snapshot_start) or curr_date == end_date):
+            snapshots[curr_date] = {
+                account: copy.copy(inv) for account, inv in balances.items()
+            }
+    return result, snapshots
+
+
+def _compute_shard(args):
+    """工作进程: 从头累计出分片第一天之前的 Inventory, 再计算分片内的每一天"""
+    ledger_file, start_date, end_date, target_currency, snapshot_start = args
+    return _compute_range(
+        load_ledger(ledger_file), start_date, end_date, target_currency,
+        snapshot_start=snapshot_start,
+    )
+
+
+def compute_daily_values(since_date, end_date=None, target_currency="CNY",
+                         use_checkpoint=False, jobs=1, ledger=None, price_index=None, attrs=None):
+    """
+    逐日汇总持仓市值和非投资收支
+
+    Args:
+        ledger: 已经加载好的 (entries, errors, options_map), 默认用 load_ledger 加载.
+            jobs 大于 1 时工作进程用 load_ledger 重新加载 options_map["filename"]
+        price_index, attrs: 同一帐本已经构建好的 PriceIndex 和 build_attribute_table
+            的结果, 默认重新构建, 多个进程计算时不使用
+        use_checkpoint: 从帐本同目录的 .{帐本文件名}.networth.checkpoint 中最近一个
+            仍然有效的快照继续计算, 并把结果写回检查点。用价格缓存加载的帐本
+            (比如命令行)和解析价格文件的帐本(比如 report-server.py)使用不同的检查点
+        jobs: 大于 1 时把需要计算的日期切成 jobs 段, 在多个进程中分别计算后按顺序拼接
+
+    Returns:
+        每日一个 dict: 日期、理论净资产、净资产、可投资净资产、非投资收入、
+        非投资支出(都是 Decimal)和各资产类别的可投资净资产
+    """
+    if end_date is None:
+        end_date = datetime.date.today()
+    if ledger is None:
+        ledger = load_ledger()
+    entries = ledger[0]
+
+    result = []
+    snapshots = {}
+    balances = None
+    balances_date = None
+    snapshot_start = None
+    if use_checkpoint:
+        day_hashes = hash_entries_by_date(entries, get_price_digests(ledger[2]))
+        checkpoint = NetworthCheckpoint.load(
+            get_checkpoint_file(ledger[2]["filename"], "price_cache" in ledger[2]),
+            target_currency,
+        )
+        resume_point = checkpoint.get_resume_point(since_date, end_date, day_hashes)
+        if resume_point is not None:
+            balances_date, balances, result = resume_point
+            logger.info("Resumed from checkpoint at %s", balances_date)
+            snapshots = {
+                date: checkpoint.snapshots[date]
+                for date in checkpoint.snapshots if date <= balances_date
+            }
+        snapshot_start = result[0]["date"] if result else since_date
+    num_reused = len(result)
+
+    start_date = since_date
+    if balances_date is not None:
+        start_date = balances_date + datetime.timedelta(days=1)
+    if start_date > end_date:
+        shards = []
+    else:
+        shards = split_date_range(start_date, end_date, jobs)
+
+    if len(shards) > 1:
+        shard_args = [
+            (ledger[2]["filename"], shard_start, shard_end, target_currency, snapshot_start)
+            for shard_start, shard_end in shards
+        ]
+        with multiprocessing.Pool(len(shards)) as pool:
+            for shard_values, shard_snapshots in pool.map(_compute_shard, shard_args):
+                result.extend(shard_values)
+                snapshots.update(shard_snapshots)
+    elif shards:
+        with instrument.stage("compute_range"):
+            shard_values, shard_snapshots = _compute_range(
+                ledger, start_date, end_date, target_currency,
+                balances, balances_date, snapshot_start, price_index, attrs,
+            )
+        result.extend(shard_values)
+        snapshots.update(shard_snapshots)
+    logger.info(
+        "Computed %d days in %d shards, reused %d days",
+        len(result) - num_reused, len(shards), num_reused,
+    )
+
+    # 只算了检查点中一段较早的日期时不覆盖检查点
+    if use_checkpoint and result and (
+            resume_point is None or end_date >= checkpoint.last_date):
+        checkpoint.update(result[0]["date"], result, snapshots, day_hashes)
+        checkpoint.save()
+    return [values for values in result if values["date"] >= since_date]
+
+
+def get_series_columns(daily_values):
+    """NetworthSeries / compute_decimal_series 的输入列"""
+    return [
+        [values[key] for values in daily_values]
+        for key in ("date", "networth", "disposable_networth", "incomes", "expenses")
+    ]
+
+
+def iter_networth_series(since_date, end_date=None, check=False, use_checkpoint=False,
+                         jobs=1, ledger=None, price_index=None, attrs=None):
+    """
+    Args:
+        其余参数同 compute_daily_values
+
+    Yields:
+        每日一个 dict, 值是未格式化的数字, 没有数据时为 None, 输出前用 format_row 格式化
+    """
+    daily_values = compute_daily_values(
+        since_date, end_date, use_checkpoint=use_checkpoint, jobs=jobs, ledger=ledger,
+        price_index=price_index, attrs=attrs,
+    )
+    columns = get_series_columns(daily_values)
+    with instrument.stage("series"):
+        series = NetworthSeries(*columns)
+    if check:
+        max_errors = check_equivalence(series, compute_decimal_series(*columns))
+        for name, max_error in sorted(max_errors.items()):
+            logger.info("%s: max abs error %.3g against Decimal", name, max_error)
+
+    for idx, values in enumerate(daily_values):
+        is_valid = bool(series.valid[idx])
+        pnl = float(series.pnl[idx]) if is_valid else None
+        if values["date"].weekday() >= 5:
+            if pnl is not None:
+                assert pnl <= 0.01, values  # 预期周末不应该有投资盈亏
+
+        daily_status = {
+            "日期": values["date"],
+            # 理论净资产=总资产 - 负债
+            "理论净资产": values["raw_networth"],
+            # 净资产=总资产' - 负债（信用卡）- 沉没资产
+            "净资产": values["networth"],
+            "沉没资产": values["raw_networth"] - values["networth"],
+            # 可投资金额=净资产 - 不可支配资产（公积金、预付房租、宽带)
+            "可投资净资产": values["disposable_networth"],
+            # Income:Trade(已了结盈亏、分红) 以外的 Income (包含公积金收入、储蓄利息)
+            "非投资收入": values["incomes"],
+            # Expenses:Trade 以外的 Expenses (包含社保等支出)
+            "非投资支出": values["expenses"],
+            "投资盈亏": pnl,
+            # 投资盈亏% = 当日投资盈亏/昨日可投资金额
+            "投资盈亏%": float(series.pnl_rate[idx]) if is_valid else None,
+            "累计净值": float(series.nav[idx]),
+            "累计盈亏": float(series.pnl_cum[idx]),
+            "当年净值": float(series.nav_ytd[idx]),
+            "当年盈亏": float(series.pnl_ytd[idx]),
+        }
+        for asset_class in KNOWN_ASSET_CLASSES:
+            daily_status[f"{asset_class}%"] = (
+                values["by_asset_class"].get(asset_class, 0) / values["disposable_networth"]
+            )
+        # 新增的列放在最后, 不影响表格中已有公式引用的列
+        # 累计净值相对历史最高点的回撤
+        daily_status["回撤%"] = float(series.drawdown[idx])
+        # 最近 30 日投资盈亏% 的年化标准差
+        daily_status["波动率%"] = (
+            None if np.isnan(series.volatility[idx]) else float(series.volatility[idx])
+        )
+        yield daily_status
+
+
+def compute_networth_series(since_date, end_date=None, check=False, use_checkpoint=False,
+                            jobs=1, ledger=None, price_index=None, attrs=None):
+    """Returns: iter_networth_series 产出的所有行"""
+    return list(iter_networth_series(
+        since_date, end_date, check, use_checkpoint, jobs, ledger, price_index, attrs
+    ))
+
+
+# 列名 -> 格式, 没有列出的列原样输出, 资产类别占比的列用 "%" 结尾的格式
+COLUMN_FORMATS = {
+    "理论净资产": "%.2f",
+    "净资产": "%.2f",
+    "沉没资产": "%.2f",
+    "可投资净资产": "%.2f",
+    "非投资收入": "%.2f",
+    "非投资支出": "%.2f",
+    "投资盈亏": "%.2f",
+    "累计净值": "%.4f",
+    "累计盈亏": "%.2f",
+    "当年净值": "%.4f",
+    "当年盈亏": "%.2f",
+}
+PERCENT_FORMATS = {
+    "投资盈亏%": "{:.4f}%",
+    "回撤%": "{:.2f}%",
+    "波动率%": "{:.2f}%",
+}
+
+
+def format_row(row):
+    formatted = {}
+    for key, val in row.items():
+        if val is None:
+            formatted[key] = "n/a"
+        elif key in COLUMN_FORMATS:
+            formatted[key] = COLUMN_FORMATS[key] % val
+        elif key.endswith("%"):
+            formatted[key] = PERCENT_FORMATS.get(key, "{:.2f}%").format(100 * val)
+        else:
+            formatted[key] = val
+    return formatted
+
+
+def pad_to_year_end(rows):
+    """在格式化后的 rows 后面补空行到年末, 方便表格软件中按整年引用"""
+    last_row = None
+    for last_row in rows:
+        yield last_row
+    if last_row is None:
+        return
+
+    curr_date = last_row["日期"]
+    empty_row = {key: "" for key, val in last_row.items()}
+    while True:
+        curr_date += datetime.timedelta(days=1)
+        if (curr_date.month == 1 and curr_date.day == 1):
+            break
+
+        empty_row["日期"] = ""  # curr_date
+        yield empty_row.copy()
@@ -0,0 +1,167 @@
+"""
+净值序列的检查点
+
+保存已经算好的每日汇总值、定期的各账户 Inventory 快照和每天 entries 的哈希。
+再次运行时比较每天 entries 的哈希, 从第一个有变化的日期之前最近的快照继续计算,
+没有变化时只需要计算上次之后新增的日期。
+"""
+import os
+import copy
+import pickle
+import hashlib
+import logging
+import datetime
+
+from beancount.core import compare
+
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILENAME = ".{filename}.networth.checkpoint"
+# 用价格缓存加载的帐本价格是量化过的, 每日的值和哈希都和解析文本的不同, 分开保存
+PRICE_CACHED_CHECKPOINT_FILENAME = ".{filename}.pricecached.networth.checkpoint"
+# 每日汇总值的计算逻辑有变化时需要增加版本号
+CHECKPOINT_VERSION = 1
+# 每隔多少天保存一次 Inventory 快照
+SNAPSHOT_INTERVAL = 30
+# meta 中和内容无关的 key, 不参与哈希
+IGNORED_META_KEYS = {"filename", "lineno"}
+
+
+def get_checkpoint_file(ledger_file, price_cached=False):
+    """
+    同一目录下的多个帐本各自有检查点, 比如 main.beancount 的是 .main.beancount.networth.checkpoint。
+    price_cached 为 True 时是用价格缓存加载的帐本的检查点
+    """
+    dirname, basename = os.path.split(ledger_file)
+    filename = PRICE_CACHED_CHECKPOINT_FILENAME if price_cached else CHECKPOINT_FILENAME
+    return os.path.join(dirname, filename.format(filename=basename))
+
+
+def hash_entries_by_date(entries, extra_digests=None):
+    """
+    Args:
+        extra_digests: {日期: [哈希]}, 不在 entries 中的数据(比如价格缓存中的价格)
+
+    Returns:
+        {日期: 当日所有 entries 的哈希}, 不包括文件名和行号,
+        所以只是在文件中移动位置的 entry 不会让检查点失效
+    """
+    digests = {date: list(date_digests) for date, date_digests in (extra_digests or {}).items()}
+    for entry in entries:
+        meta = sorted(
+            (key, str(value)) for key, value in (entry.meta or {}).items()
+            if key not in IGNORED_META_KEYS and not key.startswith("__")
+        )
+        entry_digest = compare.hash_entry(entry, exclude_meta=True) + str(meta)
+        digests.setdefault(entry.date, []).append(entry_digest)
+    return {
+        date: hashlib.sha256("".join(sorted(date_digests)).encode()).hexdigest()
+        for date, date_digests in digests.items()
+    }
+
+
+def first_changed_date(old_hashes, new_hashes):
+    changed = [
+        date for date in set(old_hashes) | set(new_hashes)
+        if old_hashes.get(date) != new_hashes.get(date)
+    ]
+    return min(changed) if changed else None
+
+
+def is_snapshot_date(date, start_date):
+    return (date - start_date).days % SNAPSHOT_INTERVAL == 0
+
+
+class NetworthCheckpoint:
+    """
+    Attributes:
+        start_date: daily_values 的第一天
+        daily_values: 从 start_date 开始连续每天的汇总值
+        snapshots: {日期: 该日结束时各账户的 Inventory}
+        day_hashes: 计算时每天 entries 的哈希
+    """
+
+    def __init__(self, path, target_currency):
+        self.path = path
+        self.target_currency = target_currency
+        self.start_date = None
+        self.daily_values = []
+        self.snapshots = {}
+        self.day_hashes = {}
+
+    @property
+    def last_date(self):
+        return self.daily_values[-1]["date"] if self.daily_values else None
+
+    @classmethod
+    def load(cls, path, target_currency):
+        checkpoint = cls(path, target_currency)
+        try:
+            with open(path, "rb") as fhandler:
+                cached = pickle.load(fhandler)
+        except FileNotFoundError:
+            return checkpoint
+        except Exception as exc:
+            logger.warning("Ignored broken checkpoint %s: %s", path, exc)
+            return checkpoint
+
+        if cached.get("version") != CHECKPOINT_VERSION:
+            return checkpoint
+        if cached["target_currency"] != target_currency:
+            return checkpoint
+        checkpoint.start_date = cached["start_date"]
+        checkpoint.daily_values = cached["daily_values"]
+        checkpoint.snapshots = cached["snapshots"]
+        checkpoint.day_hashes = cached["day_hashes"]
+        return checkpoint
+
+    def save(self):
+        cached = {
+            "version": CHECKPOINT_VERSION,
+            "target_currency": self.target_currency,
+            "start_date": self.start_date,
+            "daily_values": self.daily_values,
+            "snapshots": self.snapshots,
+            "day_hashes": self.day_hashes,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as fhandler:
+            pickle.dump(cached, fhandler, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def get_resume_point(self, since_date, end_date, day_hashes):
+        """
+        找到可以继续计算的快照
+
+        Returns:
+            (快照日期, 该日结束时的 balances 副本, 截止快照日期的 daily_values)
+            或者 None(需要从 since_date 重新计算)
+        """
+        if self.start_date is None or self.start_date > since_date:
+            return None
+
+        reusable_until = min(self.last_date, end_date)
+        changed_date = first_changed_date(self.day_hashes, day_hashes)
+        if changed_date is not None:
+            reusable_until = min(reusable_until, changed_date - datetime.timedelta(days=1))
+
+        snapshot_dates = [date for date in self.snapshots if date <= reusable_until]
+        if not snapshot_dates:
+            return None
+        snapshot_date = max(snapshot_dates)
+        balances = {
+            account: copy.copy(inv) for account, inv in self.snapshots[snapshot_date].items()
+        }
+        num_days = (snapshot_date - self.start_date).days + 1
+        return snapshot_date, balances, self.daily_values[:num_days]
+
+    def update(self, start_date, daily_values, snapshots, day_hashes):
+        """用本次计算的结果替换检查点, 只保留按间隔和最后一天的快照"""
+        self.start_date = start_date
+        self.daily_values = daily_values
+        self.day_hashes = day_hashes
+        self.snapshots = {
+            date: balances for date, balances in snapshots.items()
+            if is_snapshot_date(date, start_date) or date == self.last_date
+        }
@@ -0,0 +1,149 @@
+"""
+净值序列的向量化计算
+
+输入是按日排列的净资产、可投资净资产、非投资收入、非投资支出四列, 一次性算出
+投资盈亏、累计净值、当年净值(每年 1 月 1 日重置)、回撤和滚动波动率。
+compute_decimal_series 是逐日用 Decimal 计算的原始实现, 用于校验。
+"""
+import decimal
+
+import numpy as np
+
+
+DEFAULT_VOLATILITY_WINDOW = 30
+DAYS_PER_YEAR = 365
+
+
+def _shift(values, fill):
+    shifted = np.empty_like(values)
+    shifted[:1] = fill
+    shifted[1:] = values[:-1]
+    return shifted
+
+
+def _rolling_sum(values, window):
+    cum = np.concatenate([[0.0], np.cumsum(values)])
+    starts = np.maximum(np.arange(1, len(values) + 1) - window, 0)
+    return cum[1:] - cum[starts]
+
+
+def _rolling_std(values, valid, window):
+    """最近 window 日内有效值的样本标准差, 有效值少于 2 个时为 nan"""
+    values = np.where(valid, values, 0.0)
+    counts = _rolling_sum(valid.astype(np.float64), window)
+    sums = _rolling_sum(values, window)
+    squares = _rolling_sum(values ** 2, window)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        variance = (squares - sums ** 2 / counts) / (counts - 1)
+    return np.where(counts >= 2, np.sqrt(np.maximum(variance, 0)), np.nan)
+
+
+class NetworthSeries:
+    """
+    Attributes (都是和 dates 等长的 float64 数组, 没有数据的位置为 nan):
+        pnl: 投资盈亏 = 当日净资产 - 非投资收入 + 非投资支出 - 前一日净资产
+        pnl_rate: 投资盈亏 / 前一日可投资净资产
+        nav / pnl_cum: 累计净值 / 累计盈亏
+        nav_ytd / pnl_ytd: 当年净值 / 当年盈亏
+        drawdown: 累计净值相对历史最高点的回撤
+        volatility: 最近 volatility_window 日投资盈亏% 的年化标准差
+    """
+
+    def __init__(self, dates, networth, disposable_networth, incomes, expenses,
+                 volatility_window=DEFAULT_VOLATILITY_WINDOW):
+        self.dates = list(dates)
+        networth = np.asarray(networth, dtype=np.float64)
+        disposable_networth = np.asarray(disposable_networth, dtype=np.float64)
+        incomes = np.asarray(incomes, dtype=np.float64)
+        expenses = np.asarray(expenses, dtype=np.float64)
+
+        prev_networth = _shift(networth, 0.0)
+        prev_disposable = _shift(disposable_networth, np.nan)
+        # 和逐日计算一样, 第一天或前一日净资产为 0 时没有盈亏
+        valid = prev_networth != 0
+        self.valid = valid
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.pnl = np.where(valid, networth - incomes + expenses - prev_networth, np.nan)
+            self.pnl_rate = np.where(valid, self.pnl / prev_disposable, np.nan)
+
+        self.nav = np.cumprod(np.where(valid, 1 + self.pnl_rate, 1.0))
+        self.pnl_cum = np.cumsum(np.where(valid, self.pnl, 0.0))
+
+        # 每年第一天开始新的一段, 当年值 = 累计值 / 去年年末的累计值
+        years = np.array([date.year for date in self.dates])
+        is_year_start = np.concatenate([[True], years[1:] != years[:-1]])[:len(years)]
+        year_starts = np.flatnonzero(is_year_start)
+        segment = np.cumsum(is_year_start) - 1
+        self.nav_ytd = self.nav / _shift(self.nav, 1.0)[year_starts][segment]
+        self.pnl_ytd = self.pnl_cum - _shift(self.pnl_cum, 0.0)[year_starts][segment]
+
+        self.drawdown = self.nav / np.maximum.accumulate(self.nav) - 1
+        self.volatility = np.sqrt(DAYS_PER_YEAR) * _rolling_std(
+            self.pnl_rate, valid, volatility_window
+        )
+
+    def __len__(self):
+        return len(self.dates)
+
+
+def compute_decimal_series(dates, networth, disposable_networth, incomes, expenses):
+    """
+    逐日用 Decimal 计算 pnl、pnl_rate、nav、pnl_cum、nav_ytd、pnl_ytd
+
+    Returns:
+        {属性名: list}, 没有数据的位置为 None
+    """
+    result = {name: [] for name in ("pnl", "pnl_rate", "nav", "pnl_cum", "nav_ytd", "pnl_ytd")}
+    prev_networth = None
+    prev_disposable_networth = None
+    cum_invest_nav = decimal.Decimal("1.0")
+    cum_invest_nav_ytd = decimal.Decimal("1.0")
+    cum_invest_pnl = decimal.Decimal(0)
+    cum_invest_pnl_ytd = decimal.Decimal(0)
+    for idx, curr_date in enumerate(dates):
+        if idx > 0 and curr_date.year != dates[idx - 1].year:
+            cum_invest_nav_ytd = decimal.Decimal("1.0")
+            cum_invest_pnl_ytd = decimal.Decimal(0)
+
+        if prev_networth:
+            pnl = networth[idx] - incomes[idx] + expenses[idx] - prev_networth
+            pnl_rate = pnl / prev_disposable_networth
+            cum_invest_nav *= (1 + pnl_rate)
+            cum_invest_nav_ytd *= (1 + pnl_rate)
+            cum_invest_pnl += pnl
+            cum_invest_pnl_ytd += pnl
+        else:
+            pnl = pnl_rate = None
+
+        result["pnl"].append(pnl)
+        result["pnl_rate"].append(pnl_rate)
+        result["nav"].append(cum_invest_nav)
+        result["pnl_cum"].append(cum_invest_pnl)
+        result["nav_ytd"].append(cum_invest_nav_ytd)
+        result["pnl_ytd"].append(cum_invest_pnl_ytd)
+        prev_networth = networth[idx]
+        prev_disposable_networth = disposable_networth[idx]
+    return result
+
+
+def check_equivalence(series, reference, rtol=1e-9, atol=1e-6):
+    """
+    对比 NetworthSeries 和 compute_decimal_series 的结果
+
+    Returns:
+        {属性名: 最大绝对误差}
+
+    Raises:
+        AssertionError: 某一项超出容差
+    """
+    max_errors = {}
+    for name, expected in reference.items():
+        actual = getattr(series, name)
+        is_none = np.array([value is None for value in expected])
+        assert np.array_equal(is_none, np.isnan(actual)), name
+        expected = np.array([float(value) for value in expected if value is not None])
+        actual = actual[~is_none]
+        assert np.allclose(actual, expected, rtol=rtol, atol=atol), name
+        max_errors[name] = float(np.max(np.abs(actual - expected))) if len(expected) else 0.0
+    return max_errors
@@ -0,0 +1,272 @@
+"""
+持仓的计算, 供 generate-portfolio.py 和 report-server.py 使用
+
+- 输出带 meta 中自定义的名称，资产类别
+- 过滤已支出不可退款的，预付款项
+- 过滤不可支配资产
+"""
+import datetime
+import logging
+from decimal import Decimal
+
+import instrument
+from daily_holdings import iter_holdings_at_dates
+from ledger_attrs import COMMODITY_META_FIELDS, NON_PRICED_CURRENCIES, AttributeTable
+from ledger_loader import load_ledger
+from price_index import PriceIndex
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HORIZONS = (1, 2, 7, 30)
+
+
+def sort_key(row):
+    """
+    输出大体的风险系数以供排序
+    """
+    asset_class = row["一级类别"]
+    asset_subclass = row["二级类别"]
+    ac_list = ["现金", "债券", "债权", "基金", "股票", "股权", "另类资产", "另类"]
+    asc_list = [
+        "本币", "外汇", "债券基金", "可转换债券", "指数基金", '偏债混合基金',
+        "偏股混合基金", "A股", "中国股票", "港股", "香港股票",
+        "美股", "美国股票", "贵金属", "加密货币",
+    ]
+    factor1 = ac_list.index(asset_class)
+    factor2 = asc_list.index(asset_subclass)
+    return (1 + factor1) * 100 + factor2
+
+
+def build_attribute_table(entries, options_map):
+    """持仓表用到的账户名称和 commodity 的全部属性"""
+    return AttributeTable.build(
+        entries, options_map,
+        account_fields=("name",), commodity_fields=COMMODITY_META_FIELDS,
+    )
+
+
+def iter_portfolio_matrices(dates, horizons=DEFAULT_HORIZONS, ledger=None,
+                            price_index=None, attrs=None):
+    """
+    只加载、遍历一次帐本, 按日期升序产出每个日期的持仓
+
+    Args:
+        ledger: 已经加载好的 (entries, errors, options_map), 默认用 load_ledger 加载
+        price_index, attrs: 同一帐本已经构建好的 PriceIndex 和 build_attribute_table
+            的结果, 默认重新构建
+
+    Yields:
+        (日期, rows, cum_networth), rows 和 cum_networth 同 get_portfolio_matrix
+    """
+    if ledger is None:
+        ledger = load_ledger()
+    (entries, errors, option_map) = ledger
+    with instrument.stage("build_indexes"):
+        if price_index is None:
+            price_index = PriceIndex.build(entries, option_map)
+        if attrs is None:
+            attrs = build_attribute_table(entries, option_map)
+    holdings_at_dates = iter_holdings_at_dates(entries, option_map, price_index, sorted(dates))
+    for asof_date, assets_holdings in holdings_at_dates:
+        with instrument.stage("portfolio_matrix"):
+            rows, cum_networth = _build_portfolio_matrix(
+                assets_holdings, asof_date, price_index, attrs, horizons
+            )
+        yield asof_date, rows, cum_networth
+
+
+def get_portfolio_matrix(asof_date=None, horizons=DEFAULT_HORIZONS):
+    """
+    打印持仓
+    Args:
+        asof_date: 计算该日为止的持仓, 避免未来预付款项影响。
+        horizons: 计算最近 N 日涨跌幅的天数列表
+
+    Returns:
+        (rows, cum_networth), rows 的值是未格式化的数字, 没有数据时为 None,
+        输出前用 format_row 格式化
+    """
+    if asof_date is None:
+        asof_date = datetime.date.today()
+
+    _, rows, cum_networth = next(iter_portfolio_matrices([asof_date], horizons))
+    return rows, cum_networth
+
+
+def _build_portfolio_matrix(assets_holdings, asof_date, price_index, attrs, horizons):
+    holding_groups = {}
+    for holding in assets_holdings:
+        if holding.currency in NON_PRICED_CURRENCIES:
+            continue
+
+        account_attrs = attrs.accounts[holding.account]
+        if account_attrs.sunk:
+            logger.warning(f"{holding.account} is an sunk. Ignored.")
+            continue
+        if account_attrs.nondisposable:
+            logger.warning(f"{holding.account} is nondisposable. Ignored.")
+            continue
+
+        commodity_attrs = attrs.commodities[holding.currency]
+        account_name = account_attrs.name
+        account_nondisposable = account_attrs.nondisposable
+        symbol_name = commodity_attrs.name
+        asset_class = commodity_attrs.asset_class
+        asset_subclass = commodity_attrs.asset_subclass
+        symbol = holding.currency
+        currency = holding.cost_currency
+        price = holding.price_number
+        price_date = holding.price_date
+        if price is None:
+            if symbol == currency:
+                price = 1
+                price_date = ''
+        qty = holding.number
+        if currency == "CNY":
+            cny_rate = 1
+        else:
+            _, cny_rate = price_index.get_price((currency, "CNY"), asof_date)
+            if cny_rate is None:
+                logger.warning(
+                    f"No price of ({currency}, CNY) as of {asof_date}, "
+                    f"{symbol} in {holding.account} ignored."
+                )
+                continue
+
+        holding_dict = {
+            "account": account_name,
+            "nondisposable": account_nondisposable,
+            "symbol": symbol,
+            "symbol_name": symbol_name,
+            "asset_class": asset_class,
+            "asset_subclass": asset_subclass,
+            "quantity": qty,
+            "currency": currency,
+            "price": price,
+            "price_date": price_date,
+            "cny_rate": cny_rate,
+            # optional:
+            # book_value
+            # market_value
+            #
+            # chg_{N}, N in horizons
+        }
+
+        base_quote = (holding.currency, holding.cost_currency)
+        # 没有直接报价时 market_value 是经其他货币换算的, 不计算涨跌幅
+        num_prices = price_index.count(base_quote, asof_date)
+        if holding.cost_number is not None and holding.market_value is not None:
+            holding_dict["book_value"] = holding.book_value
+            holding_dict["market_value"] = holding.market_value
+
+            # 涨跌幅只用直接报价, 和 num_prices 一致
+            _, latest_price = price_index.get_direct_price(base_quote, asof_date)
+            for dur in horizons:
+                if num_prices < dur:
+                    continue
+
+                base_date = asof_date - datetime.timedelta(days=dur)
+                _, base_price = price_index.get_direct_price(base_quote, base_date)
+                if base_price is not None:
+                    holding_dict[f"chg_{dur}"] = latest_price / base_price - 1
+                else:
+                    holding_dict[f"chg_{dur}"] = 'n/a'
+
+        group_key = (symbol, account_nondisposable)
+        holding_groups.setdefault(group_key, []).append(holding_dict)
+
+    rows = []
+    cum_networth = 0
+    for (symbol, account_nondisposable), holdings in holding_groups.items():
+        qty_by_account = {}
+        total_book_value = Decimal(0)
+        total_market_value = Decimal(0)
+        for holding in holdings:
+            if holding["account"] not in qty_by_account:
+                qty_by_account[holding["account"]] = 0
+            qty_by_account[holding["account"]] += holding["quantity"]
+            if "book_value" in holding:
+                total_book_value += holding["book_value"]
+                total_market_value += holding["market_value"]
+        if total_book_value == 0:
+            pnlr = None
+        else:
+            pnlr = total_market_value / total_book_value - 1
+
+        total_qty = sum(qty_by_account.values())
+        hld_px = holding["price"]
+        if hld_px is None:
+            raise ValueError(f"price not found for {holding}")
+
+        networth = holding["cny_rate"] * hld_px * total_qty
+        cum_networth += networth
+        row = {
+            "一级类别": holding["asset_class"],
+            "二级类别": holding["asset_subclass"],
+            "标的": holding["symbol_name"],
+            "代号": symbol,
+            "持仓量": total_qty,
+            "市场价格": holding["price"],
+            "报价日期": holding["price_date"] or None,
+            "市场价值": int(round(holding["price"] * total_qty)),
+            "货币": holding["currency"],
+            "人民币价值": networth,
+            "持仓盈亏%": pnlr,
+        }
+        for dur in horizons:
+            optional_col = f"chg_{dur}"
+            col_name = f"{dur}日%"
+            if optional_col not in holding or holding[optional_col] == 'n/a':
+                row[col_name] = None
+            else:
+                row[col_name] = holding[optional_col]
+        rows.append(row)
+
+    rows.sort(key=sort_key)
+    for row in rows:
+        row["占比"] = row["人民币价值"] / cum_networth
+    return rows, cum_networth
+
+
+def get_month_ends(since_date, until_date):
+    """since_date 所在月份到 until_date 所在月份的每个月末, 最后一个月用 until_date"""
+    month_ends = []
+    year, month = since_date.year, since_date.month
+    while (year, month) <= (until_date.year, until_date.month):
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        month_end = datetime.date(year, month, 1) - datetime.timedelta(days=1)
+        month_ends.append(min(month_end, until_date))
+    return month_ends
+
+
+# 列名 -> 格式, 没有列出的列原样输出
+COLUMN_FORMATS = {
+    "持仓量": "%.3f",
+    "市场价格": "%.4f",
+    "人民币价值": "%.2f",
+}
+# 比例列乘以 100 后输出, 没有列出的 "%" 结尾的列(最近 N 日涨跌幅)用 "%.2f%%"
+PERCENT_FORMATS = {
+    "持仓盈亏%": "%.4f%%",
+    "占比": "%.2f%%",
+}
+# 没有值时输出的内容, 默认为 "n/a"
+EMPTY_VALUES = {
+    "报价日期": "",
+}
+
+
+def format_row(row):
+    """把 get_portfolio_matrix 返回的未格式化的一行转成 CSV 中的字符串"""
+    formatted = {}
+    for key, val in row.items():
+        if val is None:
+            formatted[key] = EMPTY_VALUES.get(key, "n/a")
+        elif key in COLUMN_FORMATS:
+            formatted[key] = COLUMN_FORMATS[key] % val
+        elif key in PERCENT_FORMATS or key.endswith("%"):
+            formatted[key] = PERCENT_FORMATS.get(key, "%.2f%%") % (100 * val)
+        else:
+            formatted[key] = val
+    return formatted
@@ -0,0 +1,377 @@
+"""
+prices.beancount 的二进制缓存
+
+prices.beancount 中很多价格带着浮点误差的几十位小数, 每次加载帐本都要逐行解析成
+Decimal。ingest 把价格按标的的精度量化后写成按列存放的定长数组:
+
+    header | 符号表 | (base, quote, 指数, 起始下标, 个数) * 交易对数
+           | 价格 int64 * 价格数 | 日期 int32 * 价格数
+
+价格 = 整数 * 10 ** -指数, 同一交易对的价格连续存放并按日期排序, 同一天只保留
+最后一行。读取时用 mmap 映射整个文件, 不需要解析文本。
+
+价格文件中只能有 price 指令(注释和空行除外), 否则 ingest 报错, 因为用缓存加载时
+其余的指令会丢失。
+
+缓存文件记录了 prices.beancount 的 mtime 和内容哈希, 价格文件被修改后缓存失效,
+load_ledger 会退回到解析文本, 需要重新 ingest。数组使用本机字节序, 缓存文件不跨机器使用。
+"""
+import os
+import sys
+import mmap
+import array
+import struct
+import decimal
+import hashlib
+import logging
+import datetime
+
+from beancount.core import data
+from beancount.core import prices
+from beancount.core.number import ONE, ZERO
+from beancount.parser import parser
+
+import instrument
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILENAME = ".{filename}.bin"
+MAGIC = b"BEANPRC\0"
+# 2: 价格文件中有 price 以外的指令时不再生成缓存, 旧版本的缓存可能丢了这些指令
+CACHE_VERSION = 2
+# magic, 版本, 字节序, 符号表字节数, 交易对数, 价格数, 价格文件的大小、mtime、sha256
+HEADER = struct.Struct("<8sI8sIIIQq32s")
+# base 和 quote 在符号表中的下标, 指数, 起始下标, 个数
+PAIR = struct.Struct("<HHiII")
+# 没有在 commodity 的 price-precision 中指定小数位数时保留的有效数字位数,
+# 足够去掉浮点误差又不损失报价本身的精度
+DEFAULT_SIGNIFICANT_DIGITS = 12
+PRECISION_META_KEY = "price-precision"
+INT64_MAX = 2 ** 63 - 1
+
+
+def get_cache_file(prices_file):
+    dirname, basename = os.path.split(prices_file)
+    return os.path.join(dirname, CACHE_FILENAME.format(filename=basename))
+
+
+def get_precisions(entries):
+    """Returns: {标的: commodity 的 price-precision 中指定的小数位数}"""
+    return {
+        entry.currency: int(entry.meta[PRECISION_META_KEY])
+        for entry in entries
+        if isinstance(entry, data.Commodity) and PRECISION_META_KEY in (entry.meta or {})
+    }
+
+
+def quantize(number, decimals=None):
+    """
+    保留 decimals 位小数, decimals 为 None 时保留 DEFAULT_SIGNIFICANT_DIGITS 位有效数字,
+    并去掉末尾的 0
+    """
+    if number == ZERO:
+        return ZERO
+    if decimals is None:
+        decimals = DEFAULT_SIGNIFICANT_DIGITS - number.adjusted() - 1
+    with decimal.localcontext() as context:
+        context.prec = max(context.prec, number.adjusted() + decimals + 2)
+        return number.quantize(ONE.scaleb(-decimals)).normalize()
+
+
+def _fraction_digits(number):
+    return max(0, -number.as_tuple().exponent)
+
+
+def _to_mantissas(numbers):
+    """
+    把同一交易对的价格转换成共用一个指数的整数, 超出 int64 时减少小数位数
+
+    Returns:
+        (指数, 整数列表)
+    """
+    exponent = max((_fraction_digits(number) for number in numbers), default=0)
+    max_abs = max((abs(number) for number in numbers), default=ZERO)
+    if exponent > 0 and max_abs.scaleb(exponent) > INT64_MAX:
+        logger.warning("Prices up to %s do not fit in int64 with %d decimals", max_abs, exponent)
+        while exponent > 0 and max_abs.scaleb(exponent) > INT64_MAX:
+            exponent -= 1
+    if max_abs.scaleb(exponent) > INT64_MAX:
+        raise ValueError(f"Price {max_abs} is too large for the price cache")
+    with decimal.localcontext() as context:
+        context.prec = 40
+        mantissas = [int(number.scaleb(exponent).to_integral_value()) for number in numbers]
+    return exponent, mantissas
+
+
+def _file_key(path):
+    with open(path, "rb") as fhandler:
+        content = fhandler.read()
+    return os.stat(path).st_mtime_ns, len(content), hashlib.sha256(content).digest()
+
+
+def _pad(size):
+    return -size % 8
+
+
+@instrument.timed("ingest_prices")
+def ingest(prices_file, precisions=None, cache_file=None):
+    """
+    解析 prices_file, 量化后写入二进制缓存
+
+    Args:
+        precisions: {标的: 小数位数}, 没有指定的标的保留 DEFAULT_SIGNIFICANT_DIGITS 位有效数字
+
+    Returns:
+        (价格数, 交易对数, 量化后数值有变化的价格数)
+
+    Raises:
+        ValueError: 价格文件有语法错误, 或者有 price 以外的指令
+    """
+    if precisions is None:
+        precisions = {}
+    if cache_file is None:
+        cache_file = get_cache_file(prices_file)
+    mtime_ns, size, digest = _file_key(prices_file)
+    entries, errors, options_map = parser.parse_file(prices_file)
+    if errors:
+        raise ValueError(f"Failed to parse {prices_file}: {errors[0].message}")
+    # 用缓存加载时不会再解析价格文件, 其中除 price 外的指令都会丢失
+    others = [entry for entry in entries if not isinstance(entry, data.Price)]
+    if others or options_map["include"] or options_map["plugin"]:
+        where = (f"{type(others[0]).__name__} at line {others[0].meta['lineno']}"
+                 if others else "include/plugin")
+        raise ValueError(
+            f"{prices_file} has directives other than price ({where}), "
+            "move them to another file or load the ledger without the price cache"
+        )
+
+    # {(base, quote): {日期: 价格}}, 同一天后出现的覆盖先出现的
+    price_lists = {}
+    num_changed = 0
+    for entry in entries:
+        number = entry.amount.number
+        quantized = quantize(number, precisions.get(entry.currency))
+        num_changed += quantized != number
+        base_quote = (entry.currency, entry.amount.currency)
+        price_lists.setdefault(base_quote, {})[entry.date] = quantized
+
+    symbols = sorted({symbol for base_quote in price_lists for symbol in base_quote})
+    symbol_ids = {symbol: idx for idx, symbol in enumerate(symbols)}
+    symbols_bytes = "\n".join(symbols).encode()
+    pairs = []
+    mantissas = array.array("q")
+    ordinals = array.array("i")
+    for (base, quote), date_prices in sorted(price_lists.items()):
+        dates = sorted(date_prices)
+        exponent, pair_mantissas = _to_mantissas([date_prices[date] for date in dates])
+        pairs.append(PAIR.pack(
+            symbol_ids[base], symbol_ids[quote], exponent, len(mantissas), len(dates)
+        ))
+        mantissas.extend(pair_mantissas)
+        ordinals.extend(date.toordinal() for date in dates)
+
+    header = HEADER.pack(
+        MAGIC, CACHE_VERSION, sys.byteorder.encode(), len(symbols_bytes),
+        len(pairs), len(mantissas), size, mtime_ns, digest,
+    )
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, "wb") as fhandler:
+        fhandler.write(header)
+        fhandler.write(symbols_bytes + b"\0" * _pad(len(symbols_bytes)))
+        fhandler.write(b"".join(pairs))
+        fhandler.write(mantissas.tobytes())
+        fhandler.write(ordinals.tobytes())
+    os.replace(tmp_file, cache_file)
+    logger.info(
+        "Ingested %d prices of %d pairs from %s into %s, %d quantized",
+        len(mantissas), len(pairs), prices_file, cache_file, num_changed,
+    )
+    return len(mantissas), len(pairs), num_changed
+
+
+class PriceCache:
+    """
+    用 mmap 打开的价格缓存, 用完后需要 close(或者用 with)
+
+    Attributes:
+        pairs: [(base, quote, 指数, 起始下标, 个数)]
+    """
+
+    def __init__(self, cache_file):
+        self.path = cache_file
+        self._fhandler = open(cache_file, "rb")
+        try:
+            self._mmap = mmap.mmap(self._fhandler.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空文件不能 mmap
+            self._fhandler.close()
+            raise ValueError(f"Broken price cache {cache_file}")
+        self._views = []
+        try:
+            self._open()
+        except Exception:
+            self.close()
+            raise
+
+    def _open(self):
+        if len(self._mmap) < HEADER.size:
+            raise ValueError(f"Broken price cache {self.path}")
+        (magic, version, byteorder, symbols_size, num_pairs, num_prices,
+         self.source_size, self.source_mtime_ns, self.source_digest) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != CACHE_VERSION:
+            raise ValueError(f"Unknown price cache version {self.path}")
+        if byteorder.rstrip(b"\0").decode() != sys.byteorder:
+            raise ValueError(f"Price cache {self.path} was written on another platform")
+
+        offset = HEADER.size
+        symbols = self._mmap[offset:offset + symbols_size].decode().split("\n")
+        offset += symbols_size + _pad(symbols_size)
+        self.pairs = []
+        for base_id, quote_id, exponent, start, count in PAIR.iter_unpack(
+                self._mmap[offset:offset + PAIR.size * num_pairs]):
+            self.pairs.append((symbols[base_id], symbols[quote_id], exponent, start, count))
+        offset += PAIR.size * num_pairs
+
+        prices_size = 8 * num_prices
+        dates_size = 4 * num_prices
+        if len(self._mmap) != offset + prices_size + dates_size:
+            raise ValueError(f"Broken price cache {self.path}")
+        view = memoryview(self._mmap)
+        self._views.append(view)
+        self.mantissas = view[offset:offset + prices_size].cast("q")
+        self.ordinals = view[offset + prices_size:].cast("i")
+        self._views.extend([self.mantissas, self.ordinals])
+
+    def is_fresh(self, prices_file):
+        """缓存是否和 prices_file 的内容一致, mtime 变了时比较内容哈希"""
+        try:
+            stat = os.stat(prices_file)
+        except FileNotFoundError:
+            return False
+        if stat.st_size != self.source_size:
+            return False
+        if stat.st_mtime_ns == self.source_mtime_ns:
+            return True
+        return _file_key(prices_file)[2] == self.source_digest
+
+    def read_price_lists(self):
+        """Returns: {(base, quote): [(日期, 价格)]}, 按日期排序"""
+        dates = {}
+        price_lists = {}
+        for base, quote, exponent, start, count in self.pairs:
+            price_list = []
+            for ordinal, mantissa in zip(self.ordinals[start:start + count],
+                                         self.mantissas[start:start + count]):
+                date = dates.get(ordinal)
+                if date is None:
+                    date = dates[ordinal] = datetime.date.fromordinal(ordinal)
+                price_list.append((date, decimal.Decimal(mantissa).scaleb(-exponent)))
+            price_lists[(base, quote)] = price_list
+        return price_lists
+
+    def iter_digests(self):
+        """Yields: (日期, 价格的哈希), 供净值检查点判断哪些日期有变化"""
+        for base, quote, exponent, start, count in self.pairs:
+            for ordinal, mantissa in zip(self.ordinals[start:start + count],
+                                         self.mantissas[start:start + count]):
+                digest = hashlib.sha256(
+                    f"price {base} {quote} {mantissa}e-{exponent}".encode()
+                ).hexdigest()
+                yield datetime.date.fromordinal(ordinal), digest
+
+    def close(self):
+        # mmap 上还有 memoryview 时不能关闭
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mmap.close()
+        self._fhandler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_fresh_cache(prices_file):
+    """Returns: 和 prices_file 一致的 PriceCache, 缓存不存在或已过期时返回 None"""
+    cache_file = get_cache_file(prices_file)
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        cache = PriceCache(cache_file)
+    except (OSError, ValueError) as exc:
+        logger.warning("Ignored broken price cache %s: %s", cache_file, exc)
+        return None
+    if not cache.is_fresh(prices_file):
+        logger.warning(
+            "Price cache %s is stale, run ./scripts/ingest-prices.py to rebuild it", cache_file
+        )
+        cache.close()
+        return None
+    return cache
+
+
+def _merge_price_lists(price_lists):
+    """
+    和 prices.build_price_map 的后半部分相同: 合并互为倒数的交易对,
+    同一天只保留最后一个价格, 再补上所有反向的价格
+    """
+    for base, quote in [base_quote for base_quote in price_lists
+                        if tuple(reversed(base_quote)) in price_lists]:
+        if (base, quote) not in price_lists or (quote, base) not in price_lists:
+            continue
+        if len(price_lists[(base, quote)]) < len(price_lists[(quote, base)]):
+            remove = (base, quote)
+        else:
+            remove = (quote, base)
+        remove_list = price_lists.pop(remove)
+        price_lists[tuple(reversed(remove))].extend(
+            (date, ONE / rate) for date, rate in remove_list if rate != ZERO
+        )
+
+    price_map = prices.PriceMap()
+    for base_quote, date_rates in price_lists.items():
+        deduped = {}
+        for date, rate in sorted(date_rates, key=lambda date_rate: date_rate[0]):
+            deduped[date] = rate
+        price_map[base_quote] = list(deduped.items())
+    price_map.forward_pairs = list(price_map.keys())
+    for (base, quote), price_list in list(price_map.items()):
+        price_map[(quote, base)] = [
+            (date, ONE / rate) for date, rate in price_list if rate != ZERO
+        ]
+    return price_map
+
+
+def build_price_map(entries, options_map):
+    """
+    等价于 prices.build_price_map(entries)。帐本是用价格缓存加载的(options_map 中有
+    price_cache)时, 价格文件中的价格从缓存读取, 其余文件中的 Price 排在后面
+    """
+    cache_file = options_map.get("price_cache")
+    if cache_file is None:
+        return prices.build_price_map(entries)
+
+    with PriceCache(cache_file) as cache:
+        price_lists = cache.read_price_lists()
+    for entry in entries:
+        if isinstance(entry, data.Price):
+            price_lists.setdefault((entry.currency, entry.amount.currency), []).append(
+                (entry.date, entry.amount.number)
+            )
+    return _merge_price_lists(price_lists)
+
+
+def get_price_digests(options_map):
+    """Returns: {日期: [价格缓存中当天价格的哈希]}, 不是用价格缓存加载的帐本返回空 dict"""
+    cache_file = options_map.get("price_cache")
+    if cache_file is None:
+        return {}
+    digests = {}
+    with PriceCache(cache_file) as cache:
+        for date, digest in cache.iter_digests():
+            digests.setdefault(date, []).append(digest)
+    return digests
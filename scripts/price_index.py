@@ -0,0 +1,73 @@
+"""
+按日期排序的价格数组, 用 bisect 做 as-of 查询
+"""
+import bisect
+
+from beancount.core.number import ONE
+
+import price_cache
+from conversion import CurrencyGraph
+
+
+class PriceIndex:
+    """
+    (base, quote) -> 按日期排序的价格数组, 用 bisect 查询某日为止的最新价格。
+    基于 prices.build_price_map 的结果构建一次, 之后每次查询 O(log N)。
+    没有直接报价的交易对通过 CurrencyGraph 经其他货币换算。
+
+    Args:
+        preferred: 换算时跳数相同的路径中优先经过的货币
+    """
+
+    def __init__(self, price_map, preferred=()):
+        self._dates = {}
+        self._rates = {}
+        for base_quote, price_list in price_map.items():
+            self._dates[base_quote] = [dt for dt, _ in price_list]
+            self._rates[base_quote] = [rate for _, rate in price_list]
+        self.graph = CurrencyGraph(self, self._dates, preferred)
+
+    @classmethod
+    def build(cls, entries, options_map):
+        """从帐本构建, 帐本是用价格缓存加载的时从缓存读取价格"""
+        return cls(
+            price_cache.build_price_map(entries, options_map),
+            options_map["operating_currency"],
+        )
+
+    def __contains__(self, base_quote):
+        return base_quote in self._dates
+
+    def count(self, base_quote, date=None):
+        """date 当日为止(含)的价格点个数, date 为 None 时返回全部个数"""
+        dates = self._dates.get(base_quote, ())
+        if date is None:
+            return len(dates)
+        return bisect.bisect_right(dates, date)
+
+    def get_direct_price(self, base_quote, date=None):
+        """
+        Returns:
+            (报价日期, 价格), 等价于对 date 当日为止的 price_map 调用
+            prices.get_latest_price; 找不到时返回 (None, None)
+        """
+        base, quote = base_quote
+        if quote is None or base == quote:
+            return None, ONE
+        dates = self._dates.get(base_quote)
+        if not dates:
+            return None, None
+        idx = self.count(base_quote, date)
+        if idx == 0:
+            return None, None
+        return dates[idx - 1], self._rates[base_quote][idx - 1]
+
+    def get_price(self, base_quote, date=None):
+        """
+        和 get_direct_price 相同, 但 date 当日为止没有直接报价时经其他货币换算,
+        报价日期为换算路径上最早的报价日期
+        """
+        price_date, rate = self.get_direct_price(base_quote, date)
+        if rate is None:
+            price_date, rate = self.graph.get_rate(base_quote[0], base_quote[1], date)
+        return price_date, rate
@@ -0,0 +1,228 @@
+"""
+prices.beancount 的索引和去重写入
+
+索引保存在同目录的 .prices.beancount.index 中, 内容是 (symbol, quote) -> 日期集合,
+以及建立索引时文件的大小、mtime 和内容哈希。价格文件只被追加时(包括被其他工具追加),
+只需要扫描新增的部分; 文件被改写过则全量重建。
+"""
+import os
+import pickle
+import hashlib
+import datetime
+import logging
+
+from beancount.parser import printer
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = ".{filename}.index"
+INDEX_VERSION = 2
+
+
+def _parse_price_line(line):
+    """Returns: (date, symbol, quote) 或 None(不是 price 行)"""
+    parts = line.split()
+    if len(parts) < 5 or parts[1] != "price":
+        return None
+    try:
+        date = datetime.datetime.strptime(parts[0], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+    return date, parts[2], parts[4]
+
+
+def _prefix_digest(fhandler, size):
+    """文件前 size 字节的哈希"""
+    digest = hashlib.sha256()
+    fhandler.seek(0)
+    remaining = size
+    while remaining > 0:
+        chunk = fhandler.read(min(remaining, 1 << 20))
+        if not chunk:
+            break
+        digest.update(chunk)
+        remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+class PriceStore:
+    """
+    带索引的 prices.beancount
+
+    - dates(symbol, quote) / has(...) / missing_dates(...) 每个日期 O(1)
+    - append(price_entries) 跳过文件中已有的 (symbol, quote, date)
+    - compact() 把文件按 (日期, symbol) 排序并去掉重复行
+    """
+
+    def __init__(self, path):
+        self.path = path
+        dirname, basename = os.path.split(path)
+        self.index_path = os.path.join(dirname, INDEX_FILENAME.format(filename=basename))
+        # (symbol, quote) -> set of dates
+        self._index = {}
+        self._size = 0
+        self.last_date = None
+        self._load()
+
+    def _load(self):
+        self._size = 0
+        try:
+            with open(self.index_path, "rb") as fhandler:
+                cached = pickle.load(fhandler)
+        except FileNotFoundError:
+            cached = None
+        except Exception as exc:
+            logger.warning("Ignored broken price index %s: %s", self.index_path, exc)
+            cached = None
+
+        stat = os.stat(self.path)
+        if cached is not None and cached.get("version") == INDEX_VERSION and (
+                cached["size"] <= stat.st_size):
+            # 大小和 mtime 都没变时认为文件没变, 否则比较已索引部分的哈希
+            unchanged = (cached["size"], cached["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns)
+            if not unchanged:
+                with open(self.path, "rb") as fhandler:
+                    unchanged = _prefix_digest(fhandler, cached["size"]) == cached["digest"]
+            if unchanged:
+                self._index = cached["index"]
+                self._size = cached["size"]
+                self.last_date = cached["last_date"]
+                if stat.st_size == self._size:
+                    return
+
+        # 索引不存在或者文件被改写过时 self._size 为 0, 即全量扫描
+        self._scan_from(self._size)
+        self._save()
+
+    def _scan_from(self, offset):
+        if offset == 0:
+            self._index = {}
+            self.last_date = None
+        with open(self.path, "rb") as fhandler:
+            fhandler.seek(offset)
+            for raw_line in fhandler:
+                self._add_to_index(raw_line.decode())
+            self._size = fhandler.tell()
+
+    def _add_to_index(self, line):
+        parsed = _parse_price_line(line)
+        if parsed is None:
+            return False
+        date, symbol, quote = parsed
+        dates = self._index.setdefault((symbol, quote), set())
+        if date in dates:
+            return False
+        dates.add(date)
+        if self.last_date is None or date > self.last_date:
+            self.last_date = date
+        return True
+
+    def _save(self):
+        with open(self.path, "rb") as fhandler:
+            digest = _prefix_digest(fhandler, self._size)
+            mtime_ns = os.fstat(fhandler.fileno()).st_mtime_ns
+        cached = {
+            "version": INDEX_VERSION,
+            "size": self._size,
+            "mtime_ns": mtime_ns,
+            "digest": digest,
+            "last_date": self.last_date,
+            "index": self._index,
+        }
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as fhandler:
+            pickle.dump(cached, fhandler, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+
+    def dates(self, symbol, quote):
+        return self._index.get((symbol, quote), frozenset())
+
+    def has(self, symbol, quote, date):
+        return date in self.dates(symbol, quote)
+
+    def missing_dates(self, symbol, quote, dates):
+        existed = self.dates(symbol, quote)
+        return [date for date in dates if date not in existed]
+
+    def append(self, price_entries, dcontext=None):
+        """
+        追加价格, 跳过文件中或本批次中已有的 (symbol, quote, date)
+
+        Returns:
+            实际写入的 Price 列表
+        """
+        # 先确认文件没有在加载之后被其他工具修改
+        if os.path.getsize(self.path) != self._size:
+            self._load()
+
+        eprinter = printer.EntryPrinter(dcontext)
+        lines = []
+        appended = []
+        for entry in price_entries:
+            line = eprinter(entry)
+            if self._add_to_index(line):
+                lines.append(line)
+                appended.append(entry)
+            else:
+                logger.info(
+                    "Ignored duplicated price: %s %s/%s",
+                    entry.date, entry.currency, entry.amount.currency,
+                )
+        if lines:
+            with open(self.path, "ab+") as fhandler:
+                fhandler.seek(0, os.SEEK_END)
+                if fhandler.tell() > 0:
+                    fhandler.seek(-1, os.SEEK_END)
+                    if fhandler.read(1) != b"\n":
+                        lines.insert(0, "\n")
+                fhandler.write("".join(lines).encode())
+                self._size = fhandler.tell()
+            self._save()
+        return appended
+
+    def compact(self):
+        """
+        按 (日期, symbol, quote) 排序重写价格文件, 同一 (symbol, quote, date)
+        只保留最后出现的一行(连同其后缩进的 metadata 行)。注释等非 price 行按原来的顺序
+        保留在文件开头, 空行被丢弃。
+
+        Returns:
+            (原有 price 行数, 重写后的行数)
+        """
+        latest_lines = {}
+        other_lines = []
+        total = 0
+        last_key = None
+        with open(self.path) as fhandler:
+            for line in fhandler:
+                if not line.endswith("\n"):
+                    line += "\n"
+                parsed = _parse_price_line(line)
+                if parsed is not None:
+                    total += 1
+                    latest_lines[parsed] = line
+                    last_key = parsed
+                elif not line.strip():
+                    last_key = None
+                elif line[0] in " \t" and last_key is not None:
+                    latest_lines[last_key] += line
+                else:
+                    other_lines.append(line)
+                    last_key = None
+        if other_lines:
+            logger.warning(
+                "Kept %d non-price lines at the top of %s", len(other_lines), self.path
+            )
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fhandler:
+            fhandler.writelines(other_lines)
+            for key in sorted(latest_lines):
+                fhandler.write(latest_lines[key])
+        os.replace(tmp_path, self.path)
+
+        self._size = 0
+        self._scan_from(0)
+        self._save()
+        return total, len(latest_lines)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+常驻的本地报表服务, 避免每次生成报表都重新启动解释器、导入 beancount 和加载帐本。
+
+- 帐本保存在内存中, 每个请求前检查 include 的文件, 只重新解析有变化的文件
+- 帐本没有变化时, 相同的请求直接返回上次的结果
+
+接口(format=csv 或 json, 默认 csv):
+    GET /portfolio?date=2019-12-31&horizons=1,5,30
+    GET /portfolio?monthly_since=2019-07-01  每个月末的持仓, 第一列为日期
+    GET /portfolio?dates=2019-12-31,2020-06-30
+    GET /networth?since=2019-10-01&padding=1
+    GET /status
+
+例:
+    ./scripts/report-server.py --port 8765
+    curl -s 'http://127.0.0.1:8765/networth?since=2019-10-01&padding=1' > local/net-worth.csv
+"""
+import io
+import json
+import time
+import datetime
+import logging
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import click
+
+from ledger_loader import IncrementalLoader, get_parse_jobs
+import networth
+import portfolio
+from networth import compute_networth_series, format_row, pad_to_year_end
+from portfolio import DEFAULT_HORIZONS, get_month_ends, iter_portfolio_matrices
+from portfolio import format_row as format_portfolio_row
+from price_index import PriceIndex
+from report_output import CSVWriter, _json_default
+
+
+logger = logging.getLogger()
+
+CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "json": "application/json; charset=utf-8",
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+def parse_date(date_str):
+    try:
+        return datetime.datetime.strptime(date_str.strip(), "%Y-%m-%d").date()
+    except ValueError:
+        raise BadRequest(f"Invalid date: {date_str}")
+
+
+def parse_flag(query, key):
+    return query.get(key, "0").lower() in ("1", "true", "yes")
+
+
+def render_rows(rows, fmt):
+    if fmt == "json":
+        return json.dumps(rows, ensure_ascii=False, default=_json_default)
+    fhandler = io.StringIO()
+    with CSVWriter(fhandler) as writer:
+        writer.write_rows(rows)
+    return fhandler.getvalue()
+
+
+class ReportState:
+    """
+    Attributes:
+        loader: IncrementalLoader
+        responses: {(路径, 参数, 今天): 响应内容}, 帐本重新加载后清空
+    """
+
+    def __init__(self, ledger_file=None):
+        self.loader = IncrementalLoader(ledger_file, jobs=get_parse_jobs())
+        self.responses = {}
+        self.loaded_at = None
+        # {名称: 索引}, 同一次加载的帐本上的所有请求共用, 帐本重新加载后清空
+        self._indexes = {}
+
+    def refresh(self):
+        if self.loader.reload():
+            self.responses.clear()
+            self._indexes.clear()
+            self.loaded_at = datetime.datetime.now()
+
+    def get_index(self, name, build):
+        """第一次用到时用 build(entries, options_map) 构建"""
+        if name not in self._indexes:
+            entries, _, options_map = self.loader.result
+            self._indexes[name] = build(entries, options_map)
+        return self._indexes[name]
+
+    def get_portfolio(self, query, fmt):
+        today = datetime.date.today()
+        asof_date = parse_date(query["date"]) if "date" in query else today
+        try:
+            horizons = [int(dur) for dur in query.get("horizons", "").split(",") if dur.strip()]
+        except ValueError:
+            raise BadRequest(f"Invalid horizons: {query['horizons']}")
+        horizons = horizons or list(DEFAULT_HORIZONS)
+
+        snapshot_dates = set()
+        if query.get("dates"):
+            snapshot_dates.update(
+                parse_date(date_str) for date_str in query["dates"].split(",") if date_str.strip()
+            )
+        if query.get("monthly_since"):
+            snapshot_dates.update(get_month_ends(parse_date(query["monthly_since"]), asof_date))
+        is_long = bool(snapshot_dates)
+        if not is_long:
+            snapshot_dates = {asof_date}
+
+        result = []
+        matrices = iter_portfolio_matrices(
+            snapshot_dates, horizons, ledger=self.loader.result,
+            price_index=self.get_index("price_index", PriceIndex.build),
+            attrs=self.get_index("portfolio_attrs", portfolio.build_attribute_table),
+        )
+        for snapshot_date, rows, _ in matrices:
+            if fmt == "csv":
+                rows = [format_portfolio_row(row) for row in rows]
+            if is_long:
+                result.extend({"日期": snapshot_date, **row} for row in rows)
+            else:
+                result.extend(rows)
+        return result
+
+    def get_networth(self, query, fmt):
+        if "since" in query:
+            since_date = parse_date(query["since"])
+        else:
+            since_date = datetime.date(datetime.date.today().year, 1, 1)
+        end_date = parse_date(query["end"]) if "end" in query else None
+        rows = compute_networth_series(
+            since_date, end_date, use_checkpoint=True, ledger=self.loader.result,
+            price_index=self.get_index("price_index", PriceIndex.build),
+            attrs=self.get_index("networth_attrs", networth.build_attribute_table),
+        )
+        if fmt == "json":
+            return rows
+        rows = [format_row(row) for row in rows]
+        if parse_flag(query, "padding"):
+            rows = list(pad_to_year_end(rows))
+        return rows
+
+    def get_status(self):
+        entries, errors, options_map = self.loader.result
+        return [{
+            "ledger_file": self.loader.ledger_file,
+            "generation": self.loader.generation,
+            "loaded_at": self.loaded_at,
+            "num_entries": len(entries),
+            "num_errors": len(errors),
+            "num_files": len(options_map["include"]),
+        }]
+
+    def handle(self, path, query):
+        """Returns: (content type, 响应内容)"""
+        self.refresh()
+        fmt = query.get("format", "csv")
+        if fmt not in CONTENT_TYPES:
+            raise BadRequest(f"Unknown format: {fmt}")
+        if path == "/status":
+            return CONTENT_TYPES["json"], render_rows(self.get_status(), "json")
+
+        key = (path, tuple(sorted(query.items())), datetime.date.today())
+        if key not in self.responses:
+            if path == "/portfolio":
+                rows = self.get_portfolio(query, fmt)
+            elif path == "/networth":
+                rows = self.get_networth(query, fmt)
+            else:
+                raise NotFound(path)
+            self.responses[key] = render_rows(rows, fmt)
+        return CONTENT_TYPES[fmt], self.responses[key]
+
+
+class ReportHandler(BaseHTTPRequestHandler):
+    # 由 main 设置
+    state = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        start = time.time()
+        try:
+            content_type, body = self.state.handle(url.path.rstrip("/") or "/", query)
+            status = 200
+        except BadRequest as exc:
+            content_type, body, status = "text/plain; charset=utf-8", str(exc), 400
+        except NotFound as exc:
+            content_type, body, status = "text/plain; charset=utf-8", f"Not found: {exc}", 404
+        except Exception as exc:
+            logger.exception("Failed to handle %s", self.path)
+            content_type, body, status = "text/plain; charset=utf-8", str(exc), 500
+
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        logger.info("%s %d in %.3fs", self.path, status, time.time() - start)
+
+    def log_message(self, format, *args):
+        # 请求日志由 do_GET 输出
+        pass
+
+
+@click.command()
+@click.option('--host', default="127.0.0.1", show_default=True)
+@click.option('-p', '--port', default=8765, show_default=True)
+def main(host, port):
+    logging.basicConfig(level=logging.INFO)
+    state = ReportState()
+    state.refresh()
+    ReportHandler.state = state
+    server = HTTPServer((host, port), ReportHandler)
+    logger.info("Serving reports on http://%s:%d", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
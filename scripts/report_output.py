@@ -0,0 +1,270 @@
+"""
+报表的输出
+
+各 writer 逐行写入, 不会把整个报表先拼成字符串。CSV 输出格式化后的字符串,
+和之前 print 出的内容完全一致; JSON Lines、SQLite、Parquet 输出带类型的值
+(数字、日期), 方便直接导入分析工具而不需要再解析字符串。
+
+    with open_writer("sqlite", "local/networth.db", table="networth") as writer:
+        for row in rows:
+            writer.write(row)
+"""
+import sys
+import csv
+import json
+import decimal
+import datetime
+import sqlite3
+
+import instrument
+
+
+FORMATS = ("csv", "jsonl", "sqlite", "parquet")
+# Parquet 每攒够这么多行写一个 row group
+PARQUET_BATCH_SIZE = 4096
+
+
+def to_typed(value):
+    """Decimal 转成 float, 其余原样返回"""
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+class RowWriter:
+    """
+    第一行决定列名, 之后每行的 key 必须相同
+
+    Args:
+        formatter: 写入前对每行调用, 比如 networth.format_row
+        close_file: close 时是否关闭 fhandler
+    """
+    name = None
+
+    def __init__(self, fhandler=None, formatter=None, close_file=False):
+        self.fhandler = fhandler
+        self.formatter = formatter
+        self.close_file = close_file
+        self.columns = None
+        self.num_rows = 0
+
+    def write(self, row):
+        with instrument.stage(f"output_{self.name}"):
+            if self.formatter is not None:
+                row = self.formatter(row)
+            if self.columns is None:
+                self.columns = list(row.keys())
+                self._open(row)
+            self._write(row)
+            self.num_rows += 1
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def _open(self, first_row):
+        pass
+
+    def _write(self, row):
+        raise NotImplementedError
+
+    def close(self):
+        if self.fhandler is None:
+            return
+        if self.close_file:
+            self.fhandler.close()
+        else:
+            self.fhandler.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CSVWriter(RowWriter):
+    """
+    行之间用 \\r\\n 分隔, 最后一行以 \\n 结尾, 和之前 print(StringIO.getvalue().strip())
+    的输出相同。transpose 时按列缓存值, 最后把每一列写成一行。
+    """
+    name = "csv"
+
+    def __init__(self, fhandler=None, formatter=None, close_file=False, transpose=False):
+        super().__init__(fhandler or sys.stdout, formatter, close_file)
+        self.transpose = transpose
+        self._writer = csv.writer(self.fhandler, lineterminator="")
+        self._transposed = None
+        self._is_first_line = True
+
+    def _writerow(self, values):
+        if not self._is_first_line:
+            self.fhandler.write("\r\n")
+        self._writer.writerow(values)
+        self._is_first_line = False
+
+    def _open(self, first_row):
+        if self.transpose:
+            self._transposed = [[column] for column in self.columns]
+        else:
+            self._writerow(self.columns)
+
+    def _write(self, row):
+        if self.transpose:
+            for values, column in zip(self._transposed, self.columns):
+                values.append(row[column])
+        else:
+            self._writerow([row[column] for column in self.columns])
+
+    def close(self):
+        if self._transposed is not None:
+            for values in self._transposed:
+                self._writerow(values)
+        if self.columns is not None:
+            self.fhandler.write("\n")
+        super().close()
+
+
+def _json_default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
+
+
+class JSONLinesWriter(RowWriter):
+    name = "jsonl"
+
+    def __init__(self, fhandler=None, formatter=None, close_file=False):
+        super().__init__(fhandler or sys.stdout, formatter, close_file)
+
+    def _write(self, row):
+        self.fhandler.write(json.dumps(row, ensure_ascii=False, default=_json_default))
+        self.fhandler.write("\n")
+
+
+def _sqlite_type(value):
+    # 为空时不声明类型, 否则 TEXT 类型的列会把之后的数字转成字符串
+    if value is None:
+        return ""
+    if isinstance(value, int):
+        return "INTEGER"
+    if isinstance(value, (float, decimal.Decimal)):
+        return "REAL"
+    return "TEXT"
+
+
+class SQLiteWriter(RowWriter):
+    """写到 path 中的 table 表, 表已存在时先删除。列的类型由第一行的值决定"""
+    name = "sqlite"
+
+    def __init__(self, path, table, formatter=None):
+        super().__init__(None, formatter)
+        self.path = path
+        self.table = table
+        self._conn = sqlite3.connect(path)
+        self._insert_sql = None
+
+    def _open(self, first_row):
+        columns_sql = ", ".join(
+            '"{}" {}'.format(column, _sqlite_type(first_row[column])).rstrip()
+            for column in self.columns
+        )
+        self._conn.execute(f'DROP TABLE IF EXISTS "{self.table}"')
+        self._conn.execute(f'CREATE TABLE "{self.table}" ({columns_sql})')
+        self._insert_sql = 'INSERT INTO "{}" VALUES ({})'.format(
+            self.table, ", ".join("?" * len(self.columns))
+        )
+
+    def _write(self, row):
+        values = []
+        for column in self.columns:
+            value = to_typed(row[column])
+            if isinstance(value, datetime.date):
+                value = value.isoformat()
+            values.append(value)
+        self._conn.execute(self._insert_sql, values)
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+class ParquetWriter(RowWriter):
+    """按 PARQUET_BATCH_SIZE 行一个 row group 写入, 需要安装 pyarrow"""
+    name = "parquet"
+
+    def __init__(self, path, formatter=None):
+        super().__init__(None, formatter)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet output requires pyarrow, run `pip install pyarrow`")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = path
+        self._batch = []
+        self._writer = None
+        self._schema = None
+
+    def _write(self, row):
+        self._batch.append([to_typed(row[column]) for column in self.columns])
+        if len(self._batch) >= PARQUET_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        arrays = [list(values) for values in zip(*self._batch)]
+        if self._schema is None:
+            # 第一批中整列为空的按字符串处理
+            table = self._pa.table(dict(zip(self.columns, arrays)))
+            self._schema = self._pa.schema([
+                self._pa.field(field.name, self._pa.string())
+                if self._pa.types.is_null(field.type) else field
+                for field in table.schema
+            ])
+        for idx, field in enumerate(self._schema):
+            if self._pa.types.is_string(field.type):
+                arrays[idx] = [None if value is None else str(value) for value in arrays[idx]]
+        table = self._pa.Table.from_arrays(
+            [self._pa.array(values, type=field.type)
+             for values, field in zip(arrays, self._schema)],
+            schema=self._schema,
+        )
+        if self._writer is None:
+            self._writer = self._pq.ParquetWriter(self.path, self._schema)
+        self._writer.write_table(table)
+        self._batch = []
+
+    def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+
+
+def open_writer(fmt, path=None, formatter=None, transpose=False, table="report"):
+    """
+    Args:
+        fmt: FORMATS 之一
+        path: csv、jsonl 默认写到 stdout; sqlite、parquet 必须指定
+        formatter: 只用于 csv, 其他格式写入未格式化的值
+        transpose: 只用于 csv
+        table: sqlite 的表名
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown output format {fmt}, choose from {FORMATS}")
+    if fmt in ("sqlite", "parquet") and path is None:
+        raise ValueError(f"Output path is required for {fmt}")
+
+    if fmt == "sqlite":
+        return SQLiteWriter(path, table)
+    if fmt == "parquet":
+        return ParquetWriter(path)
+
+    fhandler = open(path, "w", newline="") if path else None
+    if fmt == "csv":
+        return CSVWriter(fhandler, formatter, fhandler is not None, transpose)
+    return JSONLinesWriter(fhandler, close_file=fhandler is not None)
@@ -0,0 +1,220 @@
+"""
+生成用于性能测试的模拟帐本
+
+和 ledger/ 中的帐本使用相同的约定: 账户在 account.beancount 中带 name,
+sunk/nondisposable 标记; commodity.beancount 中每个标的带 name、asset-class、
+asset-subclass。规模由年数、标的数、每日报价密度和每日交易数决定。
+
+为了满足净值计算中"周末没有投资盈亏"的检查, 报价和买入只发生在工作日,
+买入价等于当日报价。
+
+交易按 daily_split 拆分成每年、每月或每天一个文件, 都通过 daily/*.beancount 引入。
+"""
+import os
+import random
+import datetime
+
+
+START_DATE = datetime.date(2020, 1, 1)
+# daily_split -> 交易文件名的日期格式
+DAILY_FILENAME_FORMATS = {
+    "year": "%Y",
+    "month": "%Y-%m",
+    "day": "%Y-%m-%d",
+}
+# (asset-class, asset-subclass, 报价货币), 需要在 portfolio.sort_key 的排序列表中
+COMMODITY_KINDS = [
+    ("股权", "A股", "CNY"),
+    ("股权", "指数基金", "CNY"),
+    ("股权", "美股", "USD"),
+    ("债权", "债券基金", "CNY"),
+    ("另类", "加密货币", "USD"),
+]
+EXPENSE_ACCOUNTS = [
+    "Expenses:Food:Meals",
+    "Expenses:Transport:Public",
+    "Expenses:Home:Groceries",
+    "Expenses:Leisure:Media",
+]
+
+MAIN = """\
+option "title" "Synthetic"
+option "inferred_tolerance_default" "*:0.001"
+option "operating_currency" "CNY"
+option "operating_currency" "USD"
+
+include "account.beancount"
+include "commodity.beancount"
+include "prices.beancount"
+include "daily/*.beancount"
+"""
+
+ACCOUNTS = """\
+2000-01-01 open Equity:Openings-Balance
+2000-01-01 open Income:Salary
+2000-01-01 open Income:Trade:PnL
+2000-01-01 open Expenses:Trade:Fee
+{expense_accounts}
+2000-01-01 open Assets:Bank:Saving
+  name: "储蓄卡"
+2000-01-01 open Assets:Broker:Cash
+  name: "证券账户现金"
+2000-01-01 open Assets:Broker:Positions
+  name: "证券账户持仓"
+2000-01-01 open Assets:Deposit:Rent
+  name: "房租押金"
+  nondisposable: 1
+2000-01-01 open Assets:PrePayments:Rent
+  name: "预付房租"
+  sunk: 1
+2000-01-01 open Liabilities:CreditCard
+  name: "信用卡"
+"""
+
+CASH_COMMODITIES = """\
+2000-01-01 commodity CNY
+  name: "人民币"
+  asset-class: "现金"
+  asset-subclass: "本币"
+2000-01-01 commodity USD
+  name: "美元"
+  asset-class: "现金"
+  asset-subclass: "外汇"
+"""
+
+
+class SyntheticLedger:
+    """
+    Attributes:
+        years: 历史年数
+        num_commodities: 标的数
+        price_density: 每个标的在每个工作日有报价的概率
+        txns_per_day: 每天的消费交易数
+        daily_split: 交易文件按 year、month 或 day 拆分
+    """
+
+    def __init__(self, years=1, num_commodities=20, price_density=1.0, txns_per_day=5, seed=0,
+                 daily_split="year"):
+        if daily_split not in DAILY_FILENAME_FORMATS:
+            raise ValueError(f"Unknown daily_split {daily_split}")
+        self.years = years
+        self.num_commodities = num_commodities
+        self.price_density = price_density
+        self.txns_per_day = txns_per_day
+        self.seed = seed
+        self.daily_split = daily_split
+        self.start_date = START_DATE
+        self.end_date = START_DATE + datetime.timedelta(days=int(365 * years) - 1)
+
+    @property
+    def key(self):
+        key = (
+            f"years={self.years},commodities={self.num_commodities},"
+            f"price_density={self.price_density},txns_per_day={self.txns_per_day}"
+        )
+        # 默认的按年拆分不出现在 key 中, 和之前保存的 baseline 保持一致
+        if self.daily_split != "year":
+            key += f",daily_split={self.daily_split}"
+        return key
+
+    def iter_dates(self):
+        curr_date = self.start_date
+        while curr_date <= self.end_date:
+            yield curr_date
+            curr_date += datetime.timedelta(days=1)
+
+    def get_commodities(self):
+        """Returns: [(代号, asset-class, asset-subclass, 报价货币)]"""
+        return [
+            (f"SYM{idx:04d}",) + COMMODITY_KINDS[idx % len(COMMODITY_KINDS)]
+            for idx in range(self.num_commodities)
+        ]
+
+    def write(self, ledger_dir):
+        """写到 ledger_dir 下, 返回 main.beancount 的路径"""
+        rng = random.Random(self.seed)
+        os.makedirs(os.path.join(ledger_dir, "daily"), exist_ok=True)
+        with open(os.path.join(ledger_dir, "main.beancount"), "w") as fhandler:
+            fhandler.write(MAIN)
+        with open(os.path.join(ledger_dir, "account.beancount"), "w") as fhandler:
+            fhandler.write(ACCOUNTS.format(expense_accounts="\n".join(
+                f"2000-01-01 open {account}" for account in EXPENSE_ACCOUNTS
+            )))
+
+        commodities = self.get_commodities()
+        with open(os.path.join(ledger_dir, "commodity.beancount"), "w") as fhandler:
+            fhandler.write(CASH_COMMODITIES)
+            for symbol, asset_class, asset_subclass, _ in commodities:
+                fhandler.write(
+                    f'2000-01-01 commodity {symbol}\n'
+                    f'  name: "标的{symbol}"\n'
+                    f'  asset-class: "{asset_class}"\n'
+                    f'  asset-subclass: "{asset_subclass}"\n'
+                )
+
+        prices = {symbol: rng.uniform(1, 500) for symbol, _, _, _ in commodities}
+        usd_rate = 7.0
+        prices_file = open(os.path.join(ledger_dir, "prices.beancount"), "w")
+        filename_format = DAILY_FILENAME_FORMATS[self.daily_split]
+        daily_file = None
+        for curr_date in self.iter_dates():
+            # 日期是递增的, 同一个文件中的日期是连续的
+            daily_filename = os.path.join(
+                ledger_dir, "daily", curr_date.strftime(filename_format) + ".beancount"
+            )
+            if daily_file is None or daily_file.name != daily_filename:
+                if daily_file is not None:
+                    daily_file.close()
+                daily_file = open(daily_filename, "w")
+            is_weekday = curr_date.weekday() < 5
+
+            if is_weekday:
+                usd_rate *= 1 + rng.gauss(0, 0.002)
+                prices_file.write(f"{curr_date} price USD {usd_rate:.6f} CNY\n")
+                for symbol, _, _, quote in commodities:
+                    if curr_date != self.start_date and rng.random() >= self.price_density:
+                        continue
+                    prices[symbol] *= 1 + rng.gauss(0, 0.01)
+                    prices_file.write(f"{curr_date} price {symbol} {prices[symbol]:.4f} {quote}\n")
+
+            if curr_date == self.start_date:
+                daily_file.write(self._format_openings(curr_date, commodities, prices))
+            if curr_date.day == 1:
+                daily_file.write(
+                    f'{curr_date} * "工资"\n'
+                    f'  Assets:Bank:Saving 30000 CNY\n'
+                    f'  Income:Salary -30000 CNY\n\n'
+                )
+            for _ in range(self.txns_per_day):
+                amount = rng.randint(100, 50000) / 100
+                daily_file.write(
+                    f'{curr_date} * "消费"\n'
+                    f'  card: "9999"\n'
+                    f'  Liabilities:CreditCard -{amount:.2f} CNY\n'
+                    f'  {rng.choice(EXPENSE_ACCOUNTS)} {amount:.2f} CNY\n\n'
+                )
+            if is_weekday and curr_date != self.start_date and rng.random() < 0.2:
+                symbol, _, _, quote = rng.choice(commodities)
+                daily_file.write(
+                    f'{curr_date} * "买入 {symbol}"\n'
+                    f'  Assets:Broker:Positions 10 {symbol} {{{prices[symbol]:.4f} {quote}}}\n'
+                    f'  Assets:Broker:Cash\n'
+                    f'  Expenses:Trade:Fee 1 {quote}\n\n'
+                )
+        prices_file.close()
+        daily_file.close()
+        return os.path.join(ledger_dir, "main.beancount")
+
+    def _format_openings(self, curr_date, commodities, prices):
+        lines = [
+            f'{curr_date} * "期初余额"',
+            '  Assets:Bank:Saving 200000 CNY',
+            '  Assets:Broker:Cash 10000000 CNY',
+            '  Assets:Broker:Cash 1000000 USD',
+            '  Assets:Deposit:Rent 10000 CNY',
+            '  Assets:PrePayments:Rent 5000 CNY',
+        ]
+        for symbol, _, _, quote in commodities:
+            lines.append(f'  Assets:Broker:Positions 100 {symbol} {{{prices[symbol]:.4f} {quote}}}')
+        lines.append('  Equity:Openings-Balance')
+        return "\n".join(lines) + "\n\n"
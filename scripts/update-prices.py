@@ -1,12 +1,47 @@
 #!/usr/bin/env python3
+"""
+拉取各持仓标的的价格, 追加到 ledger/prices.beancount, 当日价格写入
+ledger/latest-prices.beancount。
+
+和逐日调用 bean-price 相比: 帐本只加载一次, 所有 (标的, 日期) 通过有界线程池并发
+拉取, 每个价格源有单独的并发上限和重试, 结果去重后一次性写入文件。
+"""
 import os
 import sys
+import time
 import datetime
+import logging
+import threading
+from concurrent import futures
+
+import click
+from beancount.parser import printer
+from beancount.prices import price
+
+import instrument
+from ledger_loader import load_ledger
+from price_cache import get_cache_file, get_precisions, ingest
+from price_store import PriceStore
 
 
 ONE_DAY = datetime.timedelta(days=1)
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 PRICE_PATH = os.path.join(ROOT_DIR, "ledger", "prices.beancount")
+LATEST_PRICE_PATH = os.path.join(ROOT_DIR, "ledger", "latest-prices.beancount")
+SOURCES_DIR = os.path.join(ROOT_DIR, "sources")
+
+MAX_WORKERS = 8
+# 每个价格源同时进行的请求数上限, 未列出的用 DEFAULT_SOURCE_CONCURRENCY
+SOURCE_CONCURRENCY = {
+    "xueqiu": 2,
+    "eastmoney": 4,
+    "exchangeratesapi": 2,
+}
+DEFAULT_SOURCE_CONCURRENCY = 2
+RETRIES = 3
+RETRY_BACKOFF = 1.0
+
+logger = logging.getLogger()
 
 
 def yield_date_range(start_date, end_date):
@@ -17,44 +52,236 @@ def yield_date_range(start_date, end_date):
         curr_date += ONE_DAY
 
 
-def main(argv):
-    today_only = False
-    if len(argv) > 1 and argv[1] == "--today-only":
-        today_only = True
+def get_source_name(module):
+    return module.__name__.rsplit(".", 1)[-1]
 
-    with open(PRICE_PATH, "rb") as fhandler:
-        fhandler.seek(-1000, os.SEEK_END)
-        last_line = fhandler.readlines()[-1]
-        last_date_str = last_line.split()[0].decode()
-        last_date = datetime.datetime.strptime(last_date_str, "%Y-%m-%d")
 
-    print("echo > ledger/latest-prices.beancount")
-    # 部分香港基金的净值更新时间比较慢，所以此处不用 last_date + 1
-    start_date = last_date
-    utc_now = datetime.datetime.utcnow()
-    end_date = utc_now
-    for curr_date in yield_date_range(start_date, end_date):
-        if curr_date.date() == utc_now.date():
-            suffix = f"| grep {curr_date:%Y-%m-%d} > ledger/latest-prices.beancount"
-        else:
-            suffix = f">> ledger/prices.beancount"
-        if not today_only or curr_date.date() == utc_now.date():
-            print(
-                f"PYTHONPATH=`pwd`/sources bean-price --no-cache -d {curr_date:%Y-%m-%d}"
-                f" ledger/main.beancount {suffix};"
+class SourceStats:
+    """按价格源统计请求次数、未抛异常的次数和耗时"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, source_name, elapsed, ok):
+        with self._lock:
+            stat = self._stats.setdefault(
+                source_name, {"calls": 0, "ok": 0, "elapsed": 0.0, "max": 0.0}
+            )
+            stat["calls"] += 1
+            stat["ok"] += int(ok)
+            stat["elapsed"] += elapsed
+            stat["max"] = max(stat["max"], elapsed)
+
+    def log_summary(self, wall_time):
+        for source_name, stat in sorted(self._stats.items()):
+            logger.info(
+                "%s: %d calls, %d ok, mean %.0fms, max %.0fms, %.1f calls/s",
+                source_name, stat["calls"], stat["ok"],
+                1000 * stat["elapsed"] / stat["calls"], 1000 * stat["max"],
+                stat["calls"] / wall_time if wall_time else 0,
+            )
+
+
+class PriceFetcher:
+    """
+    在线程池中拉取价格。每个价格源有独立的信号量限制并发, 失败时指数退避重试,
+    一个价格源最终失败后再尝试 price: 中列出的下一个价格源。
+    """
+
+    def __init__(self, retries=RETRIES):
+        self.retries = retries
+        self.stats = SourceStats()
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _get_semaphore(self, source_name):
+        with self._lock:
+            if source_name not in self._semaphores:
+                limit = SOURCE_CONCURRENCY.get(source_name, DEFAULT_SOURCE_CONCURRENCY)
+                self._semaphores[source_name] = threading.BoundedSemaphore(limit)
+            return self._semaphores[source_name]
+
+    def _call(self, source_name, func, *args):
+        for attempt in range(self.retries):
+            with self._get_semaphore(source_name):
+                start = time.time()
+                try:
+                    with instrument.stage(f"source_call[{source_name}]"):
+                        result = func(*args)
+                except Exception as exc:
+                    self.stats.record(source_name, time.time() - start, False)
+                    logger.warning(
+                        "%s failed (attempt %d/%d): %r",
+                        source_name, attempt + 1, self.retries, exc,
+                    )
+                else:
+                    self.stats.record(source_name, time.time() - start, True)
+                    return result
+            if attempt + 1 < self.retries:
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+        return None
+
+    def prefetch(self, module, tickers, start_date, end_date):
+        """
+        支持区间拉取的价格源先一次取回整个区间, 后续逐日查询直接读内存
+
+        Args:
+            tickers: BATCH_PREFETCH 的价格源为 ticker 列表, 其他价格源为单个 ticker
+        """
+        self._call(get_source_name(module), module.Source().prefetch, tickers, start_date, end_date)
+
+    def fetch(self, dprice):
+        for psource in dprice.sources:
+            single_source_job = dprice._replace(sources=[psource])
+            entry = self._call(
+                get_source_name(psource.module), price.fetch_price, single_source_job
             )
+            if entry is not None:
+                return entry
+        logger.error("Could not fetch for job: %s", price.format_dated_price_str(dprice))
+        return None
 
 
-def get_existed_symbol_dates(target_symbol):
-    existed_date = set()
-    with open(PRICE_PATH) as fhandler:
-        for line in fhandler.readlines():
-            dt, _, symbol, px, unit = line.split()
-            if symbol != target_symbol:
+def get_price_jobs(entries, dates, store=None):
+    """store 不为 None 时跳过 prices.beancount 中已有的 (标的, 日期)"""
+    jobs = []
+    for date in dates:
+        for dprice in price.get_price_jobs_at_date(entries, date):
+            if store is not None and store.has(dprice.base, dprice.quote, date):
                 continue
-            existed_date.add(dt)
-    return existed_date
+            jobs.append(dprice)
+    return jobs
+
+
+def prefetch_sources(executor, fetcher, jobs, start_date, end_date):
+    tickers_by_module = {}
+    for dprice in jobs:
+        # 只预取首选价格源, 备用价格源仍按需逐日查询
+        psource = dprice.sources[0]
+        if hasattr(psource.module.Source, "prefetch"):
+            tickers_by_module.setdefault(psource.module, set()).add(psource.symbol)
+
+    pending = []
+    for module, tickers in tickers_by_module.items():
+        if getattr(module.Source, "BATCH_PREFETCH", False):
+            pending.append(
+                executor.submit(fetcher.prefetch, module, sorted(tickers), start_date, end_date)
+            )
+            continue
+        # 每个 ticker 一个任务, 同一价格源的并发数由信号量限制
+        pending.extend(
+            executor.submit(fetcher.prefetch, module, ticker, start_date, end_date)
+            for ticker in sorted(tickers)
+        )
+    futures.wait(pending)
+
+
+def dedup_prices(price_entries, existing_entries):
+    seen = set()
+    result = []
+    for entry in price_entries:
+        key = (entry.date, entry.currency, entry.amount.currency)
+        if key in seen:
+            continue
+        seen.add(key)
+        result.append(entry)
+    result, ignored = price.filter_redundant_prices(result, existing_entries)
+    for entry in ignored:
+        logger.info("Ignored existing price: %s %s", entry.date, entry.currency)
+    return sorted(result, key=lambda entry: (entry.date, entry.currency))
+
+
+def refresh_price_cache(entries):
+    """价格文件有变化后重新生成已有的价格缓存, 没有缓存时不生成"""
+    if os.path.exists(get_cache_file(PRICE_PATH)):
+        try:
+            ingest(PRICE_PATH, get_precisions(entries))
+        except ValueError as exc:
+            # 价格已经写入, 过期的缓存在加载时会被忽略
+            logger.warning("Failed to refresh the price cache: %s", exc)
+
+
+def write_prices(path, price_entries, dcontext, mode):
+    with open(path, mode) as fhandler:
+        if price_entries:
+            printer.print_entries(price_entries, dcontext=dcontext, file=fhandler)
+
+
+@click.command()
+@click.option('--today-only', is_flag=True, default=False)
+@click.option('--workers', default=MAX_WORKERS, show_default=True)
+@click.option('--retries', default=RETRIES, show_default=True)
+@click.option('--compact', is_flag=True, default=False,
+              help="只把 prices.beancount 排序去重后重写, 不拉取价格")
+@click.option('--no-http-cache', is_flag=True, default=False,
+              help="不读写价格源的 HTTP 响应缓存(见 sources/http_source.py)")
+@click.option('--profile', default=None,
+              help="逗号分隔的 timing,cprofile,tracemalloc, 默认读取环境变量 BEAN_PROFILE")
+@click.option('--profile-trace', default=None, type=click.Path(),
+              help="把各阶段的调用写成 Chrome trace 格式的 JSON")
+def main(today_only, workers, retries, compact, no_http_cache, profile, profile_trace):
+    logging.basicConfig(level=logging.INFO)
+    instrument.enable(profile, profile_trace)
+    sys.path.insert(0, SOURCES_DIR)
+    import http_source
+    if no_http_cache:
+        http_source.set_cache_dir(None)
+
+    store = PriceStore(PRICE_PATH)
+    if compact:
+        total, kept = store.compact()
+        logger.info("Compacted %s: %d -> %d prices", PRICE_PATH, total, kept)
+        refresh_price_cache(load_ledger(use_price_cache=False)[0])
+        return
+
+    # 去重需要帐本中已有的 Price, 不使用价格缓存
+    entries, _, options_map = load_ledger(use_price_cache=False)
+    today = datetime.datetime.utcnow().date()
+    # 部分香港基金的净值更新时间比较慢，所以此处不用 last_date + 1
+    start_date = today if today_only else (store.last_date or today)
+    dates = list(yield_date_range(start_date, today))
+    # 当日价格写到 latest-prices.beancount, 不能因为 prices.beancount 中已有而跳过
+    with instrument.stage("price_jobs"):
+        jobs = get_price_jobs(entries, [dt for dt in dates if dt != today], store)
+        jobs += get_price_jobs(entries, [dt for dt in dates if dt == today])
+    logger.info("%d price jobs from %s to %s", len(jobs), start_date, today)
+
+    wall_start = time.time()
+    fetcher = PriceFetcher(retries)
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        if dates:
+            with instrument.stage("prefetch"):
+                prefetch_sources(executor, fetcher, jobs, dates[0], dates[-1])
+        with instrument.stage("fetch"):
+            fetched = [
+                (dprice, entry)
+                for dprice, entry in zip(jobs, executor.map(fetcher.fetch, jobs))
+                if entry is not None
+            ]
+    wall_time = time.time() - wall_start
+    fetcher.stats.log_summary(wall_time)
+    http_source.log_summary()
+    logger.info("Fetched %d prices for %d jobs in %.1fs", len(fetched), len(jobs), wall_time)
+
+    # 当日价格单独写到 latest-prices.beancount, 只保留报价日期为当日的
+    latest_prices = [
+        entry for dprice, entry in fetched
+        if dprice.date == today and entry.date == today
+    ]
+    history_prices = [entry for dprice, entry in fetched if dprice.date != today]
+
+    dcontext = options_map["dcontext"]
+    with instrument.stage("write_prices"):
+        history_prices = store.append(dedup_prices(history_prices, entries), dcontext)
+        write_prices(LATEST_PRICE_PATH, dedup_prices(latest_prices, []), dcontext, "w")
+    if history_prices:
+        refresh_price_cache(entries)
+    logger.info(
+        "Appended %d prices to %s, wrote %d prices to %s",
+        len(history_prices), PRICE_PATH, len(latest_prices), LATEST_PRICE_PATH,
+    )
 
 
 if __name__ == "__main__":
-    main(sys.argv)
+    main()
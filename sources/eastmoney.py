@@ -2,7 +2,6 @@ import time
 import re
 import logging
 import json
-import requests
 from dateutil import tz,utils
 from datetime import datetime
 from urllib import error
@@ -12,8 +11,18 @@ from beancount.core.number import D
 from beancount.prices import source
 from beancount.utils import net_utils
 
+from http_source import SourceSession, ttl_for_date
+
 
 CN_TZ = tz.gettz("Asia/Shanghai")
+# 区间查询时每页的记录数
+PAGE_SIZE = 20
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
 
 
 class Source(source.Source):
@@ -22,48 +31,100 @@ class Source(source.Source):
     注意：需要在雪球标的前加F(方便区分基金与其他标的)
 
     PYTHONPATH=`pwd`/sources bean-price --no-cache -e CNY:eastmoney/F110011
+
+    回填多个日期时先调用 prefetch(ticker, start_date, end_date) 分页拉取整个区间,
+    之后同一进程内对区间内日期的 get_historical_price 直接读内存。
     """
 
-    http = requests.Session()
+    http = SourceSession("eastmoney")
+    api_url = "https://api.fund.eastmoney.com/f10/lsjz"
+
+    # fund -> {date: SourcePrice}
+    _nav_cache = {}
+    # fund -> [(start_date, end_date), ...] 已经完整拉取过的区间
+    _fetched_ranges = {}
 
     def get_historical_price(self, ticker, date):
+        cached, price = self._lookup_cache(ticker, _to_date(date))
+        if cached:
+            return price
         return self._get_daily_price(ticker, date)
 
     def get_latest_price(self, ticker):
         return self._get_daily_price(ticker)
 
-    def _get_daily_price(self, fund, date=None):
+    def prefetch(self, ticker, start_date, end_date):
+        """
+        分页拉取 [start_date, end_date] 区间内的全部净值并缓存
+
+        Returns:
+            按日期排序的 SourcePrice 列表
+        """
+        start_date, end_date = _to_date(start_date), _to_date(end_date)
+        fund_cache = self._nav_cache.setdefault(ticker, {})
+        page_index = 1
+        while True:
+            result = self._request_lsjz(ticker, start_date, end_date, page_index, PAGE_SIZE)
+            records = result["Data"]["LSJZList"]
+            for record in records:
+                price = self._parse_record(record)
+                if price is not None:
+                    fund_cache[price.time.date()] = price
+            if not records or page_index * PAGE_SIZE >= result["TotalCount"]:
+                break
+            page_index += 1
+
+        self._fetched_ranges.setdefault(ticker, []).append((start_date, end_date))
+        return [
+            price for date, price in sorted(fund_cache.items())
+            if start_date <= date <= end_date
+        ]
+
+    def _lookup_cache(self, ticker, date):
+        """Returns: (是否在已拉取区间内, SourcePrice 或 None)"""
+        for start_date, end_date in self._fetched_ranges.get(ticker, ()):
+            if start_date <= date <= end_date:
+                return True, self._nav_cache[ticker].get(date)
+        return False, None
+
+    def _request_lsjz(self, fund, start_date, end_date, page_index, page_size):
         assert fund[0] == "F"
         params = {
             "callback": "thecallback",
             "fundCode": fund[1:],
-            "pageIndex": 1,
-            "pageSize": 1,
+            "pageIndex": page_index,
+            "pageSize": page_size,
 
         }
-        if date is not None:
-            dt_str = date.strftime("%Y-%m-%d")
+        if start_date is not None:
             params.update({
-                "startDate": dt_str,
-                "endDate": dt_str,
+                "startDate": start_date.strftime("%Y-%m-%d"),
+                "endDate": end_date.strftime("%Y-%m-%d"),
             })
         resp = self.http.get(
-            "https://api.fund.eastmoney.com/f10/lsjz",
+            self.api_url,
             params=params,
             headers={
                 "Referer": "http://fundf10.eastmoney.com/jjjz_{fund}.html"
-            }
+            },
+            ttl=ttl_for_date(end_date),
         )
         assert resp.status_code == 200, resp.text
         result_str = next(re.finditer("thecallback\((.*)\)", resp.text)).groups()[0]
-        result = json.loads(result_str)
+        return json.loads(result_str)
+
+    def _parse_record(self, record):
+        if not record["DWJZ"]:
+            return None
+        nav = D(record["DWJZ"]).quantize(D('1.000000000000000000'))
+        trade_date = datetime.strptime(record["FSRQ"], "%Y-%m-%d")
+        trade_date = utils.default_tzinfo(trade_date, CN_TZ)
+        return source.SourcePrice(nav, trade_date, 'CNY')
+
+    def _get_daily_price(self, fund, date=None):
+        result = self._request_lsjz(fund, date, date, 1, 1)
         records = result["Data"]["LSJZList"]
         if len(records) == 0:
             return
 
-        trade_date = records[0]["FSRQ"]
-        nav = D(records[0]["DWJZ"]).quantize(D('1.000000000000000000'))
-        trade_date = datetime.strptime(trade_date, "%Y-%m-%d")
-        trade_date = utils.default_tzinfo(trade_date, CN_TZ)
-
-        return source.SourcePrice(nav, trade_date, 'CNY')
+        return self._parse_record(records[0])
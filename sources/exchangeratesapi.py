@@ -1,48 +1,136 @@
 import time
 import json
-import requests
+import bisect
 from dateutil import tz,utils
 from datetime import datetime
 
 from beancount.core.number import D
 from beancount.prices import source
 
+from http_source import SourceSession, ttl_for_date
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
 
 class Source(source.Source):
     """
     PYTHONPATH=`pwd`/sources bean-price --no-cache -e CNY:exchangeratesapi/USDCNY
+
+    回填多个日期时先调用 prefetch(tickers, start_date, end_date), 每个 base 货币只发
+    一次 history 请求取回区间内所有 symbol 的汇率, 之后同一进程内对区间内日期的
+    get_historical_price 直接读内存。
     """
 
-    http = requests.Session()
+    http = SourceSession("exchangeratesapi")
+    api_url = "https://api.exchangeratesapi.io/"
+    # prefetch 接受 ticker 列表, 同一 base 的多个 symbol 合并成一次请求
+    BATCH_PREFETCH = True
+
+    # (base, symbol) -> {date: rate}
+    _rate_table = {}
+    # (base, symbol) -> _rate_table 中排好序的日期, 用于 bisect
+    _rate_dates = {}
+    # (base, symbol) -> [(start_date, end_date), ...] 已经完整拉取过的区间
+    _fetched_ranges = {}
 
     def get_historical_price(self, ticker, date=None):
+        if date is not None:
+            cached, price = self._lookup_cache(ticker, _to_date(date))
+            if cached:
+                return price
         return self._get_daily_price(ticker, date)
 
     def get_latest_price(self, ticker):
         return self._get_daily_price(ticker)
 
-    def _get_daily_price(self, ticker, date=None):
+    def prefetch(self, tickers, start_date, end_date):
+        """
+        按 base 货币分组, 每组用一次 history 请求拉取 [start_date, end_date] 的汇率
+
+        Args:
+            tickers: 形如 USDCNY 的 ticker 列表
+        """
+        start_date, end_date = _to_date(start_date), _to_date(end_date)
+        symbols_by_base = {}
+        for ticker in tickers:
+            base, symbol = self._parse_ticker(ticker)
+            symbols_by_base.setdefault(base, set()).add(symbol)
+
+        for base, symbols in symbols_by_base.items():
+            resp = self.http.get(
+                self.api_url + "history",
+                params={
+                    "start_at": start_date.strftime("%Y-%m-%d"),
+                    "end_at": end_date.strftime("%Y-%m-%d"),
+                    "symbols": ",".join(sorted(symbols)),
+                    "base": base,
+                },
+                ttl=ttl_for_date(end_date),
+            )
+            result = resp.json()
+            for date_str, rates in result["rates"].items():
+                date = datetime.strptime(date_str, "%Y-%m-%d").date()
+                for symbol, rate in rates.items():
+                    self._rate_table.setdefault((base, symbol), {})[date] = rate
+
+            for symbol in symbols:
+                base_symbol = (base, symbol)
+                self._rate_dates[base_symbol] = sorted(self._rate_table.get(base_symbol, ()))
+                self._fetched_ranges.setdefault(base_symbol, []).append((start_date, end_date))
+
+    def _lookup_cache(self, ticker, date):
+        """
+        和按日期查询的接口语义一致: 返回 date 当日或之前最近一个工作日的汇率。
+
+        Returns:
+            (是否命中缓存, SourcePrice)
+        """
+        base_symbol = self._parse_ticker(ticker)
+        for start_date, end_date in self._fetched_ranges.get(base_symbol, ()):
+            if not start_date <= date <= end_date:
+                continue
+            dates = self._rate_dates[base_symbol]
+            idx = bisect.bisect_right(dates, date)
+            # 区间内 date 之前没有汇率时需要更早的数据, 只能走网络
+            if idx > 0 and dates[idx - 1] >= start_date:
+                rate_date = dates[idx - 1]
+                rate = self._rate_table[base_symbol][rate_date]
+                return True, self._make_price(base_symbol[0], rate, rate_date)
+        return False, None
+
+    def _parse_ticker(self, ticker):
         assert len(ticker) == 6, ticker
-        base = ticker[:3]
-        symbol = ticker[3:]
+        return ticker[:3], ticker[3:]
+
+    def _make_price(self, base, rate, date):
+        close_price = D(rate).quantize(D('1.000000000000000000'))
+        trade_date = utils.default_tzinfo(
+            datetime.combine(date, datetime.min.time()),
+            tz.UTC
+        )
+        currency = base
+        return source.SourcePrice(close_price, trade_date, currency)
+
+    def _get_daily_price(self, ticker, date=None):
+        base, symbol = self._parse_ticker(ticker)
         if date is None:
             date_str = "latest"
         else:
             date_str = date.strftime("%Y-%m-%d")
 
         resp = self.http.get(
-            "https://api.exchangeratesapi.io/" + date_str,
+            self.api_url + date_str,
             params={
                 "symbols": symbol,
                 "base": base,
-            }
+            },
+            ttl=ttl_for_date(date),
         )
         result = resp.json()
 
-        close_price = D(result["rates"][symbol]).quantize(D('1.000000000000000000'))
-        trade_date = utils.default_tzinfo(
-            datetime.strptime(result["date"], "%Y-%m-%d"),
-            tz.UTC
-        )
-        currency = base
-        return source.SourcePrice(close_price, trade_date, currency)
+        rate_date = datetime.strptime(result["date"], "%Y-%m-%d").date()
+        return self._make_price(base, result["rates"][symbol], rate_date)
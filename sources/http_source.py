@@ -0,0 +1,186 @@
+"""
+各价格源共用的 HTTP 层
+
+- 连接池: 每个价格源一个 Session, 连接数和 update-prices.py 的并发数匹配
+- 超时: 按 host 设置 (连接, 读取) 超时, 没有列出的 host 用 DEFAULT_TIMEOUT
+- 重试: 连接错误和 429/5xx 按指数退避重试
+- 磁盘缓存: 以请求内容的哈希为文件名保存响应。历史日期的数据永久缓存,
+  最近 SETTLE_DAYS 天(可能还会更新)和最新报价只缓存 LATEST_TTL 秒,
+  重新运行失败的回填时已经拉取过的请求不再访问网络
+
+环境变量:
+    BEAN_SOURCES_CACHE_DIR  缓存目录, 默认 ~/.cache/beancount-sources, 设为空字符串时不缓存
+    BEAN_SOURCES_STUB_URL   把所有请求转发到这个地址(比如 http://127.0.0.1:8000),
+                            原来的 host 放在 X-Forwarded-Host 中, 用于本地测试
+"""
+import os
+import time
+import pickle
+import hashlib
+import logging
+import datetime
+import threading
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+logger = logging.getLogger(__name__)
+
+ENV_CACHE_DIR = "BEAN_SOURCES_CACHE_DIR"
+ENV_STUB_URL = "BEAN_SOURCES_STUB_URL"
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/beancount-sources")
+CACHE_VERSION = 1
+
+# 和 update-prices.py 的 MAX_WORKERS 一致
+POOL_SIZE = 8
+# (连接, 读取) 超时秒数
+DEFAULT_TIMEOUT = (5, 20)
+HOST_TIMEOUTS = {
+    "stock.xueqiu.com": (5, 15),
+    "api.fund.eastmoney.com": (5, 30),
+}
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# 最新报价的缓存秒数
+LATEST_TTL = 600
+# 最近这么多天的数据可能还会补发或修正(比如香港基金的净值), 不永久缓存
+SETTLE_DAYS = 7
+
+_cache_dir = os.environ.get(ENV_CACHE_DIR, DEFAULT_CACHE_DIR) or None
+_sessions = []
+
+
+def set_cache_dir(cache_dir):
+    """cache_dir 为 None 时不使用磁盘缓存"""
+    global _cache_dir
+    _cache_dir = cache_dir
+
+
+def log_summary():
+    for session in _sessions:
+        logger.info(
+            "%s: %d http requests, %d cache hits",
+            session.name, session.stats["requests"], session.stats["cache_hits"],
+        )
+
+
+def ttl_for_date(date):
+    """
+    Returns:
+        date 的数据的缓存秒数, None 为永久缓存; date 为 None 表示最新报价
+    """
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    if date is None or (datetime.date.today() - date).days < SETTLE_DAYS:
+        return LATEST_TTL
+    return None
+
+
+def _request_key(url):
+    return hashlib.sha256(f"{CACHE_VERSION}\nGET {url}".encode()).hexdigest()
+
+
+class SourceSession(requests.Session):
+    """
+    带连接池、超时、重试和磁盘缓存的 Session。get 多了几个参数:
+
+        ttl: 缓存秒数, None 为永久缓存, 0 为不缓存
+        cache_key: 代替 URL 作为缓存的键, 比如 URL 中带当前时间戳的最新报价
+        validate: 判断响应是否可以缓存, 默认只缓存 200 的响应
+
+    Attributes:
+        stats: {"requests": 网络请求数, "cache_hits": 缓存命中数}
+    """
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        retry = Retry(
+            total=RETRIES, backoff_factor=RETRY_BACKOFF,
+            status_forcelist=RETRY_STATUSES, raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.stats = {"requests": 0, "cache_hits": 0}
+        self._stats_lock = threading.Lock()
+        _sessions.append(self)
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def request(self, method, url, **kwargs):
+        host = urllib.parse.urlsplit(url).hostname
+        kwargs.setdefault("timeout", HOST_TIMEOUTS.get(host, DEFAULT_TIMEOUT))
+        stub_url = os.environ.get(ENV_STUB_URL)
+        if stub_url:
+            parts = urllib.parse.urlsplit(url)
+            url = stub_url.rstrip("/") + urllib.parse.urlunsplit(("", "", *parts[2:]))
+            kwargs["headers"] = dict(kwargs.get("headers") or {}, **{"X-Forwarded-Host": host})
+        self._count("requests")
+        return super().request(method, url, **kwargs)
+
+    def get(self, url, params=None, ttl=LATEST_TTL, cache_key=None, validate=None, **kwargs):
+        if _cache_dir is None or ttl == 0:
+            return super().get(url, params=params, **kwargs)
+
+        if cache_key is None:
+            cache_key = requests.Request("GET", url, params=params).prepare().url
+        path = self._get_cache_path(cache_key)
+        resp = self._read_cache(path, ttl)
+        if resp is not None:
+            self._count("cache_hits")
+            return resp
+
+        resp = super().get(url, params=params, **kwargs)
+        if resp.status_code == 200 and (validate is None or validate(resp)):
+            self._write_cache(path, resp)
+        return resp
+
+    def _get_cache_path(self, cache_key):
+        digest = _request_key(cache_key)
+        return os.path.join(_cache_dir, self.name, digest[:2], digest)
+
+    def _read_cache(self, path, ttl):
+        try:
+            with open(path, "rb") as fhandler:
+                cached = pickle.load(fhandler)
+        except FileNotFoundError:
+            return None
+        except Exception as exc:
+            logger.warning("Ignored broken response cache %s: %s", path, exc)
+            return None
+        if ttl is not None and time.time() - cached["fetched_at"] > ttl:
+            return None
+
+        resp = requests.Response()
+        resp.status_code = cached["status_code"]
+        resp.headers.update(cached["headers"])
+        resp.url = cached["url"]
+        resp.encoding = cached["encoding"]
+        resp._content = cached["content"]
+        return resp
+
+    def _write_cache(self, path, resp):
+        cached = {
+            "fetched_at": time.time(),
+            "status_code": resp.status_code,
+            "headers": dict(resp.headers),
+            "url": resp.url,
+            "encoding": resp.encoding,
+            "content": resp.content,
+        }
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as fhandler:
+                pickle.dump(cached, fhandler, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            logger.warning("Failed to write response cache %s: %s", path, exc)
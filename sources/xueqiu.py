@@ -1,5 +1,9 @@
-import time
+import os
 import json
+import pickle
+import bisect
+import logging
+import threading
 import requests
 from dateutil import tz,utils
 from datetime import datetime
@@ -7,6 +11,8 @@ from datetime import datetime
 from beancount.core.number import D
 from beancount.prices import source
 
+from http_source import SourceSession, ttl_for_date
+
 EXPECTED_COLS = [
     "timestamp",
     "volume",
@@ -21,8 +27,25 @@ EXPECTED_COLS = [
     "volume_post",
     "amount_post"
 ]
+TIMESTAMP_IDX = EXPECTED_COLS.index("timestamp")
+CLOSE_IDX = EXPECTED_COLS.index("close")
 CN_TZ = tz.gettz("Asia/Shanghai")
 NY_TZ = tz.gettz("America/New_York")
+# 雪球的 kline 接口需要先访问首页拿到 xq_a_token 等 cookie
+COOKIE_FILE = os.environ.get(
+    "XUEQIU_COOKIE_FILE",
+    os.path.expanduser("~/.cache/beancount-xueqiu-cookies.pickle"),
+)
+# cookie 过期或缺失时接口返回的错误码, 错误时 error_code 是字符串, 成功时是整数 0
+AUTH_ERROR_CODES = {"400016"}
+
+logger = logging.getLogger(__name__)
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
 
 
 class Source(source.Source):
@@ -33,9 +56,12 @@ class Source(source.Source):
     PYTHONPATH=`pwd`/sources bean-price --no-cache -e CNY:xueqiu/CN:SH510300
     PYTHONPATH=`pwd`/sources bean-price --no-cache -e HKD:xueqiu/HK:02800
     PYTHONPATH=`pwd`/sources bean-price --no-cache -e USD:xueqiu/US:SPY
+
+    回填多个日期时先调用 prefetch(ticker, start_date, end_date) 一次拉取整个区间的日K,
+    之后同一进程内对区间内日期的 get_historical_price 直接读内存。
     """
 
-    http = requests.Session()
+    http = SourceSession("xueqiu")
     headers = requests.utils.default_headers()
     headers.update(
         {
@@ -44,15 +70,77 @@ class Source(source.Source):
                            'Chrome/73.0.3683.103 Safari/537.36'),
         }
     )
-    http.get("https://xueqiu.com/", headers=headers)
+    home_url = "https://xueqiu.com/"
+    kline_url = "https://stock.xueqiu.com/v5/stock/chart/kline.json"
+
+    _session_lock = threading.Lock()
+    _session_ready = False
+
+    # 本进程内发出的 kline 请求数
+    request_count = 0
+    _count_lock = threading.Lock()
+    # ticker -> {date: SourcePrice}
+    _bar_cache = {}
+    # ticker -> _bar_cache[ticker] 排好序的日期, 用于 bisect
+    _bar_dates = {}
+    # ticker -> [(start_date, end_date), ...] 已经完整拉取过的区间
+    _fetched_ranges = {}
 
     def get_historical_price(self, ticker, date):
+        cached, price = self._lookup_cache(ticker, _to_date(date))
+        if cached:
+            return price
         return self._get_daily_price(ticker, date)
 
     def get_latest_price(self, ticker):
         return self._get_daily_price(ticker)
 
-    def _get_daily_price(self, ticker, date=None):
+    def prefetch(self, ticker, start_date, end_date):
+        """
+        一次请求拉取 [start_date, end_date] 区间内的全部日K并缓存
+
+        Returns:
+            按日期排序的 SourcePrice 列表
+        """
+        start_date, end_date = _to_date(start_date), _to_date(end_date)
+        symbol, exchange_tz, currency = self._parse_ticker(ticker)
+        end_time = utils.default_tzinfo(
+            datetime.combine(end_date, datetime.max.time()),
+            exchange_tz
+        )
+        # 交易日不会多于自然日
+        count = (end_date - start_date).days + 1
+        bars = self._request_kline(symbol, end_time, count)
+
+        cache = self._bar_cache.setdefault(ticker, {})
+        for bar in bars:
+            price = self._parse_bar(bar, exchange_tz, currency)
+            cache[price.time.date()] = price
+        self._bar_dates[ticker] = sorted(cache)
+        self._fetched_ranges.setdefault(ticker, []).append((start_date, end_date))
+        return [
+            cache[date] for date in self._bar_dates[ticker]
+            if start_date <= date <= end_date
+        ]
+
+    def _lookup_cache(self, ticker, date):
+        """
+        和 count=-1 的接口语义一致: 返回 date 当日或之前最近的一根K线。
+
+        Returns:
+            (是否命中缓存, SourcePrice)
+        """
+        for start_date, end_date in self._fetched_ranges.get(ticker, ()):
+            if not start_date <= date <= end_date:
+                continue
+            dates = self._bar_dates[ticker]
+            idx = bisect.bisect_right(dates, date)
+            # 区间内 date 之前没有K线时需要更早的数据, 只能走网络
+            if idx > 0 and dates[idx - 1] >= start_date:
+                return True, self._bar_cache[ticker][dates[idx - 1]]
+        return False, None
+
+    def _parse_ticker(self, ticker):
         region, symbol = ticker.split(":", 1)
         if region in {"HK", "CN"}:
             exchange_tz = CN_TZ
@@ -64,33 +152,120 @@ class Source(source.Source):
             assert region == "US"
             exchange_tz = NY_TZ
             currency = "USD"
-        if date is None:
-            trade_date = utils.default_tzinfo(
-                datetime.now(),
-                exchange_tz,
-            )
-        else:
-            trade_date = utils.default_tzinfo(
-                datetime.combine(date, datetime.max.time()),
-                exchange_tz
-            )
-        begin = int(time.mktime(trade_date.timetuple())) * 1000
+        return symbol, exchange_tz, currency
+
+    @classmethod
+    def _warm_up(cls, force=False):
+        """
+        第一次请求前才访问雪球首页拿 cookie, 进程内共享。
+        cookie 会保存到 COOKIE_FILE, 下次运行时直接复用。
+        """
+        with cls._session_lock:
+            if cls._session_ready and not force:
+                return
+            if not force and cls._load_cookies():
+                cls._session_ready = True
+                return
+
+            logger.info("Warming up xueqiu session")
+            cls.http.cookies.clear()
+            cls.http.get(cls.home_url, headers=cls.headers, ttl=0)
+            cls._save_cookies()
+            cls._session_ready = True
+
+    @classmethod
+    def _load_cookies(cls):
+        try:
+            with open(COOKIE_FILE, "rb") as fhandler:
+                cookies = pickle.load(fhandler)
+        except (OSError, pickle.PickleError, EOFError):
+            return False
+        cookies.clear_expired_cookies()
+        if not cookies:
+            return False
+        cls.http.cookies.update(cookies)
+        return True
+
+    @classmethod
+    def _save_cookies(cls):
+        try:
+            os.makedirs(os.path.dirname(COOKIE_FILE), exist_ok=True)
+            with open(COOKIE_FILE, "wb") as fhandler:
+                pickle.dump(cls.http.cookies, fhandler)
+        except OSError as exc:
+            logger.warning("Failed to save xueqiu cookies: %s", exc)
+
+    @classmethod
+    def _count_request(cls):
+        # update-prices.py 在多个线程中调用
+        with cls._count_lock:
+            Source.request_count += 1
+
+    @staticmethod
+    def _is_auth_error(resp):
+        try:
+            error_code = resp.json().get("error_code")
+        except ValueError:
+            return False
+        return str(error_code) in AUTH_ERROR_CODES
+
+    @staticmethod
+    def _is_valid(resp):
+        try:
+            return resp.json().get("error_code") == 0
+        except ValueError:
+            return False
+
+    def _request_kline(self, symbol, trade_date, count, latest=False):
+        """
+        返回 trade_date 及之前的 count 根日K
+
+        latest 为 True 时 trade_date 是当前时间, URL 每次都不同, 按 symbol 缓存一小段时间
+        """
+        begin = int(trade_date.timestamp()) * 1000
         url = (
-            f"https://stock.xueqiu.com/v5/stock/chart/kline.json?"
+            f"{self.kline_url}?"
             f"symbol={symbol}&begin={begin}&period=day&"
-            f"type=before&count=-1&indicator=kline"
+            f"type=before&count=-{count}&indicator=kline"
         )
+        cache_options = {
+            "ttl": ttl_for_date(None if latest else trade_date),
+            "cache_key": f"latest:{symbol}:{count}" if latest else None,
+            "validate": self._is_valid,
+        }
 
-        resp = self.http.get(url, headers=self.headers)
+        self._warm_up()
+        self._count_request()
+        resp = self.http.get(url, headers=self.headers, **cache_options)
+        if self._is_auth_error(resp):
+            # 磁盘上的 cookie 过期了, 重新访问首页后重试一次
+            self._warm_up(force=True)
+            self._count_request()
+            resp = self.http.get(url, headers=self.headers, **cache_options)
         assert resp.status_code == 200, resp.text
         result = resp.json()
         assert result["error_code"] == 0, result["error_description"]
-        bar = result["data"]["item"][0]
         assert result["data"]["column"] == EXPECTED_COLS
-        returned_ts = bar[EXPECTED_COLS.index("timestamp")]
-        close_price = D(
-            bar[EXPECTED_COLS.index("close")]
-        ).quantize(D('1.000000000000000000'))
+        return result["data"]["item"]
+
+    def _parse_bar(self, bar, exchange_tz, currency):
+        returned_ts = bar[TIMESTAMP_IDX]
+        close_price = D(bar[CLOSE_IDX]).quantize(D('1.000000000000000000'))
 
         trade_date = datetime.fromtimestamp(returned_ts/1000, exchange_tz)
         return source.SourcePrice(close_price, trade_date, currency)
+
+    def _get_daily_price(self, ticker, date=None):
+        symbol, exchange_tz, currency = self._parse_ticker(ticker)
+        if date is None:
+            trade_date = utils.default_tzinfo(
+                datetime.now(),
+                exchange_tz,
+            )
+        else:
+            trade_date = utils.default_tzinfo(
+                datetime.combine(date, datetime.max.time()),
+                exchange_tz
+            )
+        bar = self._request_kline(symbol, trade_date, 1, latest=date is None)[0]
+        return self._parse_bar(bar, exchange_tz, currency)
@@ -0,0 +1,104 @@
+import os
+import sys
+import shutil
+import threading
+import importlib.util
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LEDGER_FILE = os.path.join(ROOT_DIR, "ledger", "main.beancount")
+sys.path[:0] = [os.path.join(ROOT_DIR, "scripts"), os.path.join(ROOT_DIR, "sources")]
+
+
+def load_script(filename):
+    """导入 scripts/ 下文件名带 - 的命令行脚本"""
+    path = os.path.join(ROOT_DIR, "scripts", filename)
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    # 工作进程中按模块名找到 pickle 的函数
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def copy_ledger(tmp_path):
+    """把示例帐本(不含缓存文件)复制到 tmp_path/ledger, 返回 main.beancount 的路径"""
+    ledger_dir = tmp_path / "ledger"
+    shutil.copytree(
+        os.path.join(ROOT_DIR, "ledger"), str(ledger_dir), ignore=shutil.ignore_patterns(".*")
+    )
+    return str(ledger_dir / "main.beancount")
+
+
+@pytest.fixture(scope="session")
+def ledger():
+    """不读写磁盘缓存, 测试不依赖也不改动 ledger/ 下的缓存文件"""
+    from ledger_loader import load_ledger
+    return load_ledger(LEDGER_FILE, use_cache=False, use_price_cache=False, jobs=1)
+
+
+class StubServer:
+    """
+    本地的模拟 HTTP 服务, 价格源的请求通过 BEAN_SOURCES_STUB_URL 转发到这里
+
+    Attributes:
+        routes: {path: handler}, handler(host, query) 返回 (status, body)
+            或 (status, body, 响应头)
+        requests: 收到的请求 (原来的 host, path, query)
+        request_headers: 和 requests 一一对应的请求头
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.request_headers = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(parts.query))
+                host = self.headers.get("X-Forwarded-Host")
+                stub.requests.append((host, parts.path, query))
+                stub.request_headers.append(self.headers)
+                handler = stub.routes.get(parts.path)
+                status, body, *headers = (404, "") if handler is None else handler(host, query)
+                body = body.encode()
+                self.send_response(status)
+                for key, value in (headers[0] if headers else {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self._thread.start()
+
+    def count(self, path):
+        return sum(1 for _, req_path, _ in self.requests if req_path == path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    """启动模拟服务并把价格源的请求转发过去, 默认不使用 HTTP 响应缓存"""
+    import http_source
+    server = StubServer()
+    monkeypatch.setenv(http_source.ENV_STUB_URL, server.url)
+    monkeypatch.setattr(http_source, "_cache_dir", None)
+    yield server
+    server.close()
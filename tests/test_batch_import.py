@@ -0,0 +1,160 @@
+import os
+import glob
+import multiprocessing
+
+import pytest
+from beancount.core import data
+from beancount.ingest import cache
+from beancount.parser import parser
+from beancount.parser import printer
+from click.testing import CliRunner
+
+from conftest import ROOT_DIR, load_script
+
+
+batch_import = load_script("batch-import.py")
+
+HEADER = "卡号末四位,记账日期,交易金额,交易描述\n"
+
+
+def run_import(tmp_path, *csv_contents):
+    paths = []
+    for idx, content in enumerate(csv_contents):
+        path = tmp_path / f"{idx}.csv"
+        path.write_text(HEADER + content, encoding="utf-8")
+        paths.append(str(path))
+    output_dir = str(tmp_path / "out")
+    result = CliRunner().invoke(
+        batch_import.main, paths + ["--output-dir", output_dir, "--workers", "2"]
+    )
+    assert result.exit_code == 0, result.output
+    return sum(
+        open(path, encoding="utf-8").read().count("上海地铁")
+        for path in glob.glob(output_dir + "/**/*.beancount", recursive=True)
+    )
+
+
+def test_keeps_repeated_transactions_in_one_statement(tmp_path):
+    rides = "9999,2019-08-03,3.00,上海地铁\n" * 2
+    assert run_import(tmp_path, rides) == 2
+    # 再次导入同一份帐单不重复写入
+    assert run_import(tmp_path, rides) == 2
+
+
+def test_skips_overlapping_statements(tmp_path):
+    assert run_import(
+        tmp_path,
+        "9999,2019-08-03,3.00,上海地铁\n" * 2,
+        "9999,2019-08-03,3.00,上海地铁\n9999,2019-08-04,3.00,上海地铁\n",
+    ) == 3
+
+
+def test_iter_results_bounds_pending_rows():
+    """提交给进程池但还没取走结果的行不超过两批"""
+    produced = []
+
+    def items():
+        for idx in range(2000):
+            produced.append(idx)
+            yield -idx
+
+    window = 100
+    with multiprocessing.Pool(2) as pool:
+        for consumed, result in enumerate(batch_import.iter_results(pool, abs, items(), window)):
+            assert result == consumed
+            assert len(produced) - consumed <= 2 * window
+    assert consumed == 1999
+
+
+BALANCE_IMPORTER = """
+from beancount.ingest.importers import csv
+
+CONFIG = [
+    csv.Importer(
+        {
+            csv.Col.DATE: "记账日期",
+            csv.Col.TXN_DATE: "交易日期",
+            csv.Col.TXN_TIME: "交易时间",
+            csv.Col.PAYEE: "对方",
+            csv.Col.NARRATION1: "摘要",
+            csv.Col.NARRATION2: "备注",
+            csv.Col.AMOUNT: "金额",
+            csv.Col.BALANCE: "余额",
+            csv.Col.REFERENCE_ID: "流水号",
+        },
+        regexps="记账日期,交易日期,交易时间,对方,摘要,备注,金额,余额,流水号",
+        account="Assets:CN:Bank:Test",
+        currency="CNY",
+        invert_sign=True,
+    )
+]
+"""
+# 日期降序, 有金额为空的行
+BALANCE_CSV = """\
+记账日期,交易日期,交易时间,对方,摘要,备注,金额,余额,流水号
+2019-08-05,2019-08-04,12:30:00, 某餐厅 ,消费,午饭,45.50,954.50,A003
+2019-08-04,2019-08-04,09:00:00,,利息,,,1000.00,
+2019-08-03,2019-08-03,08:15:00,上海地铁,消费,"早高峰
+换乘",-3.00,1000.00,A002
+2019-08-01,2019-08-01,10:00:00,工资,转入,,-1003.00,1003.00,A001
+"""
+
+
+def normalize(entries):
+    """打印后重新解析再打印, 去掉内存中和文件中表示上的差别"""
+    text = "\n".join(printer.format_entry(entry) for entry in entries)
+    reparsed, errors, _ = parser.parse_string(text)
+    assert not errors, errors
+    return sorted(printer.format_entry(entry) for entry in reparsed)
+
+
+def extract_entries(config, path):
+    """bean-extract 对一个文件的结果"""
+    file_memo = cache.get_file(path)
+    importer, = [importer for importer in config if importer.identify(file_memo)]
+    return importer.extract(file_memo)
+
+
+def import_entries(module_name, paths, output_dir):
+    result = CliRunner().invoke(batch_import.main, list(paths) + [
+        "--importer", module_name, "--output-dir", output_dir, "--workers", "2",
+    ])
+    assert result.exit_code == 0, result.output
+    entries = []
+    for path in glob.glob(output_dir + "/**/*.beancount", recursive=True):
+        entries.extend(parser.parse_file(path)[0])
+    return entries
+
+
+@pytest.fixture
+def empty_daily_dir(tmp_path, monkeypatch):
+    daily_dir = tmp_path / "daily"
+    daily_dir.mkdir()
+    monkeypatch.setattr(batch_import, "DAILY_DIR", str(daily_dir))
+
+
+def test_same_entries_as_bean_extract(tmp_path, empty_daily_dir):
+    paths = sorted(glob.glob(os.path.join(ROOT_DIR, "raw-data", "spdbcc", "*.csv")))
+    config = batch_import.load_importer_config("spdccc_importer")
+    expected = [entry for path in paths for entry in extract_entries(config, path)]
+    assert len(expected) > 10
+    entries = import_entries("spdccc_importer", paths, str(tmp_path / "out"))
+    assert normalize(entries) == normalize(expected)
+
+
+def test_same_balance_as_bean_extract(tmp_path, empty_daily_dir, monkeypatch):
+    importer_dir = tmp_path / "importers"
+    importer_dir.mkdir()
+    (importer_dir / "balance_importer.py").write_text(BALANCE_IMPORTER, encoding="utf-8")
+    monkeypatch.syspath_prepend(str(importer_dir))
+    path = tmp_path / "bank.csv"
+    path.write_text(BALANCE_CSV, encoding="utf-8")
+
+    expected = extract_entries(batch_import.load_importer_config("balance_importer"), str(path))
+    assert isinstance(expected[-1], data.Balance)
+    output_dir = str(tmp_path / "out")
+    entries = import_entries("balance_importer", [str(path)], output_dir)
+    assert normalize(entries) == normalize(expected)
+    # 再次导入同一份帐单不重复写入交易和 balance
+    assert normalize(import_entries("balance_importer", [str(path)], output_dir)) == normalize(
+        expected)
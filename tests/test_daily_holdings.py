@@ -0,0 +1,38 @@
+import datetime
+
+import beancount.core.data
+from beancount.ops.holdings import get_assets_holdings
+
+from daily_holdings import iter_holdings_at_dates
+from price_index import PriceIndex
+
+
+def get_check_dates(entries):
+    """有交易的日期、前后各一天, 再加上每周一天"""
+    txn_dates = {
+        entry.date for entry in entries
+        if isinstance(entry, beancount.core.data.Transaction)
+    }
+    dates = set()
+    for date in txn_dates:
+        dates.update(date + datetime.timedelta(days=delta) for delta in (-1, 0, 1))
+    curr_date, end_date = min(txn_dates), max(entry.date for entry in entries)
+    while curr_date <= end_date:
+        dates.add(curr_date)
+        curr_date += datetime.timedelta(days=7)
+    return sorted(dates)
+
+
+def test_matches_get_assets_holdings(ledger):
+    """逐日增量维护的持仓和每天对 entries_to_date 调用 get_assets_holdings 的结果一致"""
+    entries, _, options_map = ledger
+    price_index = PriceIndex.build(entries, options_map)
+    dates = get_check_dates(entries)
+    assert len(dates) > 50
+
+    for target_currency in (None, "CNY"):
+        walked = iter_holdings_at_dates(entries, options_map, price_index, dates, target_currency)
+        for curr_date, holdings_list in walked:
+            entries_to_date = [entry for entry in entries if entry.date <= curr_date]
+            expected, _ = get_assets_holdings(entries_to_date, options_map, target_currency)
+            assert sorted(holdings_list, key=repr) == sorted(expected, key=repr), curr_date
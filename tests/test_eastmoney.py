@@ -0,0 +1,80 @@
+import json
+import datetime
+from decimal import Decimal
+
+import pytest
+
+import eastmoney
+
+
+LSJZ_PATH = "/f10/lsjz"
+
+
+def parse_date(date_str):
+    return datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+
+
+def get_nav(date):
+    return "%.4f" % (1 + date.toordinal() % 100 / 1000)
+
+
+def lsjz_handler(host, query):
+    """工作日有净值, 按日期倒序分页返回"""
+    assert host == "api.fund.eastmoney.com"
+    end_date = parse_date(query.get("endDate", "2019-12-31"))
+    start_date = parse_date(query.get("startDate", "2019-12-31"))
+    dates = []
+    curr_date = end_date
+    while curr_date >= start_date:
+        if curr_date.weekday() < 5:
+            dates.append(curr_date)
+        curr_date -= datetime.timedelta(days=1)
+
+    page_index, page_size = int(query["pageIndex"]), int(query["pageSize"])
+    page = dates[(page_index - 1) * page_size:page_index * page_size]
+    result = {
+        "Data": {"LSJZList": [
+            {"FSRQ": date.isoformat(), "DWJZ": get_nav(date)} for date in page
+        ]},
+        "TotalCount": len(dates),
+    }
+    return 200, "%s(%s)" % (query["callback"], json.dumps(result))
+
+
+@pytest.fixture
+def source(stub_server, monkeypatch):
+    monkeypatch.setattr(eastmoney.Source, "_nav_cache", {})
+    monkeypatch.setattr(eastmoney.Source, "_fetched_ranges", {})
+    stub_server.routes[LSJZ_PATH] = lsjz_handler
+    return eastmoney.Source()
+
+
+def test_prefetch_pages_through_range(source, stub_server):
+    start_date, end_date = datetime.date(2019, 10, 1), datetime.date(2019, 12, 31)
+    prices = source.prefetch("F110011", start_date, end_date)
+
+    # 66 个工作日, 每页 PAGE_SIZE 条
+    assert len(prices) == 66
+    assert stub_server.count(LSJZ_PATH) == -(-66 // eastmoney.PAGE_SIZE)
+    assert [price.time.date() for price in prices] == sorted(price.time.date() for price in prices)
+    assert prices[0].time.date() == datetime.date(2019, 10, 1)
+    assert prices[0].price == Decimal(get_nav(datetime.date(2019, 10, 1)))
+    assert prices[0].quote_currency == "CNY"
+
+
+def test_historical_price_reads_prefetched_range(source, stub_server):
+    source.prefetch("F110011", datetime.date(2019, 12, 1), datetime.date(2019, 12, 31))
+    num_requests = len(stub_server.requests)
+
+    price = source.get_historical_price("F110011", datetime.date(2019, 12, 20))
+    assert price.price == Decimal(get_nav(datetime.date(2019, 12, 20)))
+    # 周末没有净值, 也不再请求
+    assert source.get_historical_price("F110011", datetime.date(2019, 12, 21)) is None
+    assert len(stub_server.requests) == num_requests
+
+    # 区间外的日期单独请求
+    price = source.get_historical_price("F110011", datetime.date(2019, 11, 29))
+    assert price.price == Decimal(get_nav(datetime.date(2019, 11, 29)))
+    assert len(stub_server.requests) == num_requests + 1
+    _, _, query = stub_server.requests[-1]
+    assert (query["fundCode"], query["pageSize"]) == ("110011", "1")
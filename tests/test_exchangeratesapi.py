@@ -0,0 +1,80 @@
+import json
+import datetime
+from decimal import Decimal
+
+import pytest
+
+import exchangeratesapi
+
+
+def parse_date(date_str):
+    return datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+
+
+def get_rate(base, symbol, date):
+    return round(len(base + symbol) + date.toordinal() % 30 / 100, 2)
+
+
+def history_handler(host, query):
+    """工作日有汇率"""
+    assert host == "api.exchangeratesapi.io"
+    rates = {}
+    curr_date = parse_date(query["start_at"])
+    while curr_date <= parse_date(query["end_at"]):
+        if curr_date.weekday() < 5:
+            rates[curr_date.isoformat()] = {
+                symbol: get_rate(query["base"], symbol, curr_date)
+                for symbol in query["symbols"].split(",")
+            }
+        curr_date += datetime.timedelta(days=1)
+    return 200, json.dumps({"base": query["base"], "rates": rates})
+
+
+def make_daily_handler(date):
+    def handler(host, query):
+        rates = {query["symbols"]: get_rate(query["base"], query["symbols"], date)}
+        return 200, json.dumps({"base": query["base"], "date": date.isoformat(), "rates": rates})
+    return handler
+
+
+@pytest.fixture
+def source(stub_server, monkeypatch):
+    for name in ("_rate_table", "_rate_dates", "_fetched_ranges"):
+        monkeypatch.setattr(exchangeratesapi.Source, name, {})
+    stub_server.routes["/history"] = history_handler
+    return exchangeratesapi.Source()
+
+
+def test_prefetch_one_request_per_base(source, stub_server):
+    start_date, end_date = datetime.date(2019, 12, 2), datetime.date(2019, 12, 31)
+    source.prefetch(["USDCNY", "USDHKD", "EURCNY"], start_date, end_date)
+
+    queries = sorted(
+        (query["base"], query["symbols"]) for _, _, query in stub_server.requests
+    )
+    assert queries == [("EUR", "CNY"), ("USD", "CNY,HKD")]
+
+    # 窗口内的每一天都直接读内存, 周末返回周五的汇率
+    curr_date = start_date
+    while curr_date <= end_date:
+        rate_date = curr_date - datetime.timedelta(days=max(0, curr_date.weekday() - 4))
+        for ticker in ("USDCNY", "USDHKD", "EURCNY"):
+            price = source.get_historical_price(ticker, curr_date)
+            expected = Decimal(get_rate(ticker[:3], ticker[3:], rate_date))
+            assert price.price == expected.quantize(Decimal("1e-18"))
+            assert price.time.date() == rate_date
+            assert price.quote_currency == ticker[:3]
+        curr_date += datetime.timedelta(days=1)
+    assert stub_server.count("/history") == 2
+    assert len(stub_server.requests) == 2
+
+
+def test_date_outside_range_requests_that_date(source, stub_server):
+    source.prefetch(["USDCNY"], datetime.date(2019, 12, 2), datetime.date(2019, 12, 31))
+    date = datetime.date(2019, 11, 29)
+    stub_server.routes["/2019-11-29"] = make_daily_handler(date)
+
+    price = source.get_historical_price("USDCNY", date)
+    assert price.price == Decimal(get_rate("USD", "CNY", date)).quantize(Decimal("1e-18"))
+    assert stub_server.count("/2019-11-29") == 1
+    assert len(stub_server.requests) == 2
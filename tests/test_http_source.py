@@ -0,0 +1,96 @@
+import json
+import time
+import types
+import datetime
+from decimal import Decimal
+
+import pytest
+
+import http_source
+import exchangeratesapi
+
+
+QUOTE_PATH = "/quote"
+QUOTE_URL = "https://api.example.com" + QUOTE_PATH
+
+
+def quote_handler(host, query):
+    return 200, json.dumps({"symbol": query["symbol"], "price": len(query["symbol"])})
+
+
+@pytest.fixture
+def session(stub_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(http_source, "_cache_dir", str(tmp_path))
+    stub_server.routes[QUOTE_PATH] = quote_handler
+    return http_source.SourceSession("test")
+
+
+def test_ttl_for_date():
+    today = datetime.date.today()
+    assert http_source.ttl_for_date(None) == http_source.LATEST_TTL
+    assert http_source.ttl_for_date(today) == http_source.LATEST_TTL
+    assert http_source.ttl_for_date(today - datetime.timedelta(days=http_source.SETTLE_DAYS)) is None
+
+
+def test_historical_response_cached_permanently(session, stub_server):
+    first = session.get(QUOTE_URL, params={"symbol": "SPY"}, ttl=None)
+    second = session.get(QUOTE_URL, params={"symbol": "SPY"}, ttl=None)
+    assert first.json() == second.json() == {"symbol": "SPY", "price": 3}
+    assert second.status_code == 200
+    assert stub_server.count(QUOTE_PATH) == 1
+    assert session.stats == {"requests": 1, "cache_hits": 1}
+
+    # 参数不同的请求不共用缓存
+    assert session.get(QUOTE_URL, params={"symbol": "QQQM"}, ttl=None).json()["price"] == 4
+    assert stub_server.count(QUOTE_PATH) == 2
+
+
+def test_latest_response_expires(session, stub_server, monkeypatch):
+    session.get(QUOTE_URL, params={"symbol": "SPY"}, cache_key="latest:SPY")
+    session.get(QUOTE_URL, params={"symbol": "SPY", "ts": "1"}, cache_key="latest:SPY")
+    assert stub_server.count(QUOTE_PATH) == 1
+
+    later = time.time() + http_source.LATEST_TTL + 1
+    monkeypatch.setattr(http_source, "time", types.SimpleNamespace(time=lambda: later))
+    session.get(QUOTE_URL, params={"symbol": "SPY"}, cache_key="latest:SPY")
+    assert stub_server.count(QUOTE_PATH) == 2
+
+
+def test_rejected_responses_not_cached(session, stub_server):
+    stub_server.routes["/missing"] = lambda host, query: (404, "")
+    for _ in range(2):
+        assert session.get("https://api.example.com/missing", ttl=None).status_code == 404
+        session.get(QUOTE_URL, params={"symbol": "SPY"}, ttl=None, validate=lambda resp: False)
+    assert stub_server.count("/missing") == 2
+    assert stub_server.count(QUOTE_PATH) == 2
+    assert session.stats["cache_hits"] == 0
+
+
+def test_retries_server_errors(session, stub_server, monkeypatch):
+    monkeypatch.setattr(http_source, "_cache_dir", None)
+    statuses = [503, 200]
+    stub_server.routes["/flaky"] = lambda host, query: (statuses.pop(0), "ok")
+    resp = session.get("https://api.example.com/flaky")
+    assert (resp.status_code, resp.text) == (200, "ok")
+    assert stub_server.count("/flaky") == 2
+    host, _, _ = stub_server.requests[0]
+    assert host == "api.example.com"
+
+
+def test_rerun_backfill_without_network(stub_server, monkeypatch, tmp_path):
+    """新进程(内存中的汇率表为空)重新回填同一区间时全部命中磁盘缓存"""
+    monkeypatch.setattr(http_source, "_cache_dir", str(tmp_path))
+    stub_server.routes["/history"] = lambda host, query: (200, json.dumps({"rates": {
+        "2019-12-30": {"CNY": 6.99}, "2019-12-31": {"CNY": 6.97},
+    }}))
+
+    prices = []
+    for _ in range(2):
+        for name in ("_rate_table", "_rate_dates", "_fetched_ranges"):
+            monkeypatch.setattr(exchangeratesapi.Source, name, {})
+        source = exchangeratesapi.Source()
+        source.prefetch(["USDCNY"], datetime.date(2019, 12, 30), datetime.date(2019, 12, 31))
+        prices.append(source.get_historical_price("USDCNY", datetime.date(2019, 12, 31)))
+    assert prices[0] == prices[1]
+    assert round(prices[0].price, 2) == Decimal("6.97")
+    assert stub_server.count("/history") == 1
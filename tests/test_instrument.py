@@ -0,0 +1,38 @@
+import tracemalloc
+
+import pytest
+
+import instrument
+
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def recorder():
+    tracemalloc.start()
+    yield instrument.Recorder({"timing", "tracemalloc"})
+    tracemalloc.stop()
+
+
+def allocate(size):
+    data = bytearray(size)
+    del data
+
+
+def test_peak_mem_per_stage(recorder):
+    with recorder.stage("outer"):
+        with recorder.stage("big"):
+            allocate(20 * MB)
+        with recorder.stage("small"):
+            allocate(MB)
+    with recorder.stage("after"):
+        allocate(MB)
+
+    peaks = {name: stat.peak_mem for name, stat in recorder.stats.items()}
+    assert peaks["outer/big"] >= 20 * MB
+    # 之后的阶段不再带着前面阶段的峰值
+    assert peaks["outer/small"] < 5 * MB
+    assert peaks["after"] < 5 * MB
+    # 内层阶段的峰值合并到外层
+    assert peaks["outer"] >= peaks["outer/big"]
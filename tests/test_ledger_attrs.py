@@ -0,0 +1,77 @@
+import pytest
+from beancount import loader
+
+from ledger_attrs import COMMODITY_META_FIELDS, AttributeTable
+
+
+LEDGER = """
+2000-01-01 commodity CNY
+  name: "人民币"
+  asset-class: "现金"
+  asset-subclass: "现金"
+
+2000-01-01 open Assets:Cash CNY
+  name: "现金"
+2000-01-01 open Assets:Time:Leave DAY
+2000-01-01 open Assets:PrePayments:Rent
+  sunk: 1
+2000-01-01 open Income:Salary
+2000-01-01 open Income:Time:Leave DAY
+
+2019-08-01 * "工资"
+  Assets:Cash  1000 CNY
+  Income:Salary
+
+2019-08-01 * "年假"
+  Assets:Time:Leave  5 DAY
+  Income:Time:Leave
+
+2019-08-02 * "预付房租"
+  Assets:PrePayments:Rent  1 RENTMONTH {3000 CNY}
+  Assets:Cash
+"""
+PORTFOLIO_FIELDS = {"account_fields": ("name",), "commodity_fields": COMMODITY_META_FIELDS}
+
+
+def build(extra="", **kwargs):
+    entries, errors, options_map = loader.load_string(LEDGER + extra)
+    assert not errors, errors
+    return AttributeTable.build(entries, options_map, **kwargs)
+
+
+def test_skips_non_priced_and_sunk_holdings():
+    """DAY 和 sunk 账户中的持仓报表不会读 name、asset-class"""
+    attrs = build(**PORTFOLIO_FIELDS)
+    assert attrs.accounts["Assets:Time:Leave"].name is None
+    assert attrs.accounts["Assets:PrePayments:Rent"].sunk
+    assert attrs.commodities["CNY"].asset_class == "现金"
+    assert "RENTMONTH" not in attrs.commodities
+
+
+def test_requires_name_only_when_read():
+    extra = """
+2000-01-01 open Assets:Saving CNY
+2019-08-03 * "存款"
+  Assets:Saving  500 CNY
+  Assets:Cash
+"""
+    assert build(extra, commodity_fields=("asset-class",)).accounts["Assets:Saving"].name is None
+    with pytest.raises(ValueError, match="Assets:Saving has no \\['name'\\]"):
+        build(extra, **PORTFOLIO_FIELDS)
+
+
+def test_reports_missing_commodities():
+    extra = """
+2000-01-01 commodity USD
+  name: "美元"
+2000-01-01 open Assets:Broker
+  name: "券商"
+2019-08-03 * "买入"
+  Assets:Broker  10 SPY {20 USD}
+  Assets:Broker  -200 USD
+"""
+    with pytest.raises(ValueError) as excinfo:
+        build(extra, commodity_fields=("asset-class",))
+    message = str(excinfo.value)
+    assert "Commodity SPY held in Assets:Broker on 2019-08-03 is not defined" in message
+    assert "Commodity USD has no ['asset-class'] in meta" in message
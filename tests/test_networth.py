@@ -0,0 +1,74 @@
+import os
+import logging
+import datetime
+import decimal
+
+import pytest
+
+from conftest import copy_ledger
+from ledger_loader import load_ledger
+from networth import compute_daily_values
+from networth_checkpoint import get_checkpoint_file
+
+
+SINCE_DATE = datetime.date(2019, 10, 1)
+END_DATE = datetime.date(2019, 10, 31)
+EXTRA_TXN = """
+2019-10-15 * "利息"
+  Assets:CN:Saving:CMB  10000 CNY
+  Income:CN:Saving:Interest
+"""
+
+
+@pytest.fixture
+def ledger_file(tmp_path):
+    """示例帐本的副本, 多了一笔 10000 CNY 的收入"""
+    path = copy_ledger(tmp_path)
+    with open(path, "a") as fhandler:
+        fhandler.write(EXTRA_TXN)
+    return path
+
+
+def get_networth(daily_values):
+    return {values["date"]: values["networth"] for values in daily_values}
+
+
+def test_shards_load_given_ledger(ledger, ledger_file):
+    copied = load_ledger(ledger_file, use_cache=False)
+    serial = compute_daily_values(SINCE_DATE, END_DATE, ledger=copied)
+    sharded = compute_daily_values(SINCE_DATE, END_DATE, ledger=copied, jobs=3)
+    assert sharded == serial
+
+    bundled = get_networth(compute_daily_values(SINCE_DATE, END_DATE, ledger=ledger))
+    for date, networth in get_networth(sharded).items():
+        expected = bundled[date] + (10000 if date >= datetime.date(2019, 10, 15) else 0)
+        assert abs(networth - expected) < decimal.Decimal("0.01"), date
+
+
+def test_checkpoint_per_ledger_file(ledger_file, caplog):
+    """同一目录下的两个帐本各自有检查点, 不会互相覆盖"""
+    other_file = os.path.join(os.path.dirname(ledger_file), "other.beancount")
+    with open(ledger_file) as fhandler:
+        content = fhandler.read()
+    with open(other_file, "w") as fhandler:
+        fhandler.write(content.replace(EXTRA_TXN, ""))
+
+    results = {}
+    for path in (ledger_file, other_file):
+        loaded = load_ledger(path, use_cache=False)
+        results[path] = compute_daily_values(
+            SINCE_DATE, END_DATE, ledger=loaded, use_checkpoint=True
+        )
+        assert results[path] == compute_daily_values(SINCE_DATE, END_DATE, ledger=loaded)
+        assert os.path.exists(get_checkpoint_file(path))
+    assert results[ledger_file] != results[other_file]
+
+    # 两个检查点都还能直接复用
+    caplog.set_level(logging.INFO, logger="networth")
+    for path in (ledger_file, other_file):
+        caplog.clear()
+        loaded = load_ledger(path, use_cache=False)
+        assert compute_daily_values(
+            SINCE_DATE, END_DATE, ledger=loaded, use_checkpoint=True
+        ) == results[path]
+        assert "Computed 0 days" in caplog.text
@@ -0,0 +1,67 @@
+import random
+import datetime
+import decimal
+
+import pytest
+
+from networth import compute_daily_values, get_series_columns, iter_networth_series
+from networth_series import NetworthSeries, check_equivalence, compute_decimal_series
+
+
+def make_columns(num_days=500, seed=0):
+    """跨年的随机序列, 开头几天净资产为 0(没有盈亏)"""
+    rng = random.Random(seed)
+    dates, networth, disposable, incomes, expenses = [], [], [], [], []
+    date = datetime.date(2019, 10, 1)
+    value = decimal.Decimal(0)
+    for idx in range(num_days):
+        if idx >= 3:
+            value += decimal.Decimal(rng.randint(-500000, 600000)) / 100 + (
+                decimal.Decimal(100000) if idx == 3 else 0
+            )
+        income = decimal.Decimal(rng.choice([0, 0, 0, 2000000])) / 100
+        expense = decimal.Decimal(rng.randint(0, 30000)) / 100
+        dates.append(date)
+        networth.append(value)
+        disposable.append(value * decimal.Decimal("0.8"))
+        incomes.append(income)
+        expenses.append(expense)
+        date += datetime.timedelta(days=1)
+    return dates, networth, disposable, incomes, expenses
+
+
+def test_matches_decimal_path():
+    columns = make_columns()
+    max_errors = check_equivalence(NetworthSeries(*columns), compute_decimal_series(*columns))
+    assert set(max_errors) == {"pnl", "pnl_rate", "nav", "pnl_cum", "nav_ytd", "pnl_ytd"}
+
+
+def test_detects_difference():
+    columns = make_columns()
+    series = NetworthSeries(*columns)
+    series.nav_ytd[-1] *= 1.001
+    with pytest.raises(AssertionError, match="nav_ytd"):
+        check_equivalence(series, compute_decimal_series(*columns))
+
+
+def test_matches_decimal_path_on_ledger(ledger):
+    daily_values = compute_daily_values(
+        datetime.date(2019, 10, 1), datetime.date(2020, 12, 31), ledger=ledger
+    )
+    columns = get_series_columns(daily_values)
+    max_errors = check_equivalence(NetworthSeries(*columns), compute_decimal_series(*columns))
+    assert max_errors["pnl"] < 1e-6
+
+
+def test_new_columns_appended(ledger):
+    """表格中的公式按列引用, 新增的列只能追加在最后"""
+    rows = iter_networth_series(
+        datetime.date(2019, 10, 1), datetime.date(2019, 10, 31), ledger=ledger
+    )
+    columns = list(next(rows))
+    assert columns[:13] == [
+        "日期", "理论净资产", "净资产", "沉没资产", "可投资净资产", "非投资收入", "非投资支出",
+        "投资盈亏", "投资盈亏%", "累计净值", "累计盈亏", "当年净值", "当年盈亏",
+    ]
+    assert set(columns[13:17]) == {"股权%", "另类%", "债权%", "现金%"}
+    assert columns[17:] == ["回撤%", "波动率%"]
@@ -0,0 +1,68 @@
+import logging
+import datetime
+
+from beancount import loader
+
+from portfolio import iter_portfolio_matrices
+
+
+LEDGER = """
+option "operating_currency" "CNY"
+
+2000-01-01 commodity CNY
+  name: "人民币"
+  asset-class: "现金"
+  asset-subclass: "本币"
+2000-01-01 commodity JPY
+  name: "日元"
+  asset-class: "现金"
+  asset-subclass: "外汇"
+2000-01-01 commodity SPY
+  name: "标普500"
+  asset-class: "股票"
+  asset-subclass: "美股"
+
+2000-01-01 open Assets:Cash
+  name: "现金"
+2000-01-01 open Assets:Broker
+  name: "券商"
+2000-01-01 open Equity:Opening-Balances
+
+2019-12-01 * "期初"
+  Assets:Cash  1000 CNY
+  Assets:Cash  10000 JPY
+  Assets:Broker  10 SPY {300 USD}
+  Equity:Opening-Balances
+
+2019-12-20 price SPY 2100 CNY
+2019-12-20 price USD 7 CNY
+2019-12-27 price SPY 300 USD
+2019-12-28 price SPY 301 USD
+2019-12-29 price SPY 302 USD
+2019-12-30 price SPY 303 USD
+2019-12-31 price SPY 330 USD
+2019-12-31 price USD 7 CNY
+"""
+
+
+def get_rows(horizons, ledger=LEDGER):
+    entries, errors, options_map = loader.load_string(ledger)
+    assert not errors, errors
+    (_, rows, _), = iter_portfolio_matrices(
+        [datetime.date(2019, 12, 31)], horizons, (entries, errors, options_map)
+    )
+    return {row["代号"]: row for row in rows}
+
+
+def test_skips_holding_without_cny_rate(caplog):
+    with caplog.at_level(logging.WARNING, logger="portfolio"):
+        rows = get_rows([1])
+    assert set(rows) == {"CNY", "SPY"}
+    assert "No price of (JPY, CNY) as of 2019-12-31" in caplog.text
+
+
+def test_changes_use_direct_prices():
+    """5 日前没有 SPY/USD 的直接报价, 不用经 CNY 换算的价格计算涨跌幅"""
+    row = get_rows([1, 5], LEDGER.replace("  Assets:Cash  10000 JPY\n", ""))["SPY"]
+    assert row["1日%"] == row["市场价格"] / 303 - 1
+    assert row["5日%"] is None
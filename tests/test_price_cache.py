@@ -0,0 +1,39 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from price_cache import PriceCache, get_cache_file, ingest
+
+
+PRICES = """\
+; 手动补录的价格
+2019-12-30 price USD 6.99 CNY
+2019-12-31 price USD 6.970000000000000017763568394 CNY
+"""
+
+
+def test_ingest_prices(tmp_path):
+    path = tmp_path / "prices.beancount"
+    path.write_text(PRICES)
+    assert ingest(str(path)) == (2, 1, 1)
+    with PriceCache(get_cache_file(str(path))) as cache:
+        assert cache.is_fresh(str(path))
+        assert cache.read_price_lists() == {("USD", "CNY"): [
+            (datetime.date(2019, 12, 30), Decimal("6.99")),
+            (datetime.date(2019, 12, 31), Decimal("6.97")),
+        ]}
+
+
+@pytest.mark.parametrize("extra", [
+    '2019-01-01 commodity USD\n  price-precision: 4\n',
+    '2019-12-31 event "location" "Shanghai"\n',
+    'include "other.beancount"\n',
+])
+def test_ingest_rejects_other_directives(tmp_path, extra):
+    """用缓存加载时价格文件不会再被解析, 不能静默丢掉其中的其他指令"""
+    path = tmp_path / "prices.beancount"
+    path.write_text(PRICES + extra)
+    with pytest.raises(ValueError, match="directives other than price"):
+        ingest(str(path))
+    assert not (tmp_path / ".prices.beancount.bin").exists()
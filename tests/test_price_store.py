@@ -0,0 +1,85 @@
+import os
+import datetime
+
+from price_store import PriceStore
+
+
+PRICES = """\
+2019-12-30 price USD 6.99 CNY
+2019-12-31 price USD 6.97 CNY
+2019-12-31 price HKD 0.89 CNY
+"""
+
+
+def write_prices(path, content, mtime_ns=None):
+    path.write_text(content)
+    if mtime_ns is not None:
+        os.utime(str(path), ns=(mtime_ns, mtime_ns))
+
+
+def test_reuses_index_for_appended_file(tmp_path):
+    path = tmp_path / "prices.beancount"
+    write_prices(path, PRICES)
+    PriceStore(str(path))
+
+    write_prices(path, PRICES + "2020-01-02 price USD 6.96 CNY\n")
+    store = PriceStore(str(path))
+    assert store.last_date == datetime.date(2020, 1, 2)
+    assert store.dates("USD", "CNY") == {
+        datetime.date(2019, 12, 30), datetime.date(2019, 12, 31), datetime.date(2020, 1, 2),
+    }
+
+
+def test_rebuilds_index_after_edit_before_tail(tmp_path):
+    """改写文件开头(大小不变)后再追加, 旧索引不能再用"""
+    history = "".join(
+        "%s price HKD 0.89 CNY\n" % (datetime.date(2019, 1, 1) + datetime.timedelta(days=idx))
+        for idx in range(300)
+    )
+    path = tmp_path / "prices.beancount"
+    write_prices(path, PRICES + history)
+    mtime_ns = os.stat(str(path)).st_mtime_ns
+    PriceStore(str(path))
+
+    edited = PRICES.replace("2019-12-30 price USD", "2019-12-29 price USD") + history
+    write_prices(path, edited, mtime_ns + 10 ** 9)
+    assert PriceStore(str(path)).dates("USD", "CNY") == {
+        datetime.date(2019, 12, 29), datetime.date(2019, 12, 31),
+    }
+
+    edited = PRICES.replace("USD 6.99", "EUR 7.99") + history + "2020-01-02 price USD 6.96 CNY\n"
+    write_prices(path, edited)
+    store = PriceStore(str(path))
+    assert store.dates("EUR", "CNY") == {datetime.date(2019, 12, 30)}
+    assert store.dates("USD", "CNY") == {datetime.date(2019, 12, 31), datetime.date(2020, 1, 2)}
+
+
+def test_compact_keeps_non_price_lines(tmp_path):
+    path = tmp_path / "prices.beancount"
+    write_prices(path, (
+        "; 手动补录的价格\n"
+        "2019-12-31 price USD 6.97 CNY\n"
+        "  source: \"manual\"\n"
+        "\n"
+        "2019-12-30 price USD 6.99 CNY\n"
+        "2019-12-31 price USD 6.98 CNY\n"
+    ))
+    store = PriceStore(str(path))
+    assert store.compact() == (3, 2)
+    assert path.read_text() == (
+        "; 手动补录的价格\n"
+        "2019-12-30 price USD 6.99 CNY\n"
+        "2019-12-31 price USD 6.98 CNY\n"
+    )
+
+    write_prices(path, (
+        "2019-12-31 price USD 6.97 CNY\n"
+        "  source: \"manual\"\n"
+        "2019-12-30 price USD 6.99 CNY\n"
+    ))
+    PriceStore(str(path)).compact()
+    assert path.read_text() == (
+        "2019-12-30 price USD 6.99 CNY\n"
+        "2019-12-31 price USD 6.97 CNY\n"
+        "  source: \"manual\"\n"
+    )
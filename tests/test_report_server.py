@@ -0,0 +1,106 @@
+import json
+import logging
+
+import pytest
+
+from conftest import copy_ledger, load_script
+from ledger_loader import get_prices_file, load_ledger
+from networth import compute_networth_series, format_row
+from price_cache import ingest
+from price_index import PriceIndex
+
+
+report_server = load_script("report-server.py")
+
+NETWORTH_QUERY = {"since": "2019-10-01", "end": "2019-10-31"}
+EXTRA_TXN = """
+2019-10-15 * "利息"
+  Assets:CN:Saving:CMB  10000 CNY
+  Income:CN:Saving:Interest
+"""
+
+
+@pytest.fixture
+def state(tmp_path):
+    return report_server.ReportState(copy_ledger(tmp_path))
+
+
+@pytest.fixture
+def index_builds(monkeypatch):
+    """PriceIndex.build 被调用的次数"""
+    builds = []
+    build = PriceIndex.build.__func__
+
+    def counted_build(cls, entries, options_map):
+        builds.append(len(entries))
+        return build(cls, entries, options_map)
+
+    monkeypatch.setattr(PriceIndex, "build", classmethod(counted_build))
+    return builds
+
+
+def expected_networth(ledger_file):
+    ledger = load_ledger(ledger_file, use_cache=False, use_price_cache=False, jobs=1)
+    rows = compute_networth_series(
+        report_server.parse_date(NETWORTH_QUERY["since"]),
+        report_server.parse_date(NETWORTH_QUERY["end"]), ledger=ledger,
+    )
+    return report_server.render_rows([format_row(row) for row in rows], "csv")
+
+
+def test_reuses_indexes_until_ledger_changes(state, index_builds):
+    _, networth = state.handle("/networth", NETWORTH_QUERY)
+    state.handle("/networth", dict(NETWORTH_QUERY, format="json"))
+    state.handle("/portfolio", {"date": "2019-10-31"})
+    state.handle("/portfolio", {"monthly_since": "2019-08-01", "date": "2019-10-31"})
+    # 帐本没变时相同的请求直接返回上次的结果
+    assert state.handle("/networth", NETWORTH_QUERY)[1] == networth
+    assert len(index_builds) == 1
+    assert networth == expected_networth(state.loader.ledger_file)
+    del index_builds[:]
+
+    with open(state.loader.ledger_file, "a") as fhandler:
+        fhandler.write(EXTRA_TXN)
+    _, changed = state.handle("/networth", NETWORTH_QUERY)
+    state.handle("/portfolio", {"date": "2019-10-31"})
+    assert len(index_builds) == 1
+    # 检查点中 10-15 及以后的日期失效, 结果和重新计算的一致
+    assert changed != networth
+    assert changed == expected_networth(state.loader.ledger_file)
+
+    status = json.loads(state.handle("/status", {})[1])
+    assert status[0]["generation"] == 2
+
+
+def test_bad_requests(state):
+    with pytest.raises(report_server.BadRequest):
+        state.handle("/networth", {"since": "2019-13-01"})
+    with pytest.raises(report_server.BadRequest):
+        state.handle("/portfolio", {"format": "xml"})
+    with pytest.raises(report_server.NotFound):
+        state.handle("/holdings", {})
+
+
+def test_server_and_cli_keep_their_checkpoints(tmp_path, caplog):
+    """server 解析价格文件, 命令行用价格缓存, 交替运行时不会让对方的检查点失效"""
+    ledger_file = copy_ledger(tmp_path)
+    ingest(get_prices_file(ledger_file))
+    state = report_server.ReportState(ledger_file)
+    since, end = (report_server.parse_date(NETWORTH_QUERY[key]) for key in ("since", "end"))
+
+    def run_cli():
+        ledger = load_ledger(ledger_file, use_cache=False, jobs=1)
+        assert "price_cache" in ledger[2]
+        return compute_networth_series(since, end, use_checkpoint=True, ledger=ledger)
+
+    def run_server():
+        state.responses.clear()
+        return state.handle("/networth", NETWORTH_QUERY)[1]
+
+    cli_rows, server_csv = run_cli(), run_server()
+    caplog.set_level(logging.INFO, logger="networth")
+    for _ in range(2):
+        caplog.clear()
+        assert run_cli() == cli_rows
+        assert run_server() == server_csv
+        assert caplog.text.count("Computed 0 days") == 2
@@ -0,0 +1,61 @@
+import time
+import types
+import datetime
+import threading
+from concurrent import futures
+
+from conftest import load_script
+
+
+update_prices = load_script("update-prices.py")
+
+
+class FakeSource:
+    """记录 prefetch 的参数和同时进行的调用数"""
+    calls = []
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def prefetch(self, tickers, start_date, end_date):
+        cls = type(self)
+        with cls.lock:
+            cls.calls.append(tickers)
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(0.05)
+        with cls.lock:
+            cls.active -= 1
+
+
+def make_module(name, batch):
+    source = type("Source", (FakeSource,), {
+        "calls": [], "active": 0, "max_active": 0, "lock": threading.Lock(),
+        "BATCH_PREFETCH": batch,
+    })
+    module = types.ModuleType(name)
+    module.Source = source
+    return module
+
+
+def make_job(module, symbol):
+    psource = types.SimpleNamespace(module=module, symbol=symbol)
+    return types.SimpleNamespace(sources=[psource])
+
+
+def test_prefetch_one_task_per_ticker(monkeypatch):
+    single = make_module("single", batch=False)
+    batch = make_module("batch", batch=True)
+    monkeypatch.setitem(update_prices.SOURCE_CONCURRENCY, "single", 3)
+    tickers = ["T%d" % idx for idx in range(6)]
+    jobs = [make_job(single, ticker) for ticker in tickers]
+    jobs += [make_job(batch, ticker) for ticker in tickers]
+
+    fetcher = update_prices.PriceFetcher()
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+        update_prices.prefetch_sources(
+            executor, fetcher, jobs, datetime.date(2019, 12, 1), datetime.date(2019, 12, 31)
+        )
+    assert sorted(single.Source.calls) == tickers
+    assert single.Source.max_active == 3
+    assert batch.Source.calls == [tickers]
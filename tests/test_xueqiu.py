@@ -0,0 +1,189 @@
+import os
+import json
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import pytest
+
+import xueqiu
+
+
+KLINE_PATH = "/v5/stock/chart/kline.json"
+
+
+def get_close(symbol, date):
+    return round(1 + len(symbol) + date.toordinal() % 50 / 100, 3)
+
+
+def kline_handler(host, query):
+    """工作日有日K, 返回 begin 当日及之前的 count 根, 按时间升序"""
+    assert host == "stock.xueqiu.com"
+    begin = datetime.datetime.fromtimestamp(int(query["begin"]) / 1000, xueqiu.CN_TZ)
+    count = -int(query["count"])
+    items = []
+    curr_date = begin.date()
+    while len(items) < count:
+        if curr_date.weekday() < 5:
+            midnight = datetime.datetime.combine(curr_date, datetime.time(), xueqiu.CN_TZ)
+            item = [0] * len(xueqiu.EXPECTED_COLS)
+            item[xueqiu.TIMESTAMP_IDX] = int(midnight.timestamp()) * 1000
+            item[xueqiu.CLOSE_IDX] = get_close(query["symbol"], curr_date)
+            items.append(item)
+        curr_date -= datetime.timedelta(days=1)
+    result = {
+        "error_code": 0,
+        "error_description": "",
+        "data": {"column": xueqiu.EXPECTED_COLS, "item": items[::-1]},
+    }
+    return 200, json.dumps(result)
+
+
+@pytest.fixture
+def source(stub_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(xueqiu, "COOKIE_FILE", str(tmp_path / "cookies.pickle"))
+    for name in ("_bar_cache", "_bar_dates", "_fetched_ranges"):
+        monkeypatch.setattr(xueqiu.Source, name, {})
+    monkeypatch.setattr(xueqiu.Source, "request_count", 0)
+    monkeypatch.setattr(xueqiu.Source, "_session_ready", False)
+    xueqiu.Source.http.cookies.clear()
+    stub_server.routes["/"] = lambda host, query: (200, "")
+    stub_server.routes[KLINE_PATH] = kline_handler
+    yield xueqiu.Source()
+    xueqiu.Source.http.cookies.clear()
+
+
+class XueqiuSite:
+    """首页发 xq_a_token, kline 接口只接受最新的 token"""
+
+    def __init__(self, stub_server, error_code):
+        self.stub_server = stub_server
+        self.error_code = error_code
+        self.token = 0
+        stub_server.routes["/"] = self.home_handler
+        stub_server.routes[KLINE_PATH] = self.kline_handler
+
+    def home_handler(self, host, query):
+        assert host == "xueqiu.com"
+        self.token += 1
+        return 200, "", {"Set-Cookie": f"xq_a_token={self.token}; Path=/"}
+
+    def kline_handler(self, host, query):
+        cookie = self.stub_server.request_headers[-1].get("Cookie") or ""
+        if cookie != f"xq_a_token={self.token}":
+            return 400, json.dumps({
+                "error_code": self.error_code,
+                "error_description": "遇到错误，请刷新页面或者重新登录帐号后再试",
+            })
+        return kline_handler(host, query)
+
+
+def new_process(monkeypatch):
+    """模拟重新启动进程: 内存中的 cookie 和K线都没有了"""
+    for name in ("_bar_cache", "_bar_dates", "_fetched_ranges"):
+        monkeypatch.setattr(xueqiu.Source, name, {})
+    monkeypatch.setattr(xueqiu.Source, "_session_ready", False)
+    xueqiu.Source.http.cookies.clear()
+
+
+def iter_dates(start_date, end_date):
+    while start_date <= end_date:
+        yield start_date
+        start_date += datetime.timedelta(days=1)
+
+
+def test_prefetch_one_request_per_ticker(source, stub_server):
+    start_date, end_date = datetime.date(2019, 12, 2), datetime.date(2019, 12, 31)
+    tickers = ["CN:SH510300", "CN:SZ159915"]
+    for ticker in tickers:
+        prices = source.prefetch(ticker, start_date, end_date)
+        assert len(prices) == 22
+        # 和价格源一样把 JSON 中的浮点数转成 18 位小数
+        expected = Decimal(get_close(ticker[3:], end_date)).quantize(Decimal("1e-18"))
+        assert prices[-1].price == expected
+        assert prices[-1].quote_currency == "CNY"
+    assert xueqiu.Source.request_count == len(tickers)
+    assert stub_server.count(KLINE_PATH) == len(tickers)
+    assert sorted(query["symbol"] for _, path, query in stub_server.requests
+                  if path == KLINE_PATH) == ["SH510300", "SZ159915"]
+
+    # 窗口内的每一天(包括周末)都直接读内存
+    for ticker in tickers:
+        for date in iter_dates(start_date, end_date):
+            assert source.get_historical_price(ticker, date) is not None
+    assert xueqiu.Source.request_count == len(tickers)
+
+
+def test_cached_prices_equal_single_requests(source, stub_server, monkeypatch):
+    ticker = "CN:SH510300"
+    start_date, end_date = datetime.date(2019, 12, 2), datetime.date(2019, 12, 31)
+    source.prefetch(ticker, start_date, end_date)
+    dates = list(iter_dates(start_date, end_date))
+    cached = [source.get_historical_price(ticker, date) for date in dates]
+    assert xueqiu.Source.request_count == 1
+
+    monkeypatch.setattr(xueqiu.Source, "_fetched_ranges", {})
+    single = [source.get_historical_price(ticker, date) for date in dates]
+    assert xueqiu.Source.request_count == 1 + len(dates)
+    assert cached == single
+    # 周末返回周五的收盘价
+    assert cached[5].time.date() == datetime.date(2019, 12, 6)
+
+
+def test_warm_up_lazily_and_once(source, stub_server):
+    XueqiuSite(stub_server, "400016")
+    assert stub_server.requests == []
+    source.prefetch("CN:SH510300", datetime.date(2019, 12, 2), datetime.date(2019, 12, 31))
+    source.prefetch("CN:SZ159915", datetime.date(2019, 12, 2), datetime.date(2019, 12, 31))
+    assert [path for _, path, _ in stub_server.requests] == ["/", KLINE_PATH, KLINE_PATH]
+
+
+def test_reuse_saved_cookies(source, stub_server, monkeypatch):
+    site = XueqiuSite(stub_server, "400016")
+    source.prefetch("CN:SH510300", datetime.date(2019, 12, 2), datetime.date(2019, 12, 31))
+    assert os.path.exists(xueqiu.COOKIE_FILE)
+
+    new_process(monkeypatch)
+    prices = xueqiu.Source().prefetch(
+        "CN:SH510300", datetime.date(2019, 12, 2), datetime.date(2019, 12, 31)
+    )
+    assert len(prices) == 22
+    assert stub_server.count("/") == 1
+    assert stub_server.count(KLINE_PATH) == 2
+    assert site.token == 1
+
+
+@pytest.mark.parametrize("error_code", ["400016", 400016])
+def test_refresh_expired_cookies(source, stub_server, monkeypatch, error_code):
+    """保存的 cookie 过期后重新访问首页并重试一次, 新的 cookie 写回文件"""
+    site = XueqiuSite(stub_server, error_code)
+    source.prefetch("CN:SH510300", datetime.date(2019, 12, 2), datetime.date(2019, 12, 31))
+    # 服务端让旧的 token 失效
+    site.token += 1
+
+    new_process(monkeypatch)
+    price = xueqiu.Source().get_historical_price("CN:SH510300", datetime.date(2019, 12, 31))
+    assert price.price == Decimal(get_close("SH510300", datetime.date(2019, 12, 31))).quantize(
+        Decimal("1e-18"))
+    assert [path for _, path, _ in stub_server.requests] == [
+        "/", KLINE_PATH, KLINE_PATH, "/", KLINE_PATH,
+    ]
+    assert xueqiu.Source.request_count == 3
+
+    new_process(monkeypatch)
+    xueqiu.Source().get_historical_price("CN:SH510300", datetime.date(2019, 12, 30))
+    assert stub_server.count("/") == 2
+    assert stub_server.count(KLINE_PATH) == 4
+
+
+def test_prefetch_from_threads(source, stub_server):
+    tickers = ["CN:SH5103%02d" % idx for idx in range(16)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(
+            lambda ticker: source.prefetch(
+                ticker, datetime.date(2019, 12, 2), datetime.date(2019, 12, 31)),
+            tickers,
+        ))
+    assert [len(prices) for prices in results] == [22] * len(tickers)
+    assert xueqiu.Source.request_count == stub_server.count(KLINE_PATH) == len(tickers)
+    assert stub_server.count("/") == 1